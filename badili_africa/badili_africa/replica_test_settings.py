@@ -0,0 +1,22 @@
+# Test settings with a second database standing in for a read replica, so
+# finance.tests.ReplicaRoutingTests can check where reads go:
+#
+#   python manage.py test finance --settings=badili_africa.replica_test_settings
+#
+# The replica is a test database of its own rather than a mirror of the
+# primary. Nothing replicates to it, so rows written only to the primary show
+# whether a read was routed.
+
+from .settings import *  # noqa: F401,F403
+
+DATABASES['replica_0'] = {
+    **DATABASES['default'],
+    'TEST': {'NAME': f"test_{DATABASES['default']['NAME']}_replica"},
+}
+# Enabled by the tests that route reads; the rest of the suite uses the
+# primary only
+DATABASE_REPLICAS = []
+
+# Tests run in one process, so a local cache can stand in for the shared one
+CACHES['sticky'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'sticky'}
+DB_REPLICA_STICKY_CACHE = 'sticky'
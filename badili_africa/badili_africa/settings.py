@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'finance',
     'rest_framework',
@@ -51,8 +52,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'finance.middleware.RequestMetricsMiddleware',
+    'finance.middleware.ReplicaRoutingMiddleware',
+    'finance.middleware.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
-    'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +85,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'badili_africa.wsgi.application'
 
+# Serve the expense list/create, expenses-by-project and receipt upload
+# endpoints with native async views. Only useful under ASGI (uvicorn, daphne).
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'false').lower() == 'true'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -101,18 +108,94 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # Keep connections open between requests, checking them before reuse
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# Django's connection pool instead of persistent connections; needs
+# psycopg 3 with its pool extra (pip install "psycopg[pool]")
+if os.getenv('DB_POOL', 'false').lower() == 'true':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        }
     }
+
+# Read replicas as comma-separated host[:port], with the primary's name and
+# credentials. finance.middleware.ReplicaRoutingMiddleware sends the reads
+# of safe requests to them. Replicas are read-only, so the test runner never
+# creates databases on them.
+DATABASE_REPLICAS = []
+for index, replica in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(','))):
+    host, _, port = replica.strip().partition(':')
+    alias = f'replica_{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['finance.routers.ReplicaRouter']
+# How long a client that wrote keeps reading from the primary; longer than
+# the replicas' usual lag
+DB_REPLICA_STICKY_SECONDS = int(os.getenv('DB_REPLICA_STICKY_SECONDS', 5))
+
+# A cache every worker shares, e.g. redis://localhost:6379/0 (needs the redis
+# package); the default cache is private to each process
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
 }
+SHARED_CACHE_URL = os.getenv('SHARED_CACHE_URL', '')
+if SHARED_CACHE_URL:
+    CACHES['shared'] = {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': SHARED_CACHE_URL}
+# Entry in CACHES remembering which clients wrote recently. Required with
+# replicas: the client's next request may reach any worker.
+DB_REPLICA_STICKY_CACHE = os.getenv('DB_REPLICA_STICKY_CACHE', 'shared' if SHARED_CACHE_URL else '')
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'finance.authentication.BearerTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
+    # Reverse proxies in front of the app. Throttles identify clients by the
+    # address that many hops back in X-Forwarded-For, and by REMOTE_ADDR when
+    # 0, so clients cannot pick their own address by sending the header.
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 0)),
 }
 
+# Token authentication cache; TOKEN_CACHE_SHARED_BACKEND names an entry in
+# CACHES (e.g. Redis) shared by every worker, left empty for in-process only
+TOKEN_CACHE_ENABLED = os.getenv('TOKEN_CACHE_ENABLED', 'true').lower() == 'true'
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 60))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('TOKEN_CACHE_MAX_ENTRIES', 10000))
+TOKEN_CACHE_SHARED_BACKEND = os.getenv('TOKEN_CACHE_SHARED_BACKEND', '')
+
 
 
+# Stored hashes use the first hasher; the others only verify older hashes,
+# which are upgraded on the next successful login
+PASSWORD_HASHERS = [
+    'finance.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+# PBKDF2 work factor; 0 uses Django's default. Lower it only as far as
+# `manage.py benchmark_password_hashing` shows your workers need
+PASSWORD_PBKDF2_ITERATIONS = int(os.getenv('PASSWORD_PBKDF2_ITERATIONS', 0))
+
+# Login throttling (DRF rate strings such as "30/m"; empty disables): all
+# attempts per client address, and failed attempts per username
+LOGIN_RATE_PER_IP = os.getenv('LOGIN_RATE_PER_IP', '30/m')
+LOGIN_FAILURES_PER_USER = os.getenv('LOGIN_FAILURES_PER_USER', '10/h')
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -159,8 +242,145 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Receipt storage: 'local' (MEDIA_ROOT) or 's3' for any S3-compatible bucket
+RECEIPT_STORAGE = os.getenv('RECEIPT_STORAGE', 'local')
+# Serve local receipts through short-lived signed URLs instead of MEDIA_URL
+RECEIPT_SIGNED_URLS = os.getenv('RECEIPT_SIGNED_URLS', 'false').lower() == 'true'
+RECEIPT_URL_EXPIRY = int(os.getenv('RECEIPT_URL_EXPIRY', 3600))
+# How signed local downloads are sent: 'django', 'x-accel-redirect' (nginx)
+# or 'x-sendfile' (Apache, lighttpd)
+RECEIPT_SERVE_MODE = os.getenv('RECEIPT_SERVE_MODE', 'django')
+RECEIPT_ACCEL_PREFIX = os.getenv('RECEIPT_ACCEL_PREFIX', '/protected-media/')
+
+# Thumbnails and PDF previews rendered beside each receipt
+RECEIPT_DERIVATIVES_ENABLED = os.getenv('RECEIPT_DERIVATIVES_ENABLED', 'true').lower() == 'true'
+RECEIPT_DERIVATIVE_WORKERS = int(os.getenv('RECEIPT_DERIVATIVE_WORKERS', 2))
+RECEIPT_THUMBNAIL_EDGE = int(os.getenv('RECEIPT_THUMBNAIL_EDGE', 320))
+RECEIPT_PREVIEW_EDGE = int(os.getenv('RECEIPT_PREVIEW_EDGE', 1200))
+
+# Read by django-storages when RECEIPT_STORAGE=s3
+AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME')
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL')
+AWS_S3_REGION_NAME = os.getenv('AWS_S3_REGION_NAME')
+AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
+AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
+AWS_S3_ADDRESSING_STYLE = os.getenv('AWS_S3_ADDRESSING_STYLE', 'auto')
+AWS_S3_SIGNATURE_VERSION = 's3v4'
+AWS_DEFAULT_ACL = None
+
 CORS_ALLOW_ALL_ORIGINS = True
 
+# Receipt extraction
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+RECEIPT_PROVIDER_URL = os.getenv('RECEIPT_PROVIDER_URL', 'https://api.openai.com/v1/')
+# Seconds to wait for the model provider before giving up on a receipt
+RECEIPT_EXTRACTION_TIMEOUT = float(os.getenv('RECEIPT_EXTRACTION_TIMEOUT', 60))
+RECEIPT_PROVIDER_CONNECT_TIMEOUT = float(os.getenv('RECEIPT_PROVIDER_CONNECT_TIMEOUT', 5))
+RECEIPT_PROVIDER_MAX_CONNECTIONS = int(os.getenv('RECEIPT_PROVIDER_MAX_CONNECTIONS', 20))
+# The provider is skipped for RECEIPT_PROVIDER_RESET_TIMEOUT seconds after this many consecutive failures
+RECEIPT_PROVIDER_FAILURE_THRESHOLD = int(os.getenv('RECEIPT_PROVIDER_FAILURE_THRESHOLD', 5))
+RECEIPT_PROVIDER_RESET_TIMEOUT = float(os.getenv('RECEIPT_PROVIDER_RESET_TIMEOUT', 30))
+RECEIPT_MODEL = os.getenv('RECEIPT_MODEL', 'gpt-4o')
+
+# Extraction backends in order of preference. When a backend has not answered
+# within its RECEIPT_HEDGE_PERCENTILE latency (RECEIPT_HEDGE_AFTER seconds until
+# RECEIPT_HEDGE_MIN_SAMPLES calls were timed) or has failed, the receipt is also
+# sent to the next one and the first usable result wins. The offline backend
+# reads totals from PDF text and only runs when every other backend failed.
+RECEIPT_EXTRACTORS = {
+    'default': {
+        'BACKEND': 'finance.extractors.ChatCompletionsExtractor',
+        'MODEL': RECEIPT_MODEL,
+    },
+}
+if os.getenv('RECEIPT_HEDGE_PROVIDER_URL'):
+    RECEIPT_EXTRACTORS['hedge'] = {
+        'BACKEND': 'finance.extractors.ChatCompletionsExtractor',
+        'URL': os.getenv('RECEIPT_HEDGE_PROVIDER_URL'),
+        'API_KEY': os.getenv('RECEIPT_HEDGE_API_KEY'),
+        'MODEL': os.getenv('RECEIPT_HEDGE_MODEL', RECEIPT_MODEL),
+    }
+if os.getenv('RECEIPT_OFFLINE_FALLBACK', 'true').lower() == 'true':
+    RECEIPT_EXTRACTORS['offline'] = {
+        'BACKEND': 'finance.extractors.OfflineExtractor',
+    }
+RECEIPT_HEDGE_PERCENTILE = float(os.getenv('RECEIPT_HEDGE_PERCENTILE', 95))
+RECEIPT_HEDGE_AFTER = float(os.getenv('RECEIPT_HEDGE_AFTER', 10))
+RECEIPT_HEDGE_MIN_SAMPLES = int(os.getenv('RECEIPT_HEDGE_MIN_SAMPLES', 20))
+RECEIPT_HEDGE_WINDOW = int(os.getenv('RECEIPT_HEDGE_WINDOW', 500))
+RECEIPT_HEDGE_WORKERS = int(os.getenv('RECEIPT_HEDGE_WORKERS', 16))
+
+# Where queued extraction jobs run: 'finance.jobs.DatabaseJobBackend' leaves them in the
+# database for `manage.py run_extraction_worker`, 'finance.jobs.ThreadPoolJobBackend'
+# runs them on threads inside the web process.
+EXTRACTION_JOB_BACKEND = os.getenv('EXTRACTION_JOB_BACKEND', 'finance.jobs.DatabaseJobBackend')
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', 4))
+EXTRACTION_MAX_ATTEMPTS = int(os.getenv('EXTRACTION_MAX_ATTEMPTS', 3))
+EXTRACTION_RETRY_BACKOFF = float(os.getenv('EXTRACTION_RETRY_BACKOFF', 2))
+EXTRACTION_CALLBACK_TIMEOUT = float(os.getenv('EXTRACTION_CALLBACK_TIMEOUT', 10))
+# Hosts that job callbacks may be sent to; callbacks are refused while empty
+EXTRACTION_CALLBACK_HOSTS = [host.strip().lower() for host in os.getenv('EXTRACTION_CALLBACK_HOSTS', '').split(',') if host.strip()]
+# Seconds after which a job still running is presumed lost with its worker
+# and run again; keep it well above the longest extraction
+EXTRACTION_JOB_LEASE = float(os.getenv('EXTRACTION_JOB_LEASE', 600))
+
+# /api/file/batch/ limits
+RECEIPT_BATCH_MAX_FILES = int(os.getenv('RECEIPT_BATCH_MAX_FILES', 50))
+RECEIPT_BATCH_CONCURRENCY = int(os.getenv('RECEIPT_BATCH_CONCURRENCY', 8))
+
+# Receipts are rasterized (PDF), downscaled to RECEIPT_MAX_EDGE pixels and
+# recompressed as JPEG before being sent for extraction
+RECEIPT_PREPROCESS_ENABLED = os.getenv('RECEIPT_PREPROCESS_ENABLED', 'true').lower() == 'true'
+RECEIPT_MAX_EDGE = int(os.getenv('RECEIPT_MAX_EDGE', 1600))
+RECEIPT_JPEG_QUALITY = int(os.getenv('RECEIPT_JPEG_QUALITY', 80))
+
+# Extraction results are cached by receipt hash and prompt version
+RECEIPT_CACHE_ENABLED = os.getenv('RECEIPT_CACHE_ENABLED', 'true').lower() == 'true'
+RECEIPT_CACHE_TTL = int(os.getenv('RECEIPT_CACHE_TTL', 30 * 24 * 60 * 60))
+RECEIPT_CACHE_MAX_ENTRIES = int(os.getenv('RECEIPT_CACHE_MAX_ENTRIES', 50000))
+# Share of cache writes that also evict; 0 leaves eviction to the
+# evict_extraction_cache command
+RECEIPT_CACHE_EVICT_PROBABILITY = float(os.getenv('RECEIPT_CACHE_EVICT_PROBABILITY', 0.01))
+
+# Perceptual hashes of receipts, to flag another photo of a receipt already
+# on an expense. Receipts whose hashes differ in at most
+# RECEIPT_DUPLICATE_DISTANCE of 64 bits count as the same.
+RECEIPT_FINGERPRINTS_ENABLED = os.getenv('RECEIPT_FINGERPRINTS_ENABLED', 'true').lower() == 'true'
+RECEIPT_DUPLICATE_DISTANCE = int(os.getenv('RECEIPT_DUPLICATE_DISTANCE', 6))
+
+# Bulk expense import
+EXPENSE_IMPORT_CHUNK_SIZE = int(os.getenv('EXPENSE_IMPORT_CHUNK_SIZE', 1000))
+
+# Server-side cache of the polled list responses; 0 disables it
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', 60))
+
+# Spending summaries
+SPENDING_SUMMARY_CACHE_TIMEOUT = int(os.getenv('SPENDING_SUMMARY_CACHE_TIMEOUT', 300))
+
+# Copying project and officer renames onto existing expenses: rows per
+# UPDATE and seconds to wait between batches
+DENORMALIZATION_BATCH_SIZE = int(os.getenv('DENORMALIZATION_BATCH_SIZE', 1000))
+DENORMALIZATION_BATCH_PAUSE = float(os.getenv('DENORMALIZATION_BATCH_PAUSE', 0))
+
+# Delta sync for offline clients: changes per page by default and at most
+SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', 500))
+SYNC_MAX_PAGE_SIZE = int(os.getenv('SYNC_MAX_PAGE_SIZE', 2000))
+
+# brotli (when installed) or gzip compression of response bodies of at least
+# RESPONSE_COMPRESSION_MIN_BYTES, for clients that accept it
+RESPONSE_COMPRESSION_ENABLED = os.getenv('RESPONSE_COMPRESSION_ENABLED', 'true').lower() == 'true'
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', 512))
+
+# Request metrics, served at /api/metrics/
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# Adds a Server-Timing header with app, db and provider durations
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+# Fraction of synchronous requests to profile; the profile is saved to
+# PROFILE_DIR only when the request took at least PROFILE_SLOW_REQUEST_MS
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_REQUEST_MS = float(os.getenv('PROFILE_SLOW_REQUEST_MS', 1000))
+PROFILE_DIR = os.getenv('PROFILE_DIR', str(BASE_DIR / 'profiles'))
+
 # CORS_ALLOWED_ORIGINS = [
 #     "http://localhost:3000",
 # ]
\ No newline at end of file
@@ -2,19 +2,36 @@ from django.urls import include, path
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework import routers
-from finance import views
+from finance import async_views, views
 
 router = routers.DefaultRouter()
 router.register(r'users', views.UserViewSet)
 router.register(r'projects', views.ProjectViewSet)
 router.register(r'expenses', views.ExpenseViewSet)
 
-urlpatterns = [
+# Under ASGI the hot endpoints can be served by native async views instead
+async_urlpatterns = [
+    path('api/expenses/', async_views.expense_list, name='expense-list'),
+    path('api/projects/<int:project_id>/expenses/', async_views.get_expenses_by_project, name='expenses-by-project'),
+    path('api/file/', async_views.upload_receipt_and_extract_data, name='upload_receipt'),
+    path('api/login/', async_views.login, name='api_login'),
+]
+
+urlpatterns = (async_urlpatterns if settings.ASYNC_VIEWS else []) + [
     path('api/', include(router.urls)),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('api/projects/<int:project_id>/expenses/', views.get_expenses_by_project, name='expenses-by-project'),
     path('api/signup/', views.SignupView.as_view(), name='signup'),
     path('api/login/', views.LoginView.as_view(), name='api_login'),
     path('api/projects/<str:project_name>/update_status/', views.update_project_status, name='update_project_status'),
+    path('api/sync/', views.sync_changes, name='sync'),
     path('api/file/', views.upload_receipt_and_extract_data, name='upload_receipt'),
+    path('api/file/batch/', views.upload_receipts_batch, name='upload_receipts_batch'),
+    path('api/file/jobs/<uuid:job_id>/', views.get_extraction_job, name='extraction_job'),
+    path('api/file/cache/stats/', views.get_extraction_cache_stats, name='extraction_cache_stats'),
+    path('api/auth/cache/stats/', views.get_token_cache_stats, name='token_cache_stats'),
+    path('api/metrics/', views.get_metrics, name='metrics'),
+    path('api/receipts/uploads/', views.create_receipt_upload, name='receipt_upload_target'),
+    path('api/receipts/upload/<path:name>', views.upload_receipt_content, name='receipt_upload'),
+    path('api/receipts/<path:name>', views.download_receipt, name='receipt_download'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,129 @@
+import json
+import re
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import Activity, Project
+from .sync import PROJECT, record_changes
+
+# A project's activities used to be a free-text blob on Project and every
+# expense named its activity in a free string. Activities are now rows tied to
+# their project and expenses point at one. Names are matched ignoring case and
+# surrounding space, so "fuel " on an expense lands on the project's "Fuel";
+# the expense's `activity` string is kept as a copy of the canonical name.
+
+def parse_activities(blob):
+    # Activity names from the old blob format: a JSON array, or names
+    # separated by commas, semicolons or new lines. Duplicates are dropped.
+    names = None
+    if isinstance(blob, (list, tuple)):
+        names = blob
+    else:
+        try:
+            names = json.loads(blob)
+        except (TypeError, ValueError):
+            pass
+        if not isinstance(names, list):
+            names = re.split(r'[,;\n]', str(blob or '').strip().strip('[]'))
+    unique = {}
+    for name in names:
+        name = str(name).strip().strip('"\'').strip()[:100]
+        if name:
+            unique.setdefault(name.casefold(), name)
+    return list(unique.values())
+
+def format_activities(names):
+    # The blob as the API always returned it
+    return json.dumps(names)
+
+def activities_added(project_ids):
+    # Project listings and the sync feed show activity names, so adding an
+    # activity changes its project
+    project_ids = set(project_ids)
+    if project_ids:
+        with transaction.atomic():
+            Project.objects.filter(pk__in=project_ids).update(updated_at=timezone.now())
+            record_changes(PROJECT, [(project_id, project_id) for project_id in project_ids])
+
+def set_activities(project, names):
+    # Make `names` the project's activities: missing ones are added, unlisted
+    # ones are removed unless expenses still point at them
+    existing = {activity.name.casefold(): activity for activity in Activity.objects.filter(project=project)}
+    wanted = {name.casefold(): name for name in names}
+    Activity.objects.bulk_create(
+        [Activity(project=project, name=name) for key, name in wanted.items() if key not in existing],
+        ignore_conflicts=True
+    )
+    unlisted = [activity.pk for key, activity in existing.items() if key not in wanted]
+    if unlisted:
+        Activity.objects.filter(pk__in=unlisted, expense__isnull=True).delete()
+
+def activity_for(project, name):
+    # The project's activity called `name`, created if it is new. Blank names
+    # have none.
+    name = str(name or '').strip()[:100]
+    if not name:
+        return None
+    activity = Activity.objects.filter(project=project, name__iexact=name).first()
+    if activity is not None:
+        return activity
+    try:
+        with transaction.atomic():
+            activity = Activity.objects.create(project=project, name=name)
+    except IntegrityError:
+        # Created meanwhile by a concurrent request
+        return Activity.objects.get(project=project, name__iexact=name)
+    activities_added([project.pk])
+    return activity
+
+def link_activities(expenses):
+    # Point unsaved expenses (bulk paths) at their activities in a few
+    # queries, creating the missing ones
+    def key(expense):
+        return (expense.project_id_id, expense.activity.strip().casefold())
+
+    named = [expense for expense in expenses if expense.activity.strip()]
+    project_ids = {expense.project_id_id for expense in named}
+
+    def lookup():
+        return {
+            (activity.project_id, activity.name.casefold()): activity
+            for activity in Activity.objects.filter(project_id__in=project_ids)
+        }
+
+    activities = lookup()
+    missing = {key(expense): expense for expense in named if key(expense) not in activities}
+    if missing:
+        Activity.objects.bulk_create(
+            [Activity(project_id=expense.project_id_id, name=expense.activity.strip()[:100]) for expense in missing.values()],
+            ignore_conflicts=True
+        )
+        activities = lookup()
+        activities_added(project_id for project_id, _ in missing)
+
+    for expense in named:
+        activity = activities[key(expense)]
+        expense.activity_ref = activity
+        expense.activity = activity.name
+    return expenses
+
+def budget_report(project):
+    # Budget against spend per activity. Sums are read from the
+    # (activity, amount) index on Expense without touching the table rows.
+    activities = Activity.objects.filter(project=project).annotate(
+        spent=Sum('expense__amount'), expense_count=Count('expense__amount')
+    ).order_by('name')
+    report = []
+    for activity in activities:
+        spent = activity.spent or 0
+        report.append({
+            'id': activity.pk,
+            'activity': activity.name,
+            'budget': f"{activity.budget:.2f}" if activity.budget is not None else None,
+            'spent': f"{spent:.2f}",
+            'remaining': f"{activity.budget - spent:.2f}" if activity.budget is not None else None,
+            'expense_count': activity.expense_count,
+        })
+    return report
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Project, Expense
+from .extraction import PROMPT_VERSION
+from .models import User, Project, Activity, Expense, ExtractionJob, ExtractionCacheEntry
 
 class CustomUserAdmin(UserAdmin):
     model = User
@@ -14,4 +15,42 @@ class CustomUserAdmin(UserAdmin):
 
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Project)
-admin.site.register(Expense)
\ No newline at end of file
+
+class ActivityAdmin(admin.ModelAdmin):
+    list_display = ['name', 'project', 'budget', 'created_at']
+    list_select_related = ['project']
+    raw_id_fields = ['project']
+    search_fields = ['name']
+
+admin.site.register(Activity, ActivityAdmin)
+class ExpenseAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'project_name', 'activity', 'amount', 'project_officer', 'created_at']
+    # Expense.__str__ reads the project name, so join it instead of querying per row
+    list_select_related = ['project_id', 'project_officer_id']
+    raw_id_fields = ['project_id', 'activity_ref', 'project_officer_id']
+
+admin.site.register(Expense, ExpenseAdmin)
+
+class ExtractionJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'status', 'attempts', 'submitted_by', 'created_at', 'run_ms']
+    list_filter = ['status']
+
+admin.site.register(ExtractionJob, ExtractionJobAdmin)
+
+class ExtractionCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ['file_hash', 'prompt_version', 'hits', 'created_at', 'last_used_at']
+    list_filter = ['prompt_version']
+    search_fields = ['file_hash']
+    actions = ['invalidate_entries', 'invalidate_outdated_prompt_entries']
+
+    @admin.action(description="Invalidate selected cache entries")
+    def invalidate_entries(self, request, queryset):
+        deleted, _ = queryset.delete()
+        self.message_user(request, f"Invalidated {deleted} cache entries.")
+
+    @admin.action(description="Invalidate selected entries not built from the current prompt")
+    def invalidate_outdated_prompt_entries(self, request, queryset):
+        deleted, _ = queryset.exclude(prompt_version=PROMPT_VERSION).delete()
+        self.message_user(request, f"Invalidated {deleted} cache entries (current prompt version {PROMPT_VERSION}).")
+
+admin.site.register(ExtractionCacheEntry, ExtractionCacheEntryAdmin)
\ No newline at end of file
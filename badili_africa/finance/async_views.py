@@ -0,0 +1,182 @@
+import math
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import serializers, status
+from rest_framework.exceptions import AuthenticationFailed, ParseError
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .authentication import BearerTokenAuthentication
+from .caching import cached_list, project_expenses_version
+from .extraction import aextract_receipt
+from .fingerprints import possible_duplicates
+from .jobs import submit_job
+from .login import FailedLoginThrottle, LoginRateThrottle, aauthenticate_login, aissue_token, login_response_data
+from .models import Expense
+from .pagination import ExpenseCursorPagination
+from .serializers import ExpenseSerializer
+from .uploads import use_receipt_upload_handler
+from .views import create_expense, expense_list_queryset, requested_expense_fields, validate_file, with_duplicates
+
+# Native async versions of the busiest endpoints for ASGI deployments. They
+# return the same JSON as their DRF counterparts in views.py, but database
+# access goes through the async ORM and receipts are extracted with the async
+# provider client, so a single worker can hold many slow uploads at once.
+
+def json_response(data, status=status.HTTP_200_OK):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+def async_api_view(methods):
+    # Bearer token authentication and IsAuthenticated for async views
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return json_response(
+                    {"detail": f'Method "{request.method}" not allowed.'},
+                    status=status.HTTP_405_METHOD_NOT_ALLOWED
+                )
+
+            authentication = BearerTokenAuthentication()
+            try:
+                auth = await authentication.aauthenticate(request)
+            except AuthenticationFailed as e:
+                auth = None
+                detail = str(e.detail)
+            else:
+                detail = "Authentication credentials were not provided."
+
+            if auth is None:
+                response = json_response({"detail": detail}, status=status.HTTP_401_UNAUTHORIZED)
+                response['WWW-Authenticate'] = authentication.authenticate_header(request)
+                return response
+
+            request.user, request.auth = auth
+            return await view(request, *args, **kwargs)
+        return csrf_exempt(wrapper)
+    return decorator
+
+async def load_form_data(request):
+    # Parsing multipart bodies writes uploads to disk, so keep it off the loop.
+    # Every caller takes receipts, which are hashed while they are received.
+    use_receipt_upload_handler(request)
+    return await sync_to_async(lambda: (request.POST, request.FILES))()
+
+def paginated_expense_data(request, queryset, serializer_context=None):
+    # Cursor-paginate like the DRF views
+    drf_request = Request(request)
+    fields = requested_expense_fields(drf_request)
+    paginator = ExpenseCursorPagination()
+    page = paginator.paginate_queryset(expense_list_queryset(queryset, fields), drf_request)
+    serializer = ExpenseSerializer(page, many=True, fields=fields, context=serializer_context or {})
+    return paginator.get_paginated_response(serializer.data).data
+
+async def paginated_expenses(request, queryset, serializer_context=None):
+    # On a thread, because DRF's paginator evaluates the queryset synchronously
+    return json_response(await sync_to_async(paginated_expense_data)(request, queryset, serializer_context))
+
+@async_api_view(['GET'])
+async def get_expenses_by_project(request, project_id):
+    version, updated_at = await sync_to_async(project_expenses_version)(project_id)
+    if version is None:
+        return await paginated_expenses(request, Expense.objects.filter(project_id=project_id))
+
+    # Same ETag and response cache as the synchronous view
+    build = lambda: paginated_expense_data(request, Expense.objects.filter(project_id=project_id))
+    data, headers = await sync_to_async(cached_list)(request, f'expenses-{project_id}', version, updated_at, build, signed_urls=True)
+    response = json_response(data) if data is not None else HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+@async_api_view(['GET', 'POST'])
+async def expense_list(request):
+    if request.method == 'GET':
+        return await paginated_expenses(request, Expense.objects.all(), {'request': request})
+
+    data, files = await load_form_data(request)
+
+    # Validating and saving query the database and write the receipt to
+    # storage, so the whole create runs on a thread
+    try:
+        expense = await sync_to_async(create_expense)(request, data, files)
+    except serializers.ValidationError as e:
+        return json_response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+    return json_response(expense, status=status.HTTP_201_CREATED)
+
+@async_api_view(['POST'])
+async def upload_receipt_and_extract_data(request):
+    data, files = await load_form_data(request)
+
+    # Get the uploaded file from the request
+    file = files.get('receipt', None)
+    if not file:
+        return json_response({"error": "No file uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Validate file size and extension
+    try:
+        await sync_to_async(validate_file)(file)
+    except ValidationError as e:
+        return json_response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # In async mode queue the extraction and let the client poll for the result
+    if data.get('mode') == 'async':
+        try:
+            job = await sync_to_async(submit_job)(file, user=request.user, callback_url=data.get('callback_url', ''))
+        except ValidationError as e:
+            return json_response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return json_response({
+            "job_id": str(job.pk),
+            "status": job.status,
+            "status_url": request.build_absolute_uri(reverse('extraction_job', args=[job.pk]))
+        }, status=status.HTTP_202_ACCEPTED)
+
+    # Await the provider without tying up a thread, and warn about expenses
+    # that may already have this receipt
+    try:
+        duplicates = await sync_to_async(possible_duplicates)(file)
+        receipt_data = await aextract_receipt(file)
+        return json_response(with_duplicates(receipt_data, duplicates))
+    except Exception as e:
+        return json_response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@csrf_exempt
+async def login(request):
+    if request.method != 'POST':
+        return json_response({"detail": f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    # Parse the body and apply the throttles before any password is hashed
+    drf_request = Request(request, parsers=[JSONParser(), FormParser(), MultiPartParser()])
+    def check_throttles():
+        data = drf_request.data
+        throttles = [LoginRateThrottle(), FailedLoginThrottle()]
+        return data, [throttle.wait() for throttle in throttles if not throttle.allow_request(drf_request, None)]
+    try:
+        data, waits = await sync_to_async(check_throttles)()
+    except ParseError as e:
+        return json_response({"detail": str(e.detail)}, status=status.HTTP_400_BAD_REQUEST)
+
+    if waits:
+        wait = math.ceil(max(wait or 0 for wait in waits))
+        response = json_response(
+            {"detail": f"Request was throttled. Expected available in {wait} seconds."},
+            status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response['Retry-After'] = str(wait)
+        return response
+
+    errors = {field: ["This field is required."] for field in ('username', 'password') if not data.get(field)}
+    if errors:
+        return json_response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+    user = await aauthenticate_login(data['username'], data['password'])
+    if user is None:
+        await sync_to_async(FailedLoginThrottle().record_failure)(drf_request, None)
+        return json_response({"non_field_errors": ["Incorrect Credentials"]}, status=status.HTTP_400_BAD_REQUEST)
+    return json_response(login_response_data(user, await aissue_token(user)))
@@ -1,6 +1,8 @@
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
 from rest_framework.exceptions import AuthenticationFailed
 
+from .token_cache import get_token_cache
+
 class BearerTokenAuthentication(TokenAuthentication):
     keyword = 'Bearer'
 
@@ -13,4 +15,47 @@ class BearerTokenAuthentication(TokenAuthentication):
         if not user.is_active:
             raise AuthenticationFailed('User inactive or deleted.')
 
-        return user, token
\ No newline at end of file
+        return user, token
+
+    def authenticate_credentials(self, key):
+        # Skip the token + user query for recently seen tokens
+        token_cache = get_token_cache()
+        auth = token_cache.get(key) if token_cache is not None else None
+        if auth is None:
+            auth = super().authenticate_credentials(key)
+            if token_cache is not None:
+                token_cache.set(key, *auth)
+        return auth
+
+    async def aauthenticate(self, request):
+        # Same as authenticate(), for native async views: the token is looked
+        # up with the async ORM instead of a blocking query
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed('Invalid token header.')
+
+        token_cache = get_token_cache()
+        cached = token_cache.get(key) if token_cache is not None else None
+        if cached is not None:
+            return cached
+
+        model = self.get_model()
+        try:
+            token = await model.objects.select_related('user').aget(key=key)
+        except model.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+
+        if not token.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+
+        if token_cache is not None:
+            token_cache.set(key, token.user, token)
+        return token.user, token
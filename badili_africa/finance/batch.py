@@ -0,0 +1,92 @@
+import json
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .activities import activity_for
+from .extraction import extract_receipt
+from .models import Expense
+
+# Shared by every batch request so the total number of concurrent
+# extractions stays bounded no matter how many batches are in flight
+executor = ThreadPoolExecutor(
+    max_workers=settings.RECEIPT_BATCH_CONCURRENCY,
+    thread_name_prefix="receipt-batch"
+)
+
+def _extract(file):
+    try:
+        return extract_receipt(file)
+    finally:
+        close_old_connections()
+
+def _line(data):
+    return json.dumps(data) + "\n"
+
+def build_expense(file, receipt_data, project, activity, user):
+    # Turn an extraction result into an unsaved Expense, or raise ValueError.
+    # `activity` is the project's Activity or None.
+    try:
+        amount = Decimal(str(receipt_data['amount'])).quantize(Decimal('0.01'))
+    except (KeyError, TypeError, InvalidOperation):
+        raise ValueError("Extraction result has no usable amount.")
+
+    return Expense(
+        project_id=project,
+        project_name=project.name,
+        activity_ref=activity,
+        activity=activity.name if activity is not None else '',
+        amount=amount,
+        description=str(receipt_data.get('description', '')),
+        receipt=file,
+        project_officer_id=user,
+        project_officer=user.first_name
+    )
+
+def stream_batch_extraction(files, errors, project=None, activity='', user=None):
+    # Yield one NDJSON line per receipt as soon as its extraction finishes.
+    # `errors` maps file index to a validation error found before extraction.
+    # When `project` is given, each successful receipt is saved as an Expense
+    # before its line is sent, so a client that disconnects mid-batch keeps
+    # every expense it was told about. Saving goes through the model signals,
+    # which keep rollups, the sync feed, derivatives and fingerprints current.
+    for index, error in errors.items():
+        yield _line({"index": index, "filename": files[index].name, "status": "error", "error": error})
+
+    if project is not None:
+        activity = activity_for(project, activity)
+
+    # Each extraction runs in a copy of this context so the request metrics
+    # still see its provider time
+    futures = {
+        executor.submit(copy_context().run, _extract, file): index
+        for index, file in enumerate(files)
+        if index not in errors
+    }
+
+    created = []
+    for future in as_completed(futures):
+        index = futures[future]
+        file = files[index]
+        line = {"index": index, "filename": file.name}
+        try:
+            receipt_data = future.result()
+            if project is not None:
+                expense = build_expense(file, receipt_data, project, activity, user)
+                expense.save()
+                created.append(expense.pk)
+                line["expense_id"] = expense.pk
+            line.update(status="ok", result=receipt_data)
+        except Exception as e:
+            line.update(status="error", error=str(e))
+        yield _line(line)
+
+    if project is not None:
+        yield _line({
+            "status": "done",
+            "expenses_created": len(created),
+            "expense_ids": created
+        })
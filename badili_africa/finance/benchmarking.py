@@ -0,0 +1,242 @@
+import io
+import json
+import random
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from .caching import expenses_changed
+from .imaging import Image
+from .activities import link_activities
+from .models import Activity, Expense, Project, User
+from .rollups import rebuild
+from .sync import EXPENSE, PROJECT, record_changes
+
+# Seeding and measurement helpers shared by the seed_benchmark_data,
+# benchmark_api and loadtest commands
+
+BENCHMARK_PASSWORD = 'benchmark-password'
+ACTIVITIES = ['Fuel', 'Transport', 'Meals', 'Accommodation', 'Materials', 'Training', 'Printing', 'Airtime']
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(latencies, elapsed, failures=0, queries=None):
+    # Latencies in milliseconds; `queries` holds the query count per request
+    summary = {
+        'ok': len(latencies),
+        'failed': failures,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'mean': round(statistics.mean(latencies), 2),
+        'p50': round(percentile(latencies, 50), 2),
+        'p95': round(percentile(latencies, 95), 2),
+        'p99': round(percentile(latencies, 99), 2),
+    }
+    if queries:
+        summary['queries'] = round(statistics.mean(queries), 2)
+    return summary
+
+def seed(users=50, projects=1000, expenses=100000, chunk_size=5000, random_seed=0, log=None):
+    # Bulk-create a reproducible dataset and return what a load generator
+    # needs to use it: usernames, the shared password, tokens and project ids
+    rng = random.Random(random_seed)
+    password = make_password(BENCHMARK_PASSWORD)  # hashing once keeps seeding fast
+
+    created_users = User.objects.bulk_create([
+        User(username=f'benchmark-{random_seed}-{i}', first_name=f'Officer {i}', password=password)
+        for i in range(users)
+    ])
+    tokens = Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in created_users])
+    created_projects = Project.objects.bulk_create([
+        Project(
+            name=f'Benchmark project {random_seed}-{i}',
+            description='Seeded for benchmarking'
+        )
+        for i in range(projects)
+    ])
+    Activity.objects.bulk_create([
+        Activity(project=project, name=name)
+        for project in created_projects
+        for name in rng.sample(ACTIVITIES, 3)
+    ])
+    record_changes(PROJECT, [(project.pk, project.pk) for project in created_projects])
+
+    written = 0
+    while written < expenses:
+        batch = []
+        for i in range(written, min(expenses, written + chunk_size)):
+            project = rng.choice(created_projects)
+            user = rng.choice(created_users)
+            batch.append(Expense(
+                project_id=project,
+                project_name=project.name,
+                activity=rng.choice(ACTIVITIES),
+                amount=f'{rng.randint(1, 50000)}.{rng.randint(0, 99):02d}',
+                description=f'Benchmark expense {i}',
+                project_officer_id=user,
+                project_officer=user.first_name
+            ))
+        created = Expense.objects.bulk_create(link_activities(batch))
+        record_changes(EXPENSE, [(expense.pk, expense.project_id_id) for expense in created])
+        written += len(batch)
+        if log:
+            log(f'{written}/{expenses} expenses')
+
+    project_ids = [project.pk for project in created_projects]
+    rebuild(project_ids)
+    expenses_changed(project_ids)
+    return {
+        'usernames': [user.username for user in created_users],
+        'password': BENCHMARK_PASSWORD,
+        'tokens': [token.key for token in tokens],
+        'project_ids': project_ids,
+        'project_names': [project.name for project in created_projects],
+    }
+
+def receipt_bytes(index):
+    # A distinct small JPEG per index, so the extraction cache never answers
+    if Image is None:
+        return b'\xff\xd8\xff\xe0' + index.to_bytes(8, 'big') + b'\x00' * 512
+    image = Image.new('RGB', (64, 64), ((index * 7) % 256, (index // 256) % 256, index % 256))
+    output = io.BytesIO()
+    image.save(output, 'JPEG')
+    return output.getvalue()
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    # Answers chat completions with a fixed receipt after `latency` seconds
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.latency)
+        content = json.dumps({'amount': 1250.0, 'description': 'Fuel for field visit'})
+        body = json.dumps({'choices': [{'message': {'content': f'```json\n{content}\n```'}}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubProvider:
+    # Local stand-in for the model API, run on a background thread
+    def __init__(self, latency=0.05):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubProviderHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Each scenario makes one request with the Django test client. `data` is the
+# seed() manifest and `i` the iteration number.
+
+def _auth(data, i):
+    return {'HTTP_AUTHORIZATION': f"Bearer {data['tokens'][i % len(data['tokens'])]}"}
+
+def _receipt(name, i):
+    return SimpleUploadedFile(name, receipt_bytes(i), content_type='image/jpeg')
+
+def login(client, data, i):
+    return client.post('/api/login/', {
+        'username': data['usernames'][i % len(data['usernames'])],
+        'password': data['password'],
+    })
+
+def list_expenses(client, data, i):
+    return client.get('/api/expenses/', **_auth(data, i))
+
+def project_expenses(client, data, i):
+    project_id = data['project_ids'][i % len(data['project_ids'])]
+    return client.get(f'/api/projects/{project_id}/expenses/', **_auth(data, i))
+
+def search_expenses(client, data, i):
+    return client.get('/api/expenses/search/', {'q': ACTIVITIES[i % len(ACTIVITIES)]}, **_auth(data, i))
+
+def sync_changes(client, data, i):
+    # A first sync of one project, one full page of changes
+    project_id = data['project_ids'][i % len(data['project_ids'])]
+    return client.get('/api/sync/', {'project_id': project_id}, HTTP_ACCEPT_ENCODING='gzip', **_auth(data, i))
+
+def create_expense(client, data, i):
+    return client.post('/api/expenses/', {
+        'project_name': data['project_names'][i % len(data['project_names'])],
+        'activity': ACTIVITIES[i % len(ACTIVITIES)],
+        'amount': '150.00',
+        'description': f'Benchmark upload {i}',
+        'receipt': _receipt(f'receipt-{i}.jpg', i),
+    }, **_auth(data, i))
+
+def extract_receipt(client, data, i):
+    return client.post('/api/file/', {'receipt': _receipt(f'extract-{i}.jpg', 10 ** 6 + i)}, **_auth(data, i))
+
+SCENARIOS = {
+    'login': login,
+    'list-expenses': list_expenses,
+    'project-expenses': project_expenses,
+    'search': search_expenses,
+    'sync': sync_changes,
+    'create-expense': create_expense,
+    'extract': extract_receipt,
+}
+
+def run_scenario(client, scenario, data, iterations, warmup=5):
+    # Sequential requests; latency and query counts are per request
+    for i in range(warmup):
+        SCENARIOS[scenario](client, data, i)
+
+    latencies, queries, failures = [], [], 0
+    started = time.perf_counter()
+    for i in range(warmup, warmup + iterations):
+        request_started = time.perf_counter()
+        with CaptureQueriesContext(connection) as captured:
+            response = SCENARIOS[scenario](client, data, i)
+        elapsed = (time.perf_counter() - request_started) * 1000
+        if response.status_code >= 400:
+            failures += 1
+            continue
+        latencies.append(elapsed)
+        queries.append(len(captured))
+    if not latencies:
+        raise RuntimeError(f"Every {scenario} request failed")
+    return summarize(latencies, time.perf_counter() - started, failures, queries)
+
+def compare(baseline, current, max_regression=10):
+    # Rows of (scenario, metric, baseline, current, change %, regressed) for
+    # every scenario in both runs. p95 may grow by `max_regression` percent,
+    # query counts may not grow at all.
+    rows = []
+    for scenario in sorted(set(baseline) & set(current)):
+        for metric in ('p50', 'p95', 'p99', 'rps', 'queries'):
+            before, after = baseline[scenario].get(metric), current[scenario].get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0
+            if metric == 'p95':
+                regressed = change > max_regression
+            elif metric == 'queries':
+                regressed = after > before
+            else:
+                regressed = False
+            rows.append((scenario, metric, before, after, round(change, 1), regressed))
+    return rows
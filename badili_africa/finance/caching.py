@@ -0,0 +1,83 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .models import Project
+
+# Conditional GET and a server-side response cache for the polled list
+# endpoints. Each list has a version read from the database in one small
+# query: the project list uses the project count and newest updated_at, a
+# project's expenses use its expenses_version counter, which every expense
+# write bumps. The ETag is that version plus a hash of the request URL, and
+# cached bodies are keyed by the ETag, so a write makes both stale at once
+# without deleting anything.
+#
+# Expense bodies embed receipt URLs, which expire after RECEIPT_URL_EXPIRY
+# when they are signed. Their ETag therefore also names the current half of
+# that lifetime, so no copy, cached or revalidated, hands out links with
+# less than half their lifetime left.
+
+RESPONSE_CACHE_KEY = 'finance:response:{}'
+
+def expenses_changed(project_ids):
+    # Called from every path that writes expenses
+    if project_ids:
+        Project.objects.filter(pk__in=project_ids).update(
+            expenses_version=F('expenses_version') + 1,
+            expenses_updated_at=timezone.now()
+        )
+
+def project_list_version():
+    stats = Project.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+    updated_at = stats['updated_at']
+    return f"{stats['count']}-{updated_at.timestamp() if updated_at else 0}", updated_at
+
+def project_expenses_version(project_id):
+    # None when the project does not exist
+    row = Project.objects.filter(pk=project_id).values_list('expenses_version', 'expenses_updated_at').first()
+    if row is None:
+        return None, None
+    version, updated_at = row
+    return f"{version}-{updated_at.timestamp()}", updated_at
+
+def signed_url_period():
+    # Seconds a body with signed receipt URLs may be reused, None if the URLs
+    # never expire
+    if not (settings.RECEIPT_SIGNED_URLS or settings.RECEIPT_STORAGE == 's3'):
+        return None
+    return max(settings.RECEIPT_URL_EXPIRY // 2, 1)
+
+def cached_list(request, scope, version, updated_at, build, signed_urls=False):
+    # Returns (data, headers); data is None when the client's copy is current
+    # and the caller should answer 304 Not Modified. `signed_urls` marks
+    # bodies with receipt URLs.
+    url = hashlib.sha256(request.build_absolute_uri().encode()).hexdigest()[:16]
+    last_modified = int(updated_at.timestamp()) if updated_at is not None else None
+    period = signed_url_period() if signed_urls else None
+    if period:
+        bucket = int(time.time() // period)
+        version = f"{version}-{bucket}"
+        last_modified = max(last_modified or 0, bucket * period)
+    etag = f'"{scope}-{version}-{url}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if get_conditional_response(request, etag=etag, last_modified=last_modified) is not None:
+        return None, headers
+
+    if not settings.RESPONSE_CACHE_TIMEOUT:
+        return build(), headers
+
+    key = RESPONSE_CACHE_KEY.format(etag)
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, settings.RESPONSE_CACHE_TIMEOUT)
+    return data, headers
@@ -0,0 +1,219 @@
+import asyncio
+import importlib.util
+import threading
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+
+from .metrics import record_provider_call
+
+# HTTP/2 needs the optional `h2` package; fall back to HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Stops calling a failing provider for `reset_timeout` seconds after
+    # `failure_threshold` consecutive failures, then lets a single trial call
+    # through to decide whether to close again. A trial that never reports
+    # back gives way to another one after `reset_timeout`.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            # While half-open, opened_at is when the trial call started
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return
+            raise CircuitOpenError("Receipt extraction provider is unavailable, try again later.")
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_cancelled(self):
+        # A call cancelled before the provider answered (a hedge that lost,
+        # a client that went away) says nothing about the provider, so the
+        # next call becomes the trial instead
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+
+def is_provider_failure(response):
+    # Rate limiting and server errors count against the breaker, while other
+    # client errors mean the provider is up but rejected our request
+    return response.status_code == 429 or response.status_code >= 500
+
+def provider_outcome(response):
+    # Label for the provider latency histogram
+    return 'failure' if is_provider_failure(response) else 'ok'
+
+
+class ProviderClient:
+    # Shared keep-alive HTTP client for the model provider with both blocking
+    # and awaitable entry points. Connections are pooled per process (and per
+    # event loop for the async client), so receipts after the first skip the
+    # TCP and TLS handshakes.
+    def __init__(self, base_url, headers=None, timeout=60, connect_timeout=5,
+                 max_connections=20, retries=1, breaker=None):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    base_url=self.base_url,
+                    headers=self.headers,
+                    timeout=self.timeout,
+                    transport=httpx.HTTPTransport(http2=HTTP2_AVAILABLE, limits=self.limits, retries=self.retries)
+                )
+            return self._client
+
+    def async_client(self):
+        # An async connection pool cannot be shared between event loops
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    headers=self.headers,
+                    timeout=self.timeout,
+                    transport=httpx.AsyncHTTPTransport(http2=HTTP2_AVAILABLE, limits=self.limits, retries=self.retries)
+                )
+                self._async_clients[loop] = client
+            return client
+
+    def _request_kwargs(self, body):
+        # File-like bodies are streamed; an explicit Content-Length stops
+        # httpx from falling back to chunked transfer encoding
+        if hasattr(body, 'read'):
+            return {
+                'content': body,
+                'headers': {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+            }
+        return {'json': body}
+
+    def _handle(self, response):
+        if is_provider_failure(response):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        try:
+            return response.json()
+        except ValueError:
+            raise Exception(f"Provider returned HTTP {response.status_code} without a JSON body")
+
+    def post_json(self, path, body):
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            response = self.client.post(path, **self._request_kwargs(body))
+        except Exception:
+            record_provider_call(time.perf_counter() - started, 'error')
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.record_cancelled()
+            raise
+        record_provider_call(time.perf_counter() - started, provider_outcome(response))
+        return self._handle(response)
+
+    async def apost_json(self, path, body):
+        self.breaker.before_call()
+        kwargs = self._request_kwargs(body)
+        if 'content' in kwargs:
+            kwargs['content'] = aiter_body(kwargs['content'])
+        started = time.perf_counter()
+        try:
+            response = await self.async_client().post(path, **kwargs)
+        except Exception:
+            record_provider_call(time.perf_counter() - started, 'error')
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.record_cancelled()
+            raise
+        record_provider_call(time.perf_counter() - started, provider_outcome(response))
+        return self._handle(response)
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+async def aiter_body(body):
+    # Read a blocking file-like body on a worker thread, chunk by chunk
+    while True:
+        data = await asyncio.to_thread(body.read, 256 * 1024)
+        if not data:
+            break
+        yield data
+
+
+_provider_client = None
+_provider_client_lock = threading.Lock()
+
+def get_provider_client():
+    global _provider_client
+    with _provider_client_lock:
+        if _provider_client is None:
+            _provider_client = ProviderClient(
+                settings.RECEIPT_PROVIDER_URL,
+                headers={"Authorization": f"Bearer {settings.OPENAI_API_KEY}"},
+                timeout=settings.RECEIPT_EXTRACTION_TIMEOUT,
+                connect_timeout=settings.RECEIPT_PROVIDER_CONNECT_TIMEOUT,
+                max_connections=settings.RECEIPT_PROVIDER_MAX_CONNECTIONS,
+                breaker=CircuitBreaker(
+                    failure_threshold=settings.RECEIPT_PROVIDER_FAILURE_THRESHOLD,
+                    reset_timeout=settings.RECEIPT_PROVIDER_RESET_TIMEOUT
+                )
+            )
+        return _provider_client
+
+def reset_provider_client():
+    # Drop the shared client so the next call picks up changed settings
+    global _provider_client
+    with _provider_client_lock:
+        if _provider_client is not None:
+            _provider_client.close()
+        _provider_client = None
@@ -0,0 +1,111 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, OuterRef, Q, Subquery
+
+from .caching import expenses_changed
+from .models import Expense, Project, User
+from .rollups import invalidate_summaries
+from .sync import EXPENSE, record_changes
+
+logger = logging.getLogger(__name__)
+
+# Expense keeps copies of its project's name and its officer's first name so
+# listings need no joins. Each copy maps to the foreign key on Expense, the
+# model it points at and the field copied from there. Renames are pushed to
+# the copies in the background by propagate(); verify() finds and repairs
+# anything that drifted anyway (queryset updates, failed propagations).
+COPIES = {
+    'project_name': ('project_id', Project, 'name'),
+    'project_officer': ('project_officer_id', User, 'first_name'),
+}
+
+# One worker, so renames of the same row are applied in order
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="denormalization")
+
+def source_value(field, source_id):
+    foreign_key, model, source_field = COPIES[field]
+    return model.objects.filter(pk=source_id).values_list(source_field, flat=True).first()
+
+def propagate(field, source_id, batch_size=None):
+    # Rewrite `field` on the expenses of one project or user in keyset
+    # batches along the (foreign key, created_at, id) index. Every batch is
+    # its own short UPDATE by primary key, so a large rename never locks many
+    # rows at once. The current value is re-read for every batch, so a rename
+    # made meanwhile wins. Returns the number of rows changed.
+    foreign_key, model, source_field = COPIES[field]
+    batch_size = batch_size or settings.DENORMALIZATION_BATCH_SIZE
+    expenses = Expense.objects.filter(**{foreign_key: source_id}).order_by('created_at', 'pk')
+
+    updated = 0
+    project_ids = set()
+    last = None
+    while True:
+        value = source_value(field, source_id)
+        if value is None:
+            break  # the source was deleted along with its expenses
+
+        batch = expenses
+        if last is not None:
+            batch = batch.filter(Q(created_at__gt=last[0]) | Q(created_at=last[0], pk__gt=last[1]))
+        rows = list(batch.values_list('created_at', 'pk', 'project_id', field)[:batch_size])
+        if not rows:
+            break
+        last = rows[-1][:2]
+
+        stale = [row for row in rows if row[3] != value]
+        if stale:
+            with transaction.atomic():
+                updated += Expense.objects.filter(pk__in=[row[1] for row in stale]).update(**{field: value})
+                record_changes(EXPENSE, [(row[1], row[2]) for row in stale])
+            project_ids.update(row[2] for row in stale)
+        if len(rows) < batch_size:
+            break
+        if settings.DENORMALIZATION_BATCH_PAUSE:
+            time.sleep(settings.DENORMALIZATION_BATCH_PAUSE)
+
+    if project_ids:
+        invalidate_summaries(project_ids)
+        expenses_changed(project_ids)
+    return updated
+
+def _propagate_in_background(field, source_id):
+    try:
+        propagate(field, source_id)
+    except Exception:
+        # The verifier command repairs whatever was left behind
+        logger.exception("Could not propagate %s for %s", field, source_id)
+    finally:
+        close_old_connections()
+
+def schedule_propagation(field, source_id):
+    transaction.on_commit(lambda: executor.submit(_propagate_in_background, field, source_id))
+
+def verify(start, end, fields=None, fix=False):
+    # Count (and with `fix`, repair) expenses with primary keys in
+    # [start, end) whose copies differ from their source. Returns
+    # {field: rows}.
+    drift = {}
+    for field in fields or COPIES:
+        foreign_key, model, source_field = COPIES[field]
+        rows = Expense.objects.filter(pk__gte=start, pk__lt=end).exclude(
+            **{field: F(f'{foreign_key}__{source_field}')}
+        )
+        if not fix:
+            drift[field] = rows.count()
+            continue
+
+        with transaction.atomic():
+            changed = list(rows.values_list('pk', 'project_id'))
+            drift[field] = rows.update(**{
+                field: Subquery(model.objects.filter(pk=OuterRef(foreign_key)).values(source_field)[:1])
+            })
+            record_changes(EXPENSE, changed)
+        project_ids = {project_id for _, project_id in changed}
+        if project_ids:
+            invalidate_summaries(project_ids)
+            expenses_changed(project_ids)
+    return drift
@@ -0,0 +1,85 @@
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.urls import reverse
+
+from .caching import expenses_changed
+from .imaging import DERIVATIVES, render_derivatives
+from .models import Expense
+from .storage import receipt_storage
+
+logger = logging.getLogger(__name__)
+
+# Thumbnails are rendered off the request thread after the expense is saved
+executor = ThreadPoolExecutor(
+    max_workers=settings.RECEIPT_DERIVATIVE_WORKERS,
+    thread_name_prefix="receipt-derivatives"
+)
+
+# Receipt extensions derivatives can be made from
+RENDERABLE_EXTENSIONS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.pdf': 'pdf'}
+
+def derivative_name(receipt_name, kind):
+    # Stored beside the original: receipts/ab/<sha>.jpg -> receipts/ab/<sha>.thumb.webp
+    return posixpath.splitext(receipt_name)[0] + DERIVATIVES[kind][1]
+
+def applicable_kinds(receipt_name):
+    file_type = RENDERABLE_EXTENSIONS.get(posixpath.splitext(receipt_name)[1].lower())
+    return [kind for kind, spec in DERIVATIVES.items() if file_type in spec[3]]
+
+def generate_derivatives(receipt_name, kinds=None):
+    # Store any missing derivatives of a receipt and record them on every
+    # expense using it (identical receipts are shared). Returns the kinds
+    # that now exist.
+    storage = receipt_storage()
+    kinds = kinds or applicable_kinds(receipt_name)
+    existing = [kind for kind in kinds if storage.exists(derivative_name(receipt_name, kind))]
+    missing = [kind for kind in kinds if kind not in existing]
+
+    if missing:
+        with storage.open(receipt_name, 'rb') as receipt:
+            rendered = render_derivatives(receipt, missing)
+        for kind, content in rendered.items():
+            with content:
+                storage.save_derivative(derivative_name(receipt_name, kind), content)
+        existing += list(rendered)
+
+    if existing:
+        # Merge rather than overwrite, other kinds may have been added meanwhile
+        changed_projects = set()
+        for expense in Expense.objects.filter(receipt=receipt_name).only('pk', 'project_id', 'receipt_derivatives'):
+            kinds_stored = sorted(set(expense.receipt_derivatives) | set(existing))
+            if kinds_stored != expense.receipt_derivatives:
+                Expense.objects.filter(pk=expense.pk).update(receipt_derivatives=kinds_stored)
+                changed_projects.add(expense.project_id_id)
+        # Listings now link to the stored files
+        expenses_changed(changed_projects)
+    return existing
+
+def _generate_in_background(receipt_name):
+    try:
+        generate_derivatives(receipt_name)
+    except Exception as e:
+        logger.warning("Could not generate derivatives for %s: %s", receipt_name, e)
+    finally:
+        close_old_connections()
+
+def schedule_derivatives(receipt_name):
+    # Render once the expense is committed; anything that fails here is
+    # rendered on first request instead
+    if settings.RECEIPT_DERIVATIVES_ENABLED and receipt_name and applicable_kinds(receipt_name):
+        transaction.on_commit(lambda: executor.submit(_generate_in_background, receipt_name))
+
+def derivative_url(expense, kind, request=None):
+    # Storage URL of a stored derivative, else the endpoint that renders it
+    # on demand, or None when the receipt cannot have one
+    if not expense.receipt or kind not in applicable_kinds(expense.receipt.name):
+        return None
+    if kind in expense.receipt_derivatives:
+        url = receipt_storage().url(derivative_name(expense.receipt.name, kind))
+    else:
+        url = reverse('expense-receipt-derivative', args=[expense.pk, kind])
+    return request.build_absolute_uri(url) if request is not None else url
@@ -0,0 +1,77 @@
+import hashlib
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .extraction_cache import get_cached_result, store_result
+from .extractors import (
+    MAX_TOKENS, SYSTEM_PROMPT, USER_PROMPT, aextract_with_backends, as_receipt_file, extract_with_backends
+)
+from .imaging import prepare_receipt
+from .uploads import inspect_upload
+
+# Changes whenever the model, prompts or image preprocessing change, so cached
+# results from an older prompt are never served for a new one
+PROMPT_VERSION = hashlib.sha256(
+    json.dumps([
+        settings.RECEIPT_MODEL, SYSTEM_PROMPT, USER_PROMPT, MAX_TOKENS,
+        settings.RECEIPT_PREPROCESS_ENABLED, settings.RECEIPT_MAX_EDGE, settings.RECEIPT_JPEG_QUALITY
+    ]).encode('utf-8')
+).hexdigest()[:16]
+
+def _record_metrics(metrics, prepared):
+    if metrics is not None:
+        metrics.update(
+            original_bytes=prepared.original_bytes,
+            processed_bytes=prepared.processed_bytes,
+            preprocess_ms=prepared.duration_ms
+        )
+
+def extract_receipt(receipt, metrics=None):
+    # `metrics`, when given, is filled with the preprocessing byte counts
+    receipt = as_receipt_file(receipt)
+
+    # Serve repeat uploads of the same file from the extraction cache. Only
+    # an exact match is reused: receipts that merely look alike (the same
+    # vendor's layout, another photo) may have different totals.
+    file_hash = inspect_upload(receipt)['sha256']
+    receipt_data = get_cached_result(file_hash, PROMPT_VERSION)
+    if receipt_data is not None:
+        return receipt_data
+
+    prepared = prepare_receipt(receipt)
+    _record_metrics(metrics, prepared)
+
+    try:
+        receipt_data, extractor = extract_with_backends(prepared.file, prepared.mime_type, receipt)
+    finally:
+        if prepared.file is not receipt:
+            prepared.file.close()
+
+    # Fallback (offline) guesses are not cached, so the receipt is read by a
+    # model again once a provider is back
+    if not extractor.fallback:
+        store_result(file_hash, PROMPT_VERSION, receipt_data)
+    return receipt_data
+
+async def aextract_receipt(receipt, metrics=None):
+    # Same as extract_receipt, but hashing, database access and image work run
+    # on worker threads so the event loop only waits on the provider
+    receipt = as_receipt_file(receipt)
+
+    file_hash = (await sync_to_async(inspect_upload)(receipt))['sha256']
+    receipt_data = await sync_to_async(get_cached_result)(file_hash, PROMPT_VERSION)
+    if receipt_data is not None:
+        return receipt_data
+
+    prepared = await sync_to_async(prepare_receipt)(receipt)
+    _record_metrics(metrics, prepared)
+
+    try:
+        receipt_data, extractor = await aextract_with_backends(prepared.file, prepared.mime_type, receipt)
+    finally:
+        if prepared.file is not receipt:
+            prepared.file.close()
+
+    if not extractor.fallback:
+        await sync_to_async(store_result)(file_hash, PROMPT_VERSION, receipt_data)
+    return receipt_data
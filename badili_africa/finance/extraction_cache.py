@@ -0,0 +1,100 @@
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ExtractionCacheEntry
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = 'finance:extraction_cache:hits'
+MISSES_KEY = 'finance:extraction_cache:misses'
+
+def _count(key):
+    # Counters live in the Django cache so a shared backend aggregates them
+    # across workers; the default local-memory cache keeps them per process.
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+def _expiry_cutoff():
+    return timezone.now() - timedelta(seconds=settings.RECEIPT_CACHE_TTL)
+
+def get_cached_result(file_hash, prompt_version):
+    if not settings.RECEIPT_CACHE_ENABLED:
+        return None
+
+    entry = ExtractionCacheEntry.objects.filter(
+        file_hash=file_hash,
+        prompt_version=prompt_version,
+        created_at__gte=_expiry_cutoff()
+    ).only('pk', 'result').first()
+
+    if entry is None:
+        _count(MISSES_KEY)
+        return None
+
+    _count(HITS_KEY)
+    ExtractionCacheEntry.objects.filter(pk=entry.pk).update(
+        hits=F('hits') + 1,
+        last_used_at=timezone.now()
+    )
+    return entry.result
+
+def store_result(file_hash, prompt_version, result):
+    if not settings.RECEIPT_CACHE_ENABLED:
+        return
+
+    # A failed cache write must not fail an extraction that already succeeded
+    now = timezone.now()
+    try:
+        ExtractionCacheEntry.objects.update_or_create(
+            file_hash=file_hash,
+            prompt_version=prompt_version,
+            defaults={'result': result, 'created_at': now, 'last_used_at': now}
+        )
+        # Eviction scans the table, so only a sample of stores runs it;
+        # `evict_extraction_cache` does the same from a scheduler
+        if random.random() < settings.RECEIPT_CACHE_EVICT_PROBABILITY:
+            evict()
+    except DatabaseError as e:
+        logger.warning("Could not cache extraction result for %s: %s", file_hash, e)
+
+def evict():
+    # Drop expired entries, then the least recently used ones over the
+    # limit. Returns the number of entries removed.
+    expired, _ = ExtractionCacheEntry.objects.filter(created_at__lt=_expiry_cutoff()).delete()
+
+    overflow = list(
+        ExtractionCacheEntry.objects.order_by('-last_used_at')
+        .values_list('pk', flat=True)[settings.RECEIPT_CACHE_MAX_ENTRIES:]
+    )
+    if overflow:
+        ExtractionCacheEntry.objects.filter(pk__in=overflow).delete()
+    return expired + len(overflow)
+
+def invalidate(prompt_version=None):
+    # Remove every entry, or only those built from other prompt versions
+    entries = ExtractionCacheEntry.objects.all()
+    if prompt_version is not None:
+        entries = entries.exclude(prompt_version=prompt_version)
+    deleted, _ = entries.delete()
+    return deleted
+
+def cache_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / lookups, 4) if lookups else None,
+        'entries': ExtractionCacheEntry.objects.count(),
+    }
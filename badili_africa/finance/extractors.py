@@ -0,0 +1,463 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from decimal import Decimal, InvalidOperation
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.utils.module_loading import import_string
+
+from .clients import CircuitBreaker, ProviderClient, get_provider_client
+from .imaging import SPOOL_SIZE, pdfium
+from .metrics import record_extractor_call, record_handoff
+from .uploads import Base64JSONBody, inspect_upload
+
+logger = logging.getLogger(__name__)
+
+# Receipt extraction backends. RECEIPT_EXTRACTORS lists them in order of
+# preference; extract_with_backends() asks the first, hands the receipt to the
+# next one as well (a hedged request) when the first has not answered within
+# its recent p95 latency or has failed, and takes the first valid result.
+# Fallback backends, like the offline extractor, are only asked once every
+# other backend has failed.
+
+SYSTEM_PROMPT = "You are a system that processes receipts and extracts key details."
+USER_PROMPT = "Here is a receipt. Please extract the total amount and provide a brief description of the purchase. Return the result as a JSON object with 'amount' (as a number) and 'description' (as a string) fields."
+MAX_TOKENS = 300
+
+RECEIPT_PLACEHOLDER = "__RECEIPT_BASE64__"
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def as_receipt_file(receipt):
+    # Accept raw bytes as well as uploaded or stored files
+    if isinstance(receipt, (bytes, bytearray)):
+        return ContentFile(receipt, name='receipt')
+    if not isinstance(receipt, File):
+        return File(receipt)
+    return receipt
+
+def receipt_part(mime_type):
+    # Images go in as image_url; a PDF that could not be rasterized has to be
+    # sent as a file part, image_url only takes images
+    data_url = f"data:{mime_type};base64,{RECEIPT_PLACEHOLDER}"
+    if mime_type == 'application/pdf':
+        return {
+            "type": "file",
+            "file": {
+                "filename": "receipt.pdf",
+                "file_data": data_url
+            }
+        }
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": data_url
+        }
+    }
+
+def build_request_body(receipt, mime_type, model=None):
+    payload = {
+        "model": model or settings.RECEIPT_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": USER_PROMPT
+                    },
+                    receipt_part(mime_type)
+                ]
+            }
+        ],
+        "max_tokens": MAX_TOKENS
+    }
+
+    # Stream the receipt into the request body as base64 instead of building
+    # the encoded copy in memory
+    receipt.seek(0)
+    return Base64JSONBody(payload, RECEIPT_PLACEHOLDER, receipt, receipt.size)
+
+def parse_response(response_data):
+    if 'error' in response_data:
+        raise Exception(f"GPT API Error: {response_data['error']['message']}")
+
+    content = response_data['choices'][0]['message']['content']
+
+     # Extract JSON from the content
+    json_str = extract_json_from_markdown(content)
+
+    try:
+        # Parse the JSON string into a Python dictionary
+        receipt_data = json.loads(json_str)
+        return receipt_data
+    except json.JSONDecodeError:
+        raise Exception("Failed to parse GPT-4 response as JSON")
+
+def extract_json_from_markdown(content):
+    # Remove Markdown code block syntax
+    json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
+    if json_match:
+        return json_match.group(1)
+    else:
+        # If no code block is found, assume the entire content is JSON
+        return content.strip()
+
+def process_receipt_with_gpt(receipt, mime_type="image/jpeg", client=None, model=None):
+    body = build_request_body(as_receipt_file(receipt), mime_type, model)
+    response_data = (client or get_provider_client()).post_json("chat/completions", body)
+    return parse_response(response_data)
+
+async def aprocess_receipt_with_gpt(receipt, mime_type="image/jpeg", client=None, model=None):
+    body = build_request_body(as_receipt_file(receipt), mime_type, model)
+    response_data = await (client or get_provider_client()).apost_json("chat/completions", body)
+    return parse_response(response_data)
+
+def is_valid_result(result):
+    # A result is only taken if it has a usable amount
+    if not isinstance(result, dict):
+        return False
+    try:
+        return Decimal(str(result.get('amount'))).is_finite()
+    except (InvalidOperation, ValueError):
+        return False
+
+
+class BaseExtractor:
+    # `name` is the backend's key in RECEIPT_EXTRACTORS, `options` its entry.
+    # Fallback backends only run once every other backend has failed, and
+    # get the original upload instead of the preprocessed image.
+    fallback = False
+
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        # Recent successful call durations, for the hedge deadline
+        self.latencies = deque(maxlen=settings.RECEIPT_HEDGE_WINDOW)
+
+    def extract(self, receipt, mime_type):
+        raise NotImplementedError
+
+    async def aextract(self, receipt, mime_type):
+        return await sync_to_async(self.extract, thread_sensitive=False)(receipt, mime_type)
+
+    def hedge_deadline(self):
+        # Seconds to wait for this backend before also asking the next one:
+        # its RECEIPT_HEDGE_PERCENTILE latency once enough calls were timed
+        samples = sorted(self.latencies)
+        if len(samples) < settings.RECEIPT_HEDGE_MIN_SAMPLES:
+            return settings.RECEIPT_HEDGE_AFTER
+        return samples[min(len(samples) - 1, int(len(samples) * settings.RECEIPT_HEDGE_PERCENTILE / 100))]
+
+
+class ChatCompletionsExtractor(BaseExtractor):
+    # A vision model behind an OpenAI-compatible chat completions API.
+    # Without a URL, the shared client for RECEIPT_PROVIDER_URL is used.
+    def __init__(self, name, options):
+        super().__init__(name, options)
+        self.model = options.get('MODEL') or settings.RECEIPT_MODEL
+        self._client = None
+        if options.get('URL'):
+            api_key = options.get('API_KEY')
+            self._client = ProviderClient(
+                options['URL'],
+                headers={"Authorization": f"Bearer {api_key}"} if api_key else {},
+                timeout=settings.RECEIPT_EXTRACTION_TIMEOUT,
+                connect_timeout=settings.RECEIPT_PROVIDER_CONNECT_TIMEOUT,
+                max_connections=settings.RECEIPT_PROVIDER_MAX_CONNECTIONS,
+                breaker=CircuitBreaker(
+                    failure_threshold=settings.RECEIPT_PROVIDER_FAILURE_THRESHOLD,
+                    reset_timeout=settings.RECEIPT_PROVIDER_RESET_TIMEOUT
+                )
+            )
+
+    @property
+    def client(self):
+        return self._client or get_provider_client()
+
+    def extract(self, receipt, mime_type):
+        return process_receipt_with_gpt(receipt, mime_type, self.client, self.model)
+
+    async def aextract(self, receipt, mime_type):
+        return await aprocess_receipt_with_gpt(receipt, mime_type, self.client, self.model)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+
+
+# Lines naming the total, best first. Lines about tax, discounts or change
+# are never the total even when they say "total".
+TOTAL_LABELS = [
+    re.compile(r'grand\s*total', re.I),
+    re.compile(r'total\s*(amount|due|payable|paid)|amount\s*(due|payable|paid)|balance\s*due|net\s*payable', re.I),
+    re.compile(r'\btotal\b', re.I),
+]
+NOT_TOTAL = re.compile(r'sub\s*-?\s*total|tax|vat|discount|change|tendered|saving|items|qty|quantity', re.I)
+AMOUNT = re.compile(r'(?<![\d.])(\d{1,3}(?:,\d{3})+|\d+)(\.\d{1,2})?(?![\d])')
+
+def parse_amounts(line):
+    return [Decimal(whole.replace(',', '') + (fraction or '')) for whole, fraction in AMOUNT.findall(line)]
+
+def parse_total(text):
+    # The receipt total from its text, or None: the amount on (or right
+    # after) the best labelled total line, else the largest amount with cents
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    for label in TOTAL_LABELS:
+        candidates = []
+        for index, line in enumerate(lines):
+            match = label.search(line)
+            if match is None or NOT_TOTAL.search(line):
+                continue
+            amounts = parse_amounts(line[match.end():]) or (parse_amounts(lines[index + 1]) if index + 1 < len(lines) else [])
+            if amounts:
+                candidates.append(amounts[-1])
+        if candidates:
+            return max(candidates)
+    with_cents = [amount for line in lines for amount in parse_amounts(line) if amount != amount.to_integral_value() or '.' in line]
+    return max(with_cents) if with_cents else None
+
+def pdf_text(receipt, max_pages=3):
+    receipt.seek(0)
+    pdf = pdfium.PdfDocument(receipt)
+    try:
+        return '\n'.join(pdf[index].get_textpage().get_text_range() for index in range(min(len(pdf), max_pages)))
+    finally:
+        pdf.close()
+        receipt.seek(0)
+
+
+class OfflineExtractor(BaseExtractor):
+    # Reads the total from the text layer of PDF receipts without any network
+    # call, so extraction keeps working while every provider is down.
+    # Photos have no text layer and still fail.
+    fallback = True
+
+    def extract(self, receipt, mime_type):
+        if pdfium is None or inspect_upload(receipt)['file_type'] != 'pdf':
+            raise ExtractionError("Offline extraction only reads PDF receipts with a text layer.")
+        text = pdf_text(receipt)
+        amount = parse_total(text)
+        if amount is None:
+            raise ExtractionError("No total found in the receipt text.")
+        merchant = next((line.strip() for line in text.splitlines() if re.search(r'[A-Za-z]{3}', line)), '')
+        return {'amount': float(amount), 'description': merchant[:100]}
+
+
+_extractors = None
+_extractors_lock = threading.Lock()
+
+def get_extractors():
+    global _extractors
+    with _extractors_lock:
+        if _extractors is None:
+            _extractors = [
+                import_string(options['BACKEND'])(name, options)
+                for name, options in settings.RECEIPT_EXTRACTORS.items()
+            ]
+        return _extractors
+
+def reset_extractors():
+    # Rebuild the backends from settings on next use
+    global _extractors
+    with _extractors_lock:
+        for extractor in _extractors or []:
+            if hasattr(extractor, 'close'):
+                extractor.close()
+        _extractors = None
+
+# Hedged calls of the blocking entry point run here; a slow backend that lost
+# the race keeps its worker until it answers or times out
+executor = ThreadPoolExecutor(max_workers=settings.RECEIPT_HEDGE_WORKERS, thread_name_prefix="extractors")
+
+def _finish(extractor, started, result):
+    seconds = time.perf_counter() - started
+    if not is_valid_result(result):
+        record_extractor_call(extractor.name, seconds, 'invalid')
+        raise ExtractionError(f"{extractor.name} returned no usable amount.")
+    record_extractor_call(extractor.name, seconds, 'ok')
+    extractor.latencies.append(seconds)
+    return result
+
+def call_extractor(extractor, receipt, mime_type):
+    started = time.perf_counter()
+    try:
+        result = extractor.extract(receipt, mime_type)
+    except Exception:
+        record_extractor_call(extractor.name, time.perf_counter() - started, 'error')
+        raise
+    return _finish(extractor, started, result)
+
+async def acall_extractor(extractor, receipt, mime_type):
+    started = time.perf_counter()
+    try:
+        result = await extractor.aextract(receipt, mime_type)
+    except asyncio.CancelledError:
+        record_extractor_call(extractor.name, time.perf_counter() - started, 'cancelled')
+        raise
+    except Exception:
+        record_extractor_call(extractor.name, time.perf_counter() - started, 'error')
+        raise
+    return _finish(extractor, started, result)
+
+def receipt_path(receipt):
+    # Path of a receipt that is already a file on disk, or None
+    if hasattr(receipt, 'temporary_file_path'):
+        return receipt.temporary_file_path()
+    name = getattr(getattr(receipt, 'file', None), 'name', None)
+    return name if isinstance(name, str) and os.path.isfile(name) else None
+
+
+class ReceiptCopies:
+    # Backends racing each other each need their own file position. Calling
+    # this gives one backend its copy, to use in a `with` block. Receipts on
+    # disk are reopened, small ones copied in memory, and larger ones spooled
+    # to a temporary file once, so memory use stays bounded.
+    def __init__(self, receipt, count):
+        self.receipt = receipt
+        self.name = receipt.name or 'receipt'
+        self.content = self.path = self.spooled = None
+        if count < 2:
+            return
+        self.path = receipt_path(receipt)
+        if self.path is not None:
+            return
+        if receipt.size is not None and receipt.size <= SPOOL_SIZE:
+            receipt.seek(0)
+            self.content = receipt.read()
+        else:
+            with tempfile.NamedTemporaryFile(prefix='receipt-', delete=False) as spooled:
+                for chunk in receipt.chunks():
+                    spooled.write(chunk)
+            self.path = self.spooled = spooled.name
+        receipt.seek(0)
+
+    def __call__(self):
+        if self.path is not None:
+            return File(open(self.path, 'rb'), name=self.name)
+        if self.content is not None:
+            return ContentFile(self.content, name=self.name)
+        # The only backend asked reads the receipt itself and must not close it
+        return nullcontext(self.receipt)
+
+    def close(self):
+        # Open copies keep reading a removed spool file until they close it
+        if self.spooled is not None:
+            os.unlink(self.spooled)
+            self.spooled = None
+
+def call_with_copy(extractor, copy, mime_type):
+    with copy as receipt:
+        return call_extractor(extractor, receipt, mime_type)
+
+async def acall_with_copy(extractor, copy, mime_type):
+    with copy as receipt:
+        return await acall_extractor(extractor, receipt, mime_type)
+
+def split_backends():
+    extractors = get_extractors()
+    return [e for e in extractors if not e.fallback], [e for e in extractors if e.fallback]
+
+def extract_with_backends(receipt, mime_type, original=None):
+    # First valid result for the (preprocessed) receipt. Fallback backends
+    # read `original`, the receipt as uploaded. Returns (result, extractor).
+    providers, fallbacks = split_backends()
+    copies = ReceiptCopies(receipt, len(providers))
+    errors = []
+    pending = {}
+
+    def launch():
+        extractor = providers.pop(0)
+        pending[executor.submit(copy_context().run, call_with_copy, extractor, copies(), mime_type)] = extractor
+        return time.monotonic() + extractor.hedge_deadline()
+
+    try:
+        deadline = launch() if providers else None
+        while pending:
+            timeout = max(deadline - time.monotonic(), 0) if providers else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Too slow: ask the next backend too, keep waiting for both
+                record_handoff(providers[0].name, 'slow')
+                deadline = launch()
+                continue
+            for future in done:
+                extractor = pending.pop(future)
+                try:
+                    return future.result(), extractor
+                except Exception as e:
+                    logger.warning("Extractor %s failed: %s", extractor.name, e)
+                    errors.append(e)
+            if not pending and providers:
+                record_handoff(providers[0].name, 'failed')
+                deadline = launch()
+    finally:
+        copies.close()
+
+    return run_fallbacks(fallbacks, original or receipt, errors)
+
+def run_fallbacks(fallbacks, original, errors):
+    for extractor in fallbacks:
+        record_handoff(extractor.name, 'fallback')
+        try:
+            return call_extractor(extractor, original, inspect_upload(original)['file_type']), extractor
+        except Exception as e:
+            logger.warning("Extractor %s failed: %s", extractor.name, e)
+    raise errors[0] if errors else ExtractionError("No receipt extractor is configured.")
+
+async def aextract_with_backends(receipt, mime_type, original=None):
+    # extract_with_backends() for the event loop; losing requests are cancelled
+    providers, fallbacks = split_backends()
+    copies = await sync_to_async(ReceiptCopies)(receipt, len(providers))
+    errors = []
+    pending = {}
+
+    def launch():
+        extractor = providers.pop(0)
+        pending[asyncio.ensure_future(acall_with_copy(extractor, copies(), mime_type))] = extractor
+        return time.monotonic() + extractor.hedge_deadline()
+
+    deadline = launch() if providers else None
+    try:
+        while pending:
+            timeout = max(deadline - time.monotonic(), 0) if providers else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                record_handoff(providers[0].name, 'slow')
+                deadline = launch()
+                continue
+            for task in done:
+                extractor = pending.pop(task)
+                try:
+                    return task.result(), extractor
+                except Exception as e:
+                    logger.warning("Extractor %s failed: %s", extractor.name, e)
+                    errors.append(e)
+            if not pending and providers:
+                record_handoff(providers[0].name, 'failed')
+                deadline = launch()
+    finally:
+        for task in pending:
+            task.cancel()
+        copies.close()
+
+    return await sync_to_async(run_fallbacks, thread_sensitive=False)(fallbacks, original or receipt, errors)
@@ -0,0 +1,129 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+
+from .imaging import difference_hash
+from .models import Expense, ReceiptFingerprint
+from .storage import RECEIPT_KEY_PATTERN, receipt_storage
+from .uploads import inspect_upload
+
+logger = logging.getLogger(__name__)
+
+# Near-duplicate receipts: the same paper photographed twice gives two files
+# with different content hashes but almost the same perceptual hash. Every
+# uploaded or stored receipt gets a ReceiptFingerprint. Receipts within a
+# Hamming distance are found by multi-index hashing: the 64-bit hash is split
+# into four 16-bit bands, each indexed, and hashes at most d bits apart have
+# some band at most d // 4 bits apart. So each band is looked up together
+# with every value that close to it (an IN list on its index), and only the
+# few candidates found are compared in full.
+
+BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+HASH_MASK = (1 << 64) - 1
+
+# Fingerprints of expense receipts are taken off the request thread
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="receipt-fingerprints")
+
+def bands(dhash):
+    return [(dhash >> (BAND_BITS * i)) & BAND_MASK for i in range(BANDS)]
+
+def distance(a, b):
+    return ((a ^ b) & HASH_MASK).bit_count()
+
+def remember(file_hash, dhash, receipt=''):
+    signed = dhash - (1 << 64) if dhash >= 1 << 63 else dhash
+    defaults = {'dhash': signed, **{f'band_{i}': band for i, band in enumerate(bands(dhash))}}
+    if receipt:
+        defaults['receipt'] = receipt
+    try:
+        with transaction.atomic():
+            ReceiptFingerprint.objects.update_or_create(file_hash=file_hash, defaults=defaults)
+    except IntegrityError:
+        pass  # stored meanwhile by a concurrent upload of the same file
+
+def fingerprint(file):
+    # dHash of an uploaded or stored receipt, or None. Known files are looked
+    # up by content hash instead of being decoded again; new ones are stored.
+    # Cached on the file like inspect_upload's hash.
+    if not hasattr(file, 'dhash'):
+        file_hash = inspect_upload(file)['sha256']
+        stored = ReceiptFingerprint.objects.filter(file_hash=file_hash).values_list('dhash', flat=True).first()
+        if stored is not None:
+            file.dhash = stored & HASH_MASK
+        else:
+            file.dhash = difference_hash(file)
+            if file.dhash is not None:
+                remember(file_hash, file.dhash)
+    return file.dhash
+
+def band_neighbours(band, radius):
+    # Every 16-bit value within `radius` bits of `band`
+    values = {band}
+    for _ in range(radius):
+        values |= {value ^ (1 << bit) for value in values for bit in range(BAND_BITS)}
+    return values
+
+def similar(dhash, max_distance=None):
+    # [(distance, file_hash, receipt name)] of stored fingerprints within
+    # `max_distance` of `dhash`, closest first. Bands with every bit equal
+    # (blank margins) are common to many unrelated receipts, so they are not
+    # looked up; a receipt matching only on such bands is missed.
+    max_distance = settings.RECEIPT_DUPLICATE_DISTANCE if max_distance is None else max_distance
+    radius = max_distance // BANDS
+    lookups = [
+        Q(**{f'band_{i}__in': band_neighbours(band, radius)})
+        for i, band in enumerate(bands(dhash))
+        if band not in (0, BAND_MASK)
+    ]
+    if not lookups:
+        return []
+    candidates = ReceiptFingerprint.objects.filter(reduce(or_, lookups)).values_list('file_hash', 'dhash', 'receipt')
+    return sorted(
+        (distance(dhash, stored), file_hash, receipt)
+        for file_hash, stored, receipt in candidates
+        if distance(dhash, stored) <= max_distance
+    )
+
+def similar_receipts(file):
+    # Files that look like this upload, including identical ones
+    if not settings.RECEIPT_FINGERPRINTS_ENABLED:
+        return []
+    dhash = fingerprint(file)
+    return similar(dhash) if dhash is not None else []
+
+def possible_duplicates(file):
+    # Ids of expenses whose receipt looks like this upload, oldest first
+    names = [receipt for _, _, receipt in similar_receipts(file) if receipt]
+    if not names:
+        return []
+    return list(Expense.objects.filter(receipt__in=names).order_by('created_at', 'pk').values_list('pk', flat=True))
+
+def fingerprint_stored_receipt(receipt_name):
+    # Fingerprint a receipt saved on an expense and link it to its file
+    match = RECEIPT_KEY_PATTERN.match(receipt_name)
+    with receipt_storage().open(receipt_name, 'rb') as receipt:
+        file_hash = match.group(1) if match else inspect_upload(receipt)['sha256']
+        stored = ReceiptFingerprint.objects.filter(file_hash=file_hash).values_list('dhash', flat=True).first()
+        dhash = stored & HASH_MASK if stored is not None else difference_hash(receipt)
+    if dhash is not None:
+        remember(file_hash, dhash, receipt_name)
+    return dhash
+
+def _fingerprint_in_background(receipt_name):
+    try:
+        fingerprint_stored_receipt(receipt_name)
+    except Exception as e:
+        logger.warning("Could not fingerprint %s: %s", receipt_name, e)
+    finally:
+        close_old_connections()
+
+def schedule_fingerprint(receipt_name):
+    if settings.RECEIPT_FINGERPRINTS_ENABLED and receipt_name:
+        transaction.on_commit(lambda: executor.submit(_fingerprint_in_background, receipt_name))
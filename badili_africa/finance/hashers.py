@@ -0,0 +1,11 @@
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    # Django's PBKDF2 with the work factor taken from
+    # PASSWORD_PBKDF2_ITERATIONS (0 keeps Django's default). Hashes made with
+    # any other count are rewritten on the user's next successful login.
+    @property
+    def iterations(self):
+        return settings.PASSWORD_PBKDF2_ITERATIONS or hashers.PBKDF2PasswordHasher.iterations
@@ -0,0 +1,185 @@
+import logging
+import tempfile
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.files import File
+
+from .uploads import inspect_upload
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; receipts are then sent unchanged
+    Image = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # without pypdfium2 PDFs cannot be rasterized
+    pdfium = None
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+
+# Keep small preprocessed receipts in memory, spill larger ones to disk
+SPOOL_SIZE = 1024 * 1024
+
+PreparedReceipt = namedtuple(
+    'PreparedReceipt',
+    ['file', 'mime_type', 'original_bytes', 'processed_bytes', 'duration_ms']
+)
+
+def render_first_pdf_page(receipt, max_edge):
+    receipt.seek(0)
+    pdf = pdfium.PdfDocument(receipt)
+    try:
+        page = pdf[0]
+        width, height = page.get_size()
+        # PDF sizes are in points (1/72 inch); render straight at the target size
+        scale = min(max_edge / max(width, height), 300 / 72)
+        return page.render(scale=scale).to_pil()
+    finally:
+        pdf.close()
+
+def open_image(receipt, max_edge):
+    receipt.seek(0)
+    image = Image.open(receipt)
+    # Let the JPEG decoder downscale while decoding instead of loading every pixel
+    image.draft('RGB', (max_edge, max_edge))
+    return ImageOps.exif_transpose(image)
+
+def flatten(image):
+    # JPEG has no alpha channel, so put transparent receipts on white
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+def prepare_receipt(receipt):
+    # Normalize a receipt before extraction: rasterize PDFs, downscale large
+    # photos to RECEIPT_MAX_EDGE and recompress as JPEG
+    started = time.monotonic()
+    file_type = inspect_upload(receipt)['file_type']
+    original_bytes = receipt.size
+    max_edge = settings.RECEIPT_MAX_EDGE
+
+    def unchanged():
+        receipt.seek(0)
+        return PreparedReceipt(
+            receipt, MIME_TYPES.get(file_type, 'image/jpeg'), original_bytes, original_bytes,
+            int((time.monotonic() - started) * 1000)
+        )
+
+    if not settings.RECEIPT_PREPROCESS_ENABLED or Image is None:
+        return unchanged()
+
+    try:
+        if file_type == 'pdf':
+            if pdfium is None:
+                return unchanged()
+            image = render_first_pdf_page(receipt, max_edge)
+        elif file_type in ('jpeg', 'png'):
+            image = open_image(receipt, max_edge)
+            # Small JPEGs are already as compact as we would make them
+            if file_type == 'jpeg' and max(image.size) <= max_edge and original_bytes <= SPOOL_SIZE:
+                return unchanged()
+        else:
+            return unchanged()
+
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        flatten(image).save(output, format='JPEG', quality=settings.RECEIPT_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning("Could not preprocess receipt, sending it unchanged: %s", e)
+        return unchanged()
+
+    processed_bytes = output.tell()
+    if file_type != 'pdf' and processed_bytes >= original_bytes:
+        output.close()
+        return unchanged()
+
+    output.seek(0)
+    prepared = File(output, name='receipt.jpg')
+    prepared.size = processed_bytes
+    duration_ms = int((time.monotonic() - started) * 1000)
+    logger.info("Preprocessed %s receipt: %s -> %s bytes in %sms", file_type, original_bytes, processed_bytes, duration_ms)
+    return PreparedReceipt(prepared, 'image/jpeg', original_bytes, processed_bytes, duration_ms)
+
+# Derivative images shown instead of the original receipt: kind -> (Pillow
+# format, file suffix, size setting, receipt types it is made for)
+DERIVATIVES = {
+    'thumbnail': ('JPEG', '.thumb.jpg', 'RECEIPT_THUMBNAIL_EDGE', ('jpeg', 'png', 'pdf')),
+    'thumbnail_webp': ('WEBP', '.thumb.webp', 'RECEIPT_THUMBNAIL_EDGE', ('jpeg', 'png', 'pdf')),
+    'preview': ('JPEG', '.preview.jpg', 'RECEIPT_PREVIEW_EDGE', ('pdf',)),
+}
+
+def render_derivatives(receipt, kinds):
+    # Render the requested derivatives of a receipt as in-memory files,
+    # decoding the original (or its first PDF page) only once. Returns
+    # {kind: File}; kinds that do not apply to this receipt are left out.
+    if Image is None:
+        return {}
+
+    file_type = inspect_upload(receipt)['file_type']
+    kinds = [kind for kind in kinds if file_type in DERIVATIVES[kind][3]]
+    if not kinds or (file_type == 'pdf' and pdfium is None):
+        return {}
+
+    max_edge = max(getattr(settings, DERIVATIVES[kind][2]) for kind in kinds)
+    source = render_first_pdf_page(receipt, max_edge) if file_type == 'pdf' else open_image(receipt, max_edge)
+    source = flatten(source)
+
+    rendered = {}
+    for kind in kinds:
+        image_format, suffix, size_setting, _ = DERIVATIVES[kind]
+        edge = getattr(settings, size_setting)
+        image = source.copy()
+        image.thumbnail((edge, edge), Image.LANCZOS)
+        output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        image.save(output, format=image_format, quality=settings.RECEIPT_JPEG_QUALITY)
+        size = output.tell()
+        output.seek(0)
+        rendered[kind] = File(output, name=f'receipt{suffix}')
+        rendered[kind].size = size
+    return rendered
+
+# Perceptual hashes are taken from a tiny grayscale copy, so only decode this much
+HASH_DECODE_EDGE = 256
+# Brightness steps smaller than this count as flat, so paper texture and
+# compression noise in blank areas do not flip bits
+HASH_MIN_STEP = 8
+
+def difference_hash(receipt):
+    # 64-bit dHash of a receipt (or its first PDF page): one bit per pair of
+    # horizontally adjacent pixels of a 9x8 grayscale copy, set where
+    # brightness increases. Resizing, recompression and small changes in
+    # exposure or framing flip few bits. None when it cannot be decoded.
+    if Image is None:
+        return None
+    file_type = inspect_upload(receipt)['file_type']
+    try:
+        if file_type == 'pdf' and pdfium is not None:
+            image = render_first_pdf_page(receipt, HASH_DECODE_EDGE)
+        elif file_type in ('jpeg', 'png'):
+            image = open_image(receipt, HASH_DECODE_EDGE)
+        else:
+            return None
+        pixels = list(flatten(image).convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.warning("Could not hash receipt: %s", e)
+        return None
+    finally:
+        receipt.seek(0)
+
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left, right = pixels[row * 9 + column], pixels[row * 9 + column + 1]
+            value = value << 1 | (right - left >= HASH_MIN_STEP)
+    return value
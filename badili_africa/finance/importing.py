@@ -0,0 +1,148 @@
+import csv
+import io
+import json
+import time
+
+from django.db import transaction
+from rest_framework import serializers
+
+from .activities import link_activities
+from .fingerprints import schedule_fingerprint
+from .models import Expense, Project
+from .rollups import apply_deltas, expense_deltas
+from .serializers import ExpenseImportSerializer
+from .sync import EXPENSE, record_changes
+
+# Columns read from an import file; anything else in a row is ignored
+EXPENSE_IMPORT_FIELDS = ['project_name', 'activity', 'amount', 'description', 'receipt']
+
+# Only the first rows with errors are reported back
+MAX_REPORTED_ERRORS = 100
+
+class ImportAborted(Exception):
+    def __init__(self, summary):
+        super().__init__("Import aborted, no expenses were created.")
+        self.summary = summary
+
+def detect_format(filename, requested=None):
+    if requested:
+        return requested.lower()
+    return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+def parse_csv(stream):
+    # `stream` is a binary file; rows are read lazily, one line at a time
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        for row in csv.DictReader(text):
+            yield {field: row[field] for field in EXPENSE_IMPORT_FIELDS if row.get(field) is not None}
+    finally:
+        text.detach()
+
+def parse_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            # Let validation report it against the row number
+            yield {}
+            continue
+        yield {field: row[field] for field in EXPENSE_IMPORT_FIELDS if field in row} if isinstance(row, dict) else {}
+
+PARSERS = {'csv': parse_csv, 'ndjson': parse_ndjson, 'jsonl': parse_ndjson}
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def project_lookup():
+    # Every project name in one query; like Project.objects.filter(name=...).first(),
+    # the oldest project wins when names are duplicated
+    projects = {}
+    for project in Project.objects.only('id', 'name').order_by('-id'):
+        projects[project.name] = project
+    return projects
+
+def import_expenses(rows, user, chunk_size=1000, skip_invalid=False, dry_run=False):
+    # Validate and insert `rows` chunk by chunk inside one transaction. Unless
+    # `skip_invalid` is set, any invalid row rolls the whole import back.
+    started = time.perf_counter()
+    projects = project_lookup()
+    # One serializer validates every row, so its fields are only built once
+    validator = ExpenseImportSerializer()
+    summary = {'rows': 0, 'created': 0, 'invalid': 0, 'errors': []}
+    rollup_deltas = expense_deltas([])
+
+    def record_error(row_number, errors):
+        summary['invalid'] += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+            summary['errors'].append({'row': row_number, 'errors': errors})
+
+    with transaction.atomic():
+        for chunk in chunked(rows, chunk_size):
+            expenses = []
+            for row in chunk:
+                summary['rows'] += 1
+                try:
+                    validated = validator.run_validation(row)
+                except serializers.ValidationError as e:
+                    record_error(summary['rows'], e.detail)
+                    continue
+
+                project = projects.get(validated['project_name'])
+                if project is None:
+                    record_error(summary['rows'], {'project_name': ["Project with the given name not found."]})
+                    continue
+
+                expenses.append(Expense(
+                    project_id=project,
+                    project_name=project.name,
+                    activity=validated['activity'],
+                    amount=validated['amount'],
+                    description=validated['description'],
+                    receipt=validated['receipt'],
+                    project_officer_id=user,
+                    project_officer=user.first_name
+                ))
+
+            # After the first bad row keep validating so the report lists
+            # every error, but stop writing
+            if summary['invalid'] and not skip_invalid:
+                continue
+            if not dry_run:
+                created = Expense.objects.bulk_create(link_activities(expenses))
+                expense_deltas(created, deltas=rollup_deltas)
+                record_changes(EXPENSE, [(expense.pk, expense.project_id_id) for expense in created])
+                # Run on commit, so a dry run or an aborted import hashes nothing
+                for expense in created:
+                    schedule_fingerprint(expense.receipt.name)
+            summary['created'] += len(expenses)
+
+        if summary['invalid'] and not skip_invalid:
+            summary['created'] = 0
+            record_timing(summary, started)
+            # Raising out of the atomic block rolls back every chunk written so far
+            raise ImportAborted(summary)
+
+        if dry_run:
+            transaction.set_rollback(True)
+        else:
+            # bulk_create skips the save signals that keep the rollups current,
+            # so apply every chunk's changes in one pass at the end
+            apply_deltas(rollup_deltas)
+
+    record_timing(summary, started)
+    return summary
+
+def record_timing(summary, started):
+    elapsed = time.perf_counter() - started
+    summary['duration_ms'] = round(elapsed * 1000)
+    summary['rows_per_second'] = round(summary['rows'] / elapsed) if elapsed else None
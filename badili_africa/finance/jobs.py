@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .extraction import extract_receipt
+from .models import ExtractionJob
+from .serializers import ExtractionJobSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class BaseJobBackend:
+    def enqueue(self, job):
+        raise NotImplementedError
+
+    def retry(self, job):
+        # Retries are picked up again once job.run_after has passed
+        pass
+
+
+class DatabaseJobBackend(BaseJobBackend):
+    # Jobs stay in the ExtractionJob table until a `run_extraction_worker`
+    # process claims them, so the web process never runs extractions itself.
+    def enqueue(self, job):
+        pass
+
+
+class ThreadPoolJobBackend(BaseJobBackend):
+    # Runs jobs on a bounded pool of threads inside the web process.
+    # Handy for development and single-process deployments.
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.EXTRACTION_WORKERS,
+            thread_name_prefix="extraction"
+        )
+
+    def enqueue(self, job):
+        job_id = job.pk
+        transaction.on_commit(lambda: self.executor.submit(self.run, job_id))
+
+    def retry(self, job):
+        delay = max((job.run_after - timezone.now()).total_seconds(), 0)
+        timer = threading.Timer(delay, self.executor.submit, args=(self.run, job.pk))
+        timer.daemon = True
+        timer.start()
+
+    def run(self, job_id):
+        job = run_job(job_id)
+        if job is not None and job.status == ExtractionJob.STATUS_PENDING:
+            self.retry(job)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(settings.EXTRACTION_JOB_BACKEND)()
+        return _backend
+
+def validate_callback_url(url):
+    # Callbacks are POSTed by the server, so only to the configured hosts,
+    # never to whatever internal address a client names
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or (parts.hostname or '') not in settings.EXTRACTION_CALLBACK_HOSTS:
+        raise ValidationError("callback_url must be an http(s) URL on an allowed host.")
+
+def submit_job(file, user=None, callback_url=''):
+    # Persist the upload and hand the job to the configured backend
+    if callback_url:
+        validate_callback_url(callback_url)
+    job = ExtractionJob.objects.create(
+        receipt=file,
+        submitted_by=user,
+        callback_url=callback_url or ''
+    )
+    get_backend().enqueue(job)
+    return job
+
+def runnable(now):
+    # Pending jobs that are due, and running ones whose worker's lease ran out
+    # with attempts left
+    return Q(status=ExtractionJob.STATUS_PENDING, run_after__lte=now) | Q(
+        status=ExtractionJob.STATUS_RUNNING,
+        claimed_at__lt=now - timedelta(seconds=settings.EXTRACTION_JOB_LEASE),
+        attempts__lt=settings.EXTRACTION_MAX_ATTEMPTS
+    )
+
+def claim_job(job_id):
+    # Atomically move a runnable job to running so only one worker gets it
+    now = timezone.now()
+    claimed = ExtractionJob.objects.filter(runnable(now), pk=job_id).update(
+        status=ExtractionJob.STATUS_RUNNING,
+        claimed_at=now,
+        attempts=F('attempts') + 1
+    )
+    if not claimed:
+        return None
+
+    job = ExtractionJob.objects.get(pk=job_id)
+    if job.started_at is None:
+        job.started_at = now
+        job.save(update_fields=['started_at'])
+    return job
+
+def retry_delay(attempts):
+    # Exponential backoff: base, 2*base, 4*base, ... capped at five minutes
+    return min(settings.EXTRACTION_RETRY_BACKOFF * (2 ** (attempts - 1)), 300)
+
+def run_job(job_id):
+    close_old_connections()
+    try:
+        job = claim_job(job_id)
+        if job is None:
+            return None
+
+        started = time.monotonic()
+        metrics = {}
+        try:
+            with job.receipt.open('rb') as receipt:
+                job.result = extract_receipt(receipt, metrics)
+            job.status = ExtractionJob.STATUS_SUCCEEDED
+            job.error = ''
+        except Exception as e:
+            logger.warning("Extraction job %s attempt %s failed: %s", job.pk, job.attempts, e)
+            job.error = str(e)
+            if job.attempts < settings.EXTRACTION_MAX_ATTEMPTS:
+                job.status = ExtractionJob.STATUS_PENDING
+                job.run_after = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+            else:
+                job.status = ExtractionJob.STATUS_FAILED
+
+        job.run_ms = int((time.monotonic() - started) * 1000)
+        for field, value in metrics.items():
+            setattr(job, field, value)
+        if job.status != ExtractionJob.STATUS_PENDING:
+            job.finished_at = timezone.now()
+        job.save(update_fields=[
+            'status', 'result', 'error', 'run_after', 'run_ms', 'finished_at',
+            'original_bytes', 'processed_bytes', 'preprocess_ms'
+        ])
+
+        if job.finished_at:
+            delete_receipt(job.receipt.name)
+            if job.callback_url:
+                send_callback(job)
+        return job
+    finally:
+        close_old_connections()
+
+def delete_receipt(name):
+    # Uploads are only kept until their job has finished. A failed delete
+    # leaves the file behind but must not fail the finished job.
+    try:
+        default_storage.delete(name)
+    except Exception as e:
+        logger.warning("Could not delete extraction job receipt %s: %s", name, e)
+
+def send_callback(job):
+    try:
+        # Checked again in case the allowed hosts changed since submission;
+        # redirects are not followed, they could lead anywhere
+        validate_callback_url(job.callback_url)
+        requests.post(
+            job.callback_url,
+            json=ExtractionJobSerializer(job).data,
+            timeout=settings.EXTRACTION_CALLBACK_TIMEOUT,
+            allow_redirects=False
+        )
+    except (ValidationError, requests.RequestException) as e:
+        logger.warning("Callback for extraction job %s failed: %s", job.pk, e)
+
+def fail_abandoned_jobs(now):
+    # Jobs whose last allowed attempt lost its worker are not run again
+    abandoned = ExtractionJob.objects.filter(
+        status=ExtractionJob.STATUS_RUNNING,
+        claimed_at__lt=now - timedelta(seconds=settings.EXTRACTION_JOB_LEASE),
+        attempts__gte=settings.EXTRACTION_MAX_ATTEMPTS
+    )
+    receipts = list(abandoned.values_list('receipt', flat=True))
+    failed = abandoned.update(status=ExtractionJob.STATUS_FAILED, error="The worker stopped during extraction.", finished_at=now)
+    for name in receipts:
+        delete_receipt(name)
+    return failed
+
+def pending_job_ids(limit):
+    now = timezone.now()
+    fail_abandoned_jobs(now)
+    return list(
+        ExtractionJob.objects.filter(runnable(now)).order_by('run_after').values_list('pk', flat=True)[:limit]
+    )
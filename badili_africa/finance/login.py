@@ -0,0 +1,125 @@
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import verify_password
+from rest_framework.authtoken.models import Token
+from rest_framework.throttling import SimpleRateThrottle
+
+from .models import User
+from .token_cache import get_token_cache
+
+# Password login for the sync and async login views. Throttles run before
+# any password is hashed, the user and their token come back in one query,
+# and hashes made with an older hasher or work factor are upgraded on the
+# next successful login.
+
+
+class LoginRateThrottle(SimpleRateThrottle):
+    # Every login attempt, per client address (see NUM_PROXIES)
+    scope = 'login'
+
+    def get_rate(self):
+        return settings.LOGIN_RATE_PER_IP or None
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
+
+
+class FailedLoginThrottle(SimpleRateThrottle):
+    # Failed attempts per username from any address. Only failures are
+    # counted, so a user signing in repeatedly is never locked out.
+    scope = 'login_failures'
+
+    def get_rate(self):
+        return settings.LOGIN_FAILURES_PER_USER or None
+
+    def get_cache_key(self, request, view):
+        username = request.data.get('username') if hasattr(request.data, 'get') else None
+        if not username:
+            return None
+        ident = hashlib.sha256(str(username).lower().encode()).hexdigest()
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        # Like SimpleRateThrottle.allow_request(), without counting this attempt
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        self.history = self.cache.get(self.key, [])
+        self.now = self.timer()
+        while self.history and self.history[-1] <= self.now - self.duration:
+            self.history.pop()
+        if len(self.history) >= self.num_requests:
+            return self.throttle_failure()
+        return True
+
+    def record_failure(self, request, view):
+        if self.allow_request(request, view) and self.rate is not None and self.key is not None:
+            self.history.insert(0, self.now)
+            self.cache.set(self.key, self.history, self.duration)
+
+
+def login_queryset(username):
+    return User._default_manager.select_related('auth_token').filter(**{User.USERNAME_FIELD: username})
+
+def rehash(user, password):
+    # Written with update() so upgrading a hash fires no User signals
+    user.set_password(password)
+    User._default_manager.filter(pk=user.pk).update(password=user.password)
+
+def authenticate_login(username, password):
+    # The active user with these credentials, or None. Unknown usernames
+    # still hash once so they take as long as wrong passwords.
+    user = login_queryset(username).first()
+    is_correct, must_update = verify_password(password, user.password if user is not None else '')
+    if user is None or not is_correct or not user.is_active:
+        return None
+    if must_update:
+        rehash(user, password)
+    return user
+
+async def aauthenticate_login(username, password):
+    # Hashing is CPU bound and hashlib releases the GIL, so it runs on the
+    # default executor: neither on the event loop nor on the single thread
+    # that thread-sensitive sync_to_async calls share
+    user = await login_queryset(username).afirst()
+    is_correct, must_update = await sync_to_async(verify_password, thread_sensitive=False)(
+        password, user.password if user is not None else ''
+    )
+    if user is None or not is_correct or not user.is_active:
+        return None
+    if must_update:
+        await sync_to_async(user.set_password, thread_sensitive=False)(password)
+        await User._default_manager.filter(pk=user.pk).aupdate(password=user.password)
+    return user
+
+def cache_token(user, token):
+    # The client's next request is authenticated without a query
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        token_cache.set(token.key, user, token)
+    return token
+
+def issue_token(user):
+    try:
+        token = user.auth_token
+    except Token.DoesNotExist:
+        token, created = Token.objects.get_or_create(user=user)
+    return cache_token(user, token)
+
+async def aissue_token(user):
+    try:
+        token = user.auth_token
+    except Token.DoesNotExist:
+        token, created = await Token.objects.aget_or_create(user=user)
+    return cache_token(user, token)
+
+def login_response_data(user, token):
+    return {
+        'token': f'Bearer {token.key}',
+        'user_id': user.pk,
+        'email': user.email
+    }
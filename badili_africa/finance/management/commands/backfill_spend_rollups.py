@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from finance.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-project spending rollups from the expense table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project-id', type=int, action='append', dest='project_ids',
+                            help="Only rebuild this project (repeatable)")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # Hold off expense writes so none land between the scan and the
+                # insert; reads carry on as normal
+                with connection.cursor() as cursor:
+                    cursor.execute('LOCK TABLE finance_expense IN SHARE MODE')
+            created = rebuild(options['project_ids'])
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} spending rollups"))
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from finance.benchmarking import SCENARIOS, StubProvider, compare, run_scenario, seed
+from finance.clients import reset_provider_client
+from finance.token_cache import get_token_cache
+
+# Options that describe the workload, forwarded when benchmarking another
+# revision so both runs measure the same thing
+WORKLOAD_OPTIONS = ['users', 'projects', 'expenses', 'iterations', 'seed', 'provider_latency']
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway test database and measure latency percentiles, requests/sec and "
+        "queries per request for the main endpoints, with receipt extraction answered by "
+        "a local stub of the model API. Compare against a saved run or another git revision."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help="Scenario to run (repeatable, default all)")
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--projects', type=int, default=200)
+        parser.add_argument('--expenses', type=int, default=20000)
+        parser.add_argument('--iterations', type=int, default=200, help="Measured requests per scenario")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the dataset")
+        parser.add_argument('--provider-latency', type=float, default=0.05,
+                            help="Seconds the stub model API takes per receipt")
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+        parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+        parser.add_argument('--revision', help="Git revision to benchmark with the same options and compare with")
+        parser.add_argument('--max-regression', type=float, default=10,
+                            help="Allowed p95 increase in percent before the run fails")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['revision']:
+            baseline = self.run_revision(options)
+        elif options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        results = self.run(options)
+        for scenario, summary in results.items():
+            self.stdout.write(
+                f"{scenario}: {summary['ok']} ok, {summary['failed']} failed, {summary['rps']} req/s, "
+                f"p50 {summary['p50']}ms, p95 {summary['p95']}ms, p99 {summary['p99']}ms, "
+                f"{summary['queries']} queries/request"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if baseline is not None:
+            self.report(compare(baseline, results, options['max_regression']))
+
+    def run(self, options):
+        # A private cache keeps the run from touching (or flushing) a shared
+        # one; every request comes from one address, so no login throttle
+        caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-api'}}
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        media_root = tempfile.mkdtemp()
+        try:
+            with StubProvider(options['provider_latency']) as provider, \
+                    override_settings(RECEIPT_PROVIDER_URL=provider.url, MEDIA_ROOT=media_root, CACHES=caches,
+                                      LOGIN_RATE_PER_IP=''):
+                reset_provider_client()
+                data = seed(options['users'], options['projects'], options['expenses'], random_seed=options['seed'])
+                results = {}
+                for scenario in options['scenario'] or SCENARIOS:
+                    # Every scenario starts from cold caches, whatever ran before it
+                    cache.clear()
+                    if get_token_cache() is not None:
+                        get_token_cache().clear()
+                    results[scenario] = run_scenario(Client(), scenario, data, options['iterations'])
+                return results
+        finally:
+            reset_provider_client()
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    def run_revision(self, options):
+        # Check the revision out into a temporary worktree and run this command
+        # there; the revision must already contain benchmark_api
+        top = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=settings.BASE_DIR,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        worktree = tempfile.mkdtemp()
+        output = os.path.join(worktree, 'benchmark-baseline.json')
+        subprocess.run(['git', 'worktree', 'add', '--detach', worktree, options['revision']], cwd=top, check=True)
+        try:
+            command = [sys.executable, 'manage.py', 'benchmark_api', '--output', output]
+            for name in WORKLOAD_OPTIONS:
+                command += [f"--{name.replace('_', '-')}", str(options[name])]
+            for scenario in options['scenario'] or []:
+                command += ['--scenario', scenario]
+            self.stdout.write(f"Benchmarking {options['revision']}")
+            result = subprocess.run(command, cwd=os.path.join(worktree, os.path.relpath(settings.BASE_DIR, top)))
+            if result.returncode != 0:
+                raise CommandError(f"Benchmarking {options['revision']} failed")
+            with open(output) as f:
+                return json.load(f)
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=top)
+
+    def report(self, rows):
+        regressions = []
+        for scenario, metric, before, after, change, regressed in rows:
+            marker = '  REGRESSION' if regressed else ''
+            self.stdout.write(f"{scenario:18} {metric:8} {before:>10} -> {after:>10} ({change:+.1f}%){marker}")
+            if regressed:
+                regressions.append(f'{scenario} {metric}')
+        if regressions:
+            raise CommandError(f"Performance regressed: {', '.join(regressions)}")
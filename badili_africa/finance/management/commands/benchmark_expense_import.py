@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from finance.activities import activity_for
+from finance.importing import import_expenses
+from finance.models import Expense, Project, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure bulk import throughput in rows/second against creating the same "
+        "expenses one at a time. Everything is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--baseline-rows', type=int, default=500,
+                            help="Rows for the one-at-a-time comparison, which is much slower")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--projects', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = User.objects.create(username='benchmark-import', first_name='Benchmark')
+            projects = Project.objects.bulk_create([
+                Project(name=f'Benchmark project {i}', description='')
+                for i in range(options['projects'])
+            ])
+
+            def rows(count):
+                for i in range(count):
+                    yield {
+                        'project_name': projects[i % len(projects)].name,
+                        'activity': f'Activity {i % 7}',
+                        'amount': f'{i % 5000}.{i % 100:02d}',
+                        'description': f'Benchmark expense {i}',
+                    }
+
+            summary = import_expenses(rows(options['rows']), user, chunk_size=options['chunk_size'])
+            bulk_rate = summary['rows_per_second']
+
+            # What the per-row POST path does for each expense
+            started = time.perf_counter()
+            for row in rows(options['baseline_rows']):
+                project = Project.objects.filter(name=row['project_name']).first()
+                Expense.objects.create(
+                    project_id=project,
+                    project_name=project.name,
+                    activity_ref=activity_for(project, row['activity']),
+                    activity=row['activity'],
+                    amount=row['amount'],
+                    description=row['description'],
+                    project_officer_id=user,
+                    project_officer=user.first_name
+                )
+            elapsed = time.perf_counter() - started
+            baseline_rate = round(options['baseline_rows'] / elapsed)
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"bulk import: {summary['rows']} rows, {bulk_rate} rows/s")
+        self.stdout.write(f"one at a time: {options['baseline_rows']} rows, {baseline_rate} rows/s")
+        self.stdout.write(f"speedup: {bulk_rate / baseline_rate:.1f}x")
@@ -0,0 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import get_hasher
+from django.core.management.base import BaseCommand
+
+from finance.hashers import PBKDF2PasswordHasher
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure password verifications (logins) per second per core for PBKDF2 work factors, "
+        "to choose PASSWORD_PBKDF2_ITERATIONS. With --threads, also the rate across threads."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, action='append',
+                            help="PBKDF2 iteration count to measure (repeatable, default the current setting)")
+        parser.add_argument('--seconds', type=float, default=2, help="How long to measure each count")
+        parser.add_argument('--threads', type=int, default=1)
+
+    def handle(self, *args, **options):
+        hasher = get_hasher()
+        counts = options['iterations'] or [hasher.iterations]
+        self.stdout.write(f"Current hasher: {hasher.algorithm}, {hasher.iterations} iterations")
+
+        for count in counts:
+            encoded = hasher.encode('benchmark-password', hasher.salt(), count)
+            per_core = self.rate(encoded, options['seconds'], 1)
+            line = f"{count} iterations: {per_core:.1f} logins/s per core ({1000 / per_core:.1f}ms each)"
+            if options['threads'] > 1:
+                total = self.rate(encoded, options['seconds'], options['threads'])
+                line += f", {total:.1f} logins/s on {options['threads']} threads"
+            self.stdout.write(line)
+
+    def rate(self, encoded, seconds, threads):
+        hasher = PBKDF2PasswordHasher()
+
+        def verify():
+            done = 0
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                hasher.verify('benchmark-password', encoded)
+                done += 1
+            return done
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            done = sum(executor.map(lambda _: verify(), range(threads)))
+        return done / (time.perf_counter() - started)
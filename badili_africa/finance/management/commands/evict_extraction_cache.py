@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from finance.extraction_cache import evict
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired extraction cache entries and the least recently used ones beyond "
+        "RECEIPT_CACHE_MAX_ENTRIES. Run it from cron when RECEIPT_CACHE_EVICT_PROBABILITY is 0."
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{evict()} extraction cache entries evicted")
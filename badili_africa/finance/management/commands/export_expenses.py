@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from finance.models import Expense
+from finance.streaming import EXPENSE_EXPORT_FIELDS, export_rows, stream_csv, stream_json_array, stream_ndjson
+
+
+class Command(BaseCommand):
+    help = "Stream every expense to a CSV, JSON Lines or JSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help="File to write (default: stdout)")
+        parser.add_argument('--type', choices=['csv', 'ndjson', 'json'], default='csv')
+        parser.add_argument('--project-id', type=int)
+
+    def handle(self, *args, **options):
+        expenses = Expense.objects.all()
+        if options['project_id']:
+            expenses = expenses.filter(project_id=options['project_id'])
+
+        rows = export_rows(expenses)
+        if options['type'] == 'csv':
+            chunks = stream_csv(rows, EXPENSE_EXPORT_FIELDS)
+        elif options['type'] == 'ndjson':
+            chunks = stream_ndjson(rows)
+        else:
+            chunks = stream_json_array(rows)
+
+        if options['output'] == '-':
+            sys.stdout.writelines(chunks)
+            return
+        with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+            f.writelines(chunks)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from finance.fingerprints import fingerprint_stored_receipt
+from finance.models import Expense, ReceiptFingerprint
+
+
+class Command(BaseCommand):
+    help = (
+        "Store the perceptual hash of every expense receipt that has none yet, so receipts "
+        "saved before fingerprinting was enabled are found as duplicates too."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help="Fingerprint at most this many receipts")
+
+    def handle(self, *args, **options):
+        done = set(ReceiptFingerprint.objects.exclude(receipt='').values_list('receipt', flat=True))
+        names = Expense.objects.exclude(receipt='').values_list('receipt', flat=True).distinct().iterator()
+
+        hashed = failed = 0
+        for name in names:
+            if name in done:
+                continue
+            if options['limit'] is not None and hashed + failed >= options['limit']:
+                break
+            try:
+                dhash = fingerprint_stored_receipt(name)
+            except Exception as e:
+                self.stderr.write(f"{name}: {e}")
+                dhash = None
+            if dhash is None:
+                failed += 1
+            else:
+                hashed += 1
+        self.stdout.write(f"{hashed} receipts fingerprinted, {failed} could not be hashed")
@@ -0,0 +1,44 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from finance.importing import PARSERS, ImportAborted, detect_format, import_expenses
+from finance.models import User
+
+
+class Command(BaseCommand):
+    help = "Bulk import expenses from a CSV or JSON Lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import")
+        parser.add_argument('--user', required=True, help="Username to record as the project officer")
+        parser.add_argument('--type', choices=sorted(PARSERS), help="File format (default: from the extension)")
+        parser.add_argument('--chunk-size', type=int, default=settings.EXPENSE_IMPORT_CHUNK_SIZE)
+        parser.add_argument('--skip-invalid', action='store_true',
+                            help="Import the valid rows instead of aborting on the first invalid one")
+        parser.add_argument('--dry-run', action='store_true', help="Validate only, create nothing")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['user']}")
+
+        import_format = detect_format(options['path'], options['type'])
+        try:
+            with open(options['path'], 'rb') as f:
+                summary = import_expenses(
+                    PARSERS[import_format](f),
+                    user,
+                    chunk_size=options['chunk_size'],
+                    skip_invalid=options['skip_invalid'],
+                    dry_run=options['dry_run']
+                )
+        except ImportAborted as e:
+            raise CommandError(f"{e}\n{json.dumps(e.summary, indent=2)}")
+
+        self.stdout.write(json.dumps(summary, indent=2))
+        self.stdout.write(self.style.SUCCESS(
+            f"{summary['created']} of {summary['rows']} rows imported at {summary['rows_per_second']} rows/s"
+        ))
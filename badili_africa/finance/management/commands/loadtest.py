@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+from finance.benchmarking import summarize
+
+ENDPOINTS = {
+    'expenses': ('GET', 'api/expenses/'),
+    'project-expenses': ('GET', 'api/projects/{project_id}/expenses/'),
+    'file': ('POST', 'api/file/'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive concurrent requests at one or more running servers and report throughput, "
+        "e.g. a WSGI deployment against an ASGI one started with ASYNC_VIEWS=true"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', action='append', required=True,
+                            help="Base URL of a running server (repeat to compare servers)")
+        parser.add_argument('--token', required=True, help="API token to authenticate with")
+        parser.add_argument('--endpoint', choices=ENDPOINTS, default='expenses')
+        parser.add_argument('--project-id', type=int, default=1)
+        parser.add_argument('--receipt', help="Receipt file to upload for the 'file' endpoint")
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--timeout', type=float, default=120)
+
+    def handle(self, *args, **options):
+        if options['endpoint'] == 'file' and not options['receipt']:
+            raise CommandError("--receipt is required for the 'file' endpoint")
+
+        for base_url in options['url']:
+            stats = asyncio.run(self.run(base_url, options))
+            self.stdout.write(
+                f"{base_url} {options['endpoint']}: {stats['ok']}/{options['requests']} ok, "
+                f"{stats['rps']:.1f} req/s, p50 {stats['p50']:.0f}ms, "
+                f"p95 {stats['p95']:.0f}ms, p99 {stats['p99']:.0f}ms"
+            )
+
+    async def run(self, base_url, options):
+        method, path = ENDPOINTS[options['endpoint']]
+        path = path.format(project_id=options['project_id'])
+        receipt = None
+        if options['receipt']:
+            with open(options['receipt'], 'rb') as f:
+                receipt = f.read()
+
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        latencies = []
+        failures = 0
+        limits = httpx.Limits(max_connections=options['concurrency'])
+
+        async with httpx.AsyncClient(
+            base_url=base_url,
+            headers={'Authorization': f"Bearer {options['token']}"},
+            timeout=options['timeout'],
+            limits=limits
+        ) as client:
+            async def one_request():
+                nonlocal failures
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        if method == 'POST':
+                            response = await client.post(path, files={'receipt': ('receipt.jpg', receipt)})
+                        else:
+                            response = await client.get(path)
+                        ok = response.status_code < 400
+                    except httpx.HTTPError:
+                        ok = False
+                    if ok:
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    else:
+                        failures += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one_request() for _ in range(options['requests'])))
+            elapsed = time.perf_counter() - started
+
+        if not latencies:
+            raise CommandError(f"Every request to {base_url} failed")
+
+        return summarize(latencies, elapsed, failures)
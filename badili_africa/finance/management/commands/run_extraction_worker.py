@@ -0,0 +1,59 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from finance.jobs import pending_job_ids, run_job
+
+
+class Command(BaseCommand):
+    help = "Process queued receipt extraction jobs from the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.EXTRACTION_WORKERS,
+                            help="Maximum number of extractions running at once")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the currently runnable jobs and exit")
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        slots = threading.BoundedSemaphore(concurrency)
+        in_flight = set()
+        in_flight_lock = threading.Lock()
+
+        def work(job_id):
+            try:
+                job = run_job(job_id)
+                if job is not None:
+                    self.stdout.write(f"{job.pk} {job.status} attempt={job.attempts} run_ms={job.run_ms}")
+            finally:
+                with in_flight_lock:
+                    in_flight.discard(job_id)
+                slots.release()
+
+        self.stdout.write(f"Extraction worker started with concurrency {concurrency}")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="extraction") as executor:
+            while True:
+                submitted = 0
+                for job_id in pending_job_ids(concurrency * 2):
+                    with in_flight_lock:
+                        if job_id in in_flight:
+                            continue
+                    if not slots.acquire(blocking=False):
+                        break
+                    with in_flight_lock:
+                        in_flight.add(job_id)
+                    executor.submit(work, job_id)
+                    submitted += 1
+
+                if options['once'] and not submitted:
+                    with in_flight_lock:
+                        if not in_flight:
+                            break
+
+                if not submitted:
+                    time.sleep(options['poll_interval'])
@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from finance.benchmarking import seed
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-create benchmark users, projects and expenses in the configured database, "
+        "e.g. before pointing loadtest at a staging server. Writes the usernames, password, "
+        "tokens and project ids to a JSON manifest."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--projects', type=int, default=5000)
+        parser.add_argument('--expenses', type=int, default=2000000)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed; use a new one to seed again")
+        parser.add_argument('--manifest', default='benchmark-manifest.json')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            data = seed(
+                options['users'], options['projects'], options['expenses'],
+                chunk_size=options['chunk_size'], random_seed=options['seed'],
+                log=lambda message: self.stdout.write(message, ending='\r')
+            )
+        with open(options['manifest'], 'w') as f:
+            json.dump(data, f)
+        self.stdout.write(
+            f"\nSeeded {options['users']} users, {options['projects']} projects and "
+            f"{options['expenses']} expenses; manifest written to {options['manifest']}"
+        )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from finance.denormalization import COPIES, verify
+from finance.models import Expense
+
+
+class Command(BaseCommand):
+    help = (
+        "Find expenses whose project_name or project_officer no longer match their project "
+        "or officer, walking the table in primary key ranges. With --fix, repair them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--field', action='append', choices=COPIES,
+                            help="Copied field to check (repeatable, default all)")
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Primary keys per range")
+        parser.add_argument('--fix', action='store_true')
+
+    def handle(self, *args, **options):
+        fields = options['field'] or list(COPIES)
+        last_pk = Expense.objects.aggregate(last=Max('pk'))['last'] or 0
+        totals = dict.fromkeys(fields, 0)
+
+        for start in range(1, last_pk + 1, options['chunk_size']):
+            drift = verify(start, start + options['chunk_size'], fields, fix=options['fix'])
+            for field, rows in drift.items():
+                totals[field] += rows
+
+        action = 'fixed' if options['fix'] else 'out of date'
+        for field, rows in totals.items():
+            self.stdout.write(f"{field}: {rows} rows {action}")
@@ -0,0 +1,174 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+# In-process request metrics in the Prometheus text exposition format. Every
+# worker process keeps its own numbers, so scrape each worker (or run a
+# single-process server) to see all traffic.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Per-request tallies for the request being handled in this context
+current_request = ContextVar('finance_request_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.provider_calls = 0
+        self.provider_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add_query(self, seconds):
+        with self.lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def add_provider_call(self, seconds):
+        with self.lock:
+            self.provider_calls += 1
+            self.provider_seconds += seconds
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, labels)} {value:g}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        label_names = self.labels + ('le',)
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_labels(label_names, labels + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {total:g}')
+                lines.append(f'{self.name}_count{_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+REQUESTS = Counter('finance_http_requests_total', 'HTTP requests handled.', ('view', 'method', 'status'))
+REQUEST_SECONDS = Histogram('finance_http_request_duration_seconds', 'Wall time per request.', ('view', 'method'))
+REQUEST_BYTES = Counter('finance_http_request_bytes_total', 'Request body bytes received.', ('view',))
+RESPONSE_BYTES = Counter('finance_http_response_bytes_total', 'Response body bytes sent.', ('view',))
+DB_QUERIES = Counter('finance_db_queries_total', 'Database queries run while handling requests.', ('view',))
+DB_SECONDS = Counter('finance_db_query_seconds_total', 'Time spent in database queries.', ('view',))
+PROVIDER_SECONDS = Counter('finance_provider_request_seconds_total', 'Time spent calling the extraction provider while handling requests.', ('view',))
+PROVIDER_CALLS = Histogram('finance_provider_call_duration_seconds', 'Extraction provider call latency.', ('outcome',))
+EXTRACTOR_CALLS = Histogram('finance_extractor_duration_seconds', 'Receipt extraction latency per backend.', ('backend', 'outcome'))
+EXTRACTOR_HANDOFFS = Counter('finance_extractor_handoffs_total', 'Receipts also sent to a backend because earlier ones were slow or failed.', ('backend', 'reason'))
+
+METRICS = [REQUESTS, REQUEST_SECONDS, REQUEST_BYTES, RESPONSE_BYTES, DB_QUERIES, DB_SECONDS, PROVIDER_SECONDS, PROVIDER_CALLS, EXTRACTOR_CALLS, EXTRACTOR_HANDOFFS]
+
+def record_query(execute, sql, params, many, context):
+    # connection.execute_wrapper hook: time every query of an instrumented request
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(time.perf_counter() - started)
+
+def record_provider_call(seconds, outcome):
+    PROVIDER_CALLS.observe(seconds, outcome)
+    stats = current_request.get()
+    if stats is not None:
+        stats.add_provider_call(seconds)
+
+def record_extractor_call(backend, seconds, outcome):
+    EXTRACTOR_CALLS.observe(seconds, backend, outcome)
+
+def record_handoff(backend, reason):
+    EXTRACTOR_HANDOFFS.inc(backend, reason)
+
+def record_request(stats, view, method, status, bytes_in, bytes_out):
+    seconds = time.perf_counter() - stats.started
+    REQUESTS.inc(view, method, status)
+    REQUEST_SECONDS.observe(seconds, view, method)
+    REQUEST_BYTES.inc(view, amount=bytes_in)
+    RESPONSE_BYTES.inc(view, amount=bytes_out)
+    DB_QUERIES.inc(view, amount=stats.db_queries)
+    DB_SECONDS.inc(view, amount=stats.db_seconds)
+    PROVIDER_SECONDS.inc(view, amount=stats.provider_seconds)
+    return seconds
+
+def _gauge(name, help_text, value, metric_type='gauge'):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value:g}']
+
+def component_metrics():
+    # Counters the caches and provider client already keep, read at scrape time
+    from .clients import CircuitBreaker, get_provider_client
+    from .extraction_cache import HITS_KEY, MISSES_KEY
+    from .extractors import get_extractors
+    from .token_cache import get_token_cache
+    from django.core.cache import cache
+
+    lines = []
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        stats = token_cache.stats()
+        lines += _gauge('finance_token_cache_hits_total', 'Token cache hits in this process.', stats['hits'] + stats['shared_hits'], 'counter')
+        lines += _gauge('finance_token_cache_misses_total', 'Token cache misses in this process.', stats['misses'], 'counter')
+        lines += _gauge('finance_token_cache_entries', 'Tokens held in the in-process cache.', stats['entries'])
+    lines += _gauge('finance_extraction_cache_hits_total', 'Receipt extraction cache hits.', cache.get(HITS_KEY, 0), 'counter')
+    lines += _gauge('finance_extraction_cache_misses_total', 'Receipt extraction cache misses.', cache.get(MISSES_KEY, 0), 'counter')
+    breaker = get_provider_client().breaker
+    lines += _gauge('finance_provider_circuit_open', '1 while the provider circuit breaker is open.', int(breaker.state != CircuitBreaker.CLOSED))
+    name = 'finance_extractor_hedge_deadline_seconds'
+    lines += [f'# HELP {name} Seconds a backend may take before the next one is asked too.', f'# TYPE {name} gauge']
+    lines += [f'{name}{_labels(("backend",), (e.name,))} {e.hedge_deadline():g}' for e in get_extractors() if not e.fallback]
+    return lines
+
+def exposition():
+    lines = []
+    for metric in METRICS:
+        lines += metric.expose()
+    lines += component_metrics()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,315 @@
+import cProfile
+import hashlib
+import os
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string, slugify
+
+from . import metrics
+from .routers import read_from_replica
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def instrument_connection(connection, **kwargs):
+    # Time queries on every database connection, including ones opened later
+    # on sync_to_async and worker threads
+    if metrics.record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.record_query)
+
+connection_created.connect(instrument_connection)
+
+def view_label(request):
+    # URL names keep the label set small no matter how many ids are requested
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+def request_bytes(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+def server_timing(stats):
+    entries = [f'app;dur={(time.perf_counter() - stats.started) * 1000:.1f}']
+    entries.append(f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.db_queries} queries"')
+    if stats.provider_calls:
+        entries.append(f'provider;dur={stats.provider_seconds * 1000:.1f};desc="{stats.provider_calls} calls"')
+    return ', '.join(entries)
+
+
+class RequestMetricsMiddleware:
+    # Records wall time, database queries, extraction provider time and body
+    # sizes for every request, labelled by URL name, for the /api/metrics/
+    # endpoint. Optionally adds a Server-Timing header and saves cProfile
+    # output for a sample of slow synchronous requests.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        for connection in connections.all(initialized_only=True):
+            instrument_connection(connection)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        stats = metrics.RequestStats()
+        token = metrics.current_request.set(stats)
+        profiler = None
+        if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            metrics.current_request.reset(token)
+
+        if profiler is not None:
+            self.save_profile(request, stats, profiler)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        # Coroutines interleave on the event loop, so they are never profiled
+        stats = metrics.RequestStats()
+        token = metrics.current_request.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        if settings.SERVER_TIMING_ENABLED:
+            response['Server-Timing'] = server_timing(stats)
+
+        record = lambda bytes_out: metrics.record_request(
+            stats, view_label(request), request.method, response.status_code, request_bytes(request), bytes_out
+        )
+        if not response.streaming:
+            record(len(response.content))
+        elif response.is_async:
+            response.streaming_content = self.acount(response.streaming_content, stats, record)
+        else:
+            response.streaming_content = self.count(response.streaming_content, stats, record)
+        return response
+
+    # Streamed bodies (exports, batch extraction) do most of their work while
+    # the server iterates them, so they are recorded once the stream ends
+
+    def count(self, content, stats, record):
+        sent = 0
+        metrics.current_request.set(stats)
+        try:
+            for chunk in content:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            metrics.current_request.set(None)
+            record(sent)
+
+    async def acount(self, content, stats, record):
+        sent = 0
+        metrics.current_request.set(stats)
+        try:
+            async for chunk in content:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            metrics.current_request.set(None)
+            record(sent)
+
+    def save_profile(self, request, stats, profiler):
+        elapsed_ms = (time.perf_counter() - stats.started) * 1000
+        if elapsed_ms < settings.PROFILE_SLOW_REQUEST_MS:
+            return
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{slugify(view_label(request))}-{elapsed_ms:.0f}ms.prof"
+        profiler.dump_stats(os.path.join(settings.PROFILE_DIR, filename))
+
+
+STICKY_KEY = 'finance:db-sticky:{}'
+
+def client_key(request):
+    # Bearer token, else session cookie, else address
+    ident = (
+        request.META.get('HTTP_AUTHORIZATION')
+        or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        or request.META.get('REMOTE_ADDR', '')
+    )
+    return STICKY_KEY.format(hashlib.sha256(ident.encode()).hexdigest())
+
+
+class ReplicaRoutingMiddleware:
+    # Lets safe requests read from the replicas, except for clients that
+    # wrote within the last DB_REPLICA_STICKY_SECONDS: they keep reading from
+    # the primary until the replicas have caught up with their writes. Who
+    # wrote is kept in DB_REPLICA_STICKY_CACHE, shared by every worker.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed()
+        if not settings.DB_REPLICA_STICKY_CACHE:
+            raise ImproperlyConfigured(
+                "DB_REPLICA_HOSTS needs DB_REPLICA_STICKY_CACHE (or SHARED_CACHE_URL) naming a cache shared by "
+                "every worker, or clients may not see their own writes."
+            )
+        self.cache = caches[settings.DB_REPLICA_STICKY_CACHE]
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        replica = self.use_replica(request)
+        token = read_from_replica.set(replica)
+        try:
+            response = self.get_response(request)
+        finally:
+            read_from_replica.reset(token)
+        self.after(request, response)
+        return self.stream_from_replica(response) if replica else response
+
+    async def __acall__(self, request):
+        replica = await self.ause_replica(request)
+        token = read_from_replica.set(replica)
+        try:
+            response = await self.get_response(request)
+        finally:
+            read_from_replica.reset(token)
+        await self.aafter(request, response)
+        return self.stream_from_replica(response) if replica else response
+
+    # Streamed bodies (exports) query while the server iterates them, after
+    # the request has left this middleware
+
+    def stream_from_replica(self, response):
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self.aiterate(response.streaming_content)
+            else:
+                response.streaming_content = self.iterate(response.streaming_content)
+        return response
+
+    def iterate(self, content):
+        read_from_replica.set(True)
+        try:
+            yield from content
+        finally:
+            read_from_replica.set(False)
+
+    async def aiterate(self, content):
+        read_from_replica.set(True)
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            read_from_replica.set(False)
+
+    def wrote(self, request, response):
+        return request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400
+
+    def use_replica(self, request):
+        return request.method in ('GET', 'HEAD', 'OPTIONS') and self.cache.get(client_key(request)) is None
+
+    async def ause_replica(self, request):
+        return request.method in ('GET', 'HEAD', 'OPTIONS') and await self.cache.aget(client_key(request)) is None
+
+    def after(self, request, response):
+        if self.wrote(request, response):
+            self.cache.set(client_key(request), 1, settings.DB_REPLICA_STICKY_SECONDS)
+
+    async def aafter(self, request, response):
+        if self.wrote(request, response):
+            await self.cache.aset(client_key(request), 1, settings.DB_REPLICA_STICKY_SECONDS)
+
+
+def accepted_encodings(request):
+    # Codings listed in Accept-Encoding, minus those refused with q=0
+    accepted = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip().lower()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class CompressionMiddleware:
+    # Compresses response bodies of at least RESPONSE_COMPRESSION_MIN_BYTES
+    # with brotli when the client and server support it, else gzip. Mobile
+    # clients syncing over slow links get JSON several times smaller. Streamed
+    # responses (exports, batch extraction) are sent as they are.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.RESPONSE_COMPRESSION_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if len(response.content) < settings.RESPONSE_COMPRESSION_MIN_BYTES:
+            return response
+        # The body depends on Accept-Encoding from here on, compressed or not
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        accepted = accepted_encodings(request)
+        if brotli is not None and 'br' in accepted:
+            coding, content = 'br', brotli.compress(response.content, quality=5)
+        elif 'gzip' in accepted:
+            coding, content = 'gzip', compress_string(response.content)
+        else:
+            return response
+        if len(content) >= len(response.content):
+            return response
+
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = coding
+        # The compressed bytes differ from the ones the ETag was made for
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0006_extractionjob_preprocessing_metrics'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='project',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['created_at', 'id'], name='finance_exp_created_ef2022_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['project_id', 'created_at', 'id'], name='finance_exp_project_cf16af_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['project_officer_id', 'created_at'], name='finance_exp_project_75298a_idx'),
+        ),
+    ]
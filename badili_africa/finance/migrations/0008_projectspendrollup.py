@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0007_expense_project_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectSpendRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity', models.CharField(max_length=100)),
+                ('month', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('expense_count', models.IntegerField(default=0)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spend_rollups', to='finance.project')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('project', 'activity', 'month'), name='unique_project_spend_rollup')],
+            },
+        ),
+    ]
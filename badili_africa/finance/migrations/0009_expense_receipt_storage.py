@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:11
+
+import finance.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0008_projectspendrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='expense',
+            name='receipt',
+            field=models.FileField(storage=finance.storage.receipt_storage, upload_to='receipts/'),
+        ),
+    ]
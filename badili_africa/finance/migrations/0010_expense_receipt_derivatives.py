@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0009_expense_receipt_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='receipt_derivatives',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
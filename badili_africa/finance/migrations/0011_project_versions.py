@@ -0,0 +1,30 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0010_expense_receipt_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='expenses_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='expenses_version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
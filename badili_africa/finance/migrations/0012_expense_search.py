@@ -0,0 +1,75 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:36
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# The search vector is computed by a trigger, so bulk_create(), queryset
+# update() and raw SQL keep it current too. Weights rank project and activity
+# matches above the officer's name, and that above the description.
+SEARCH_SQL = [
+    """
+    CREATE FUNCTION finance_expense_search_vector(project_name text, activity text, project_officer text, description text)
+    RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('english', coalesce(project_name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(activity, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(project_officer, '')), 'B')
+            || setweight(to_tsvector('english', coalesce(description, '')), 'C')
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE FUNCTION finance_expense_search_vector_trigger() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := finance_expense_search_vector(NEW.project_name, NEW.activity, NEW.project_officer, NEW.description);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER finance_expense_search_vector_update
+    BEFORE INSERT OR UPDATE OF project_name, activity, project_officer, description ON finance_expense
+    FOR EACH ROW EXECUTE FUNCTION finance_expense_search_vector_trigger()
+    """,
+    "UPDATE finance_expense SET search_vector = finance_expense_search_vector(project_name, activity, project_officer, description)",
+    "CREATE INDEX finance_expense_search_vector_idx ON finance_expense USING gin (search_vector)",
+    "CREATE INDEX finance_expense_project_name_trgm_idx ON finance_expense USING gin (project_name gin_trgm_ops)",
+    "CREATE INDEX finance_expense_activity_trgm_idx ON finance_expense USING gin (activity gin_trgm_ops)",
+    "CREATE INDEX finance_expense_project_officer_trgm_idx ON finance_expense USING gin (project_officer gin_trgm_ops)",
+    "CREATE INDEX finance_expense_description_trgm_idx ON finance_expense USING gin (description gin_trgm_ops)",
+]
+
+REVERSE_SEARCH_SQL = [
+    "DROP INDEX IF EXISTS finance_expense_description_trgm_idx",
+    "DROP INDEX IF EXISTS finance_expense_project_officer_trgm_idx",
+    "DROP INDEX IF EXISTS finance_expense_activity_trgm_idx",
+    "DROP INDEX IF EXISTS finance_expense_project_name_trgm_idx",
+    "DROP INDEX IF EXISTS finance_expense_search_vector_idx",
+    "DROP TRIGGER IF EXISTS finance_expense_search_vector_update ON finance_expense",
+    "DROP FUNCTION IF EXISTS finance_expense_search_vector_trigger()",
+    "DROP FUNCTION IF EXISTS finance_expense_search_vector(text, text, text, text)",
+]
+
+def run_on_postgresql(statements):
+    # Other databases fall back to substring search and skip all of this
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0011_project_versions'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='expense',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(run_on_postgresql(SEARCH_SQL), run_on_postgresql(REVERSE_SEARCH_SQL)),
+    ]
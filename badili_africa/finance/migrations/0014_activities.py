@@ -0,0 +1,106 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:49
+
+import json
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def parse_blob(blob):
+    # Same rules as finance.activities.parse_activities, frozen here
+    try:
+        names = json.loads(blob)
+    except (TypeError, ValueError):
+        names = None
+    if not isinstance(names, list):
+        names = re.split(r'[,;\n]', str(blob or '').strip().strip('[]'))
+    unique = {}
+    for name in names:
+        name = str(name).strip().strip('"\'').strip()[:100]
+        if name:
+            unique.setdefault(name.casefold(), name)
+    return list(unique.values())
+
+def create_activities(apps, schema_editor):
+    # Activities listed in each project's blob, then any other name its
+    # expenses use. Expenses are linked per distinct name, and their name is
+    # rewritten to the activity's spelling when it only differed in case.
+    Project = apps.get_model('finance', 'Project')
+    Activity = apps.get_model('finance', 'Activity')
+    Expense = apps.get_model('finance', 'Expense')
+    db_alias = schema_editor.connection.alias
+
+    activities = {}
+    for project_id, blob in Project.objects.using(db_alias).values_list('id', 'activities').iterator():
+        for name in parse_blob(blob):
+            activities[(project_id, name.casefold())] = Activity(project_id=project_id, name=name)
+    used = Expense.objects.using(db_alias).values_list('project_id', 'activity').distinct().order_by()
+    for project_id, name in used.iterator():
+        name = name.strip()
+        if name:
+            activities.setdefault((project_id, name.casefold()), Activity(project_id=project_id, name=name))
+    Activity.objects.using(db_alias).bulk_create(activities.values(), batch_size=1000)
+
+    for project_id, name in used.iterator():
+        activity = activities.get((project_id, name.strip().casefold()))
+        if activity is not None:
+            Expense.objects.using(db_alias).filter(project_id=project_id, activity=name).update(activity_ref=activity.pk, activity=activity.name)
+
+def restore_blobs(apps, schema_editor):
+    Project = apps.get_model('finance', 'Project')
+    Activity = apps.get_model('finance', 'Activity')
+    db_alias = schema_editor.connection.alias
+
+    names = {}
+    for project_id, name in Activity.objects.using(db_alias).order_by('id').values_list('project_id', 'name').iterator():
+        names.setdefault(project_id, []).append(name)
+    for project_id, project_names in names.items():
+        Project.objects.using(db_alias).filter(pk=project_id).update(activities=json.dumps(project_names))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0013_receiptfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Activity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('budget', models.DecimalField(blank=True, decimal_places=2, max_digits=14, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='finance.project')),
+            ],
+            options={
+                'verbose_name_plural': 'activities',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='activity',
+            constraint=models.UniqueConstraint(fields=('project', 'name'), name='unique_project_activity'),
+        ),
+        migrations.AddField(
+            model_name='expense',
+            name='activity_ref',
+            field=models.ForeignKey(blank=True, db_index=False, default=None, null=True, on_delete=django.db.models.deletion.PROTECT, to='finance.activity'),
+        ),
+        migrations.RunPython(create_activities, restore_blobs),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['activity_ref', 'amount'], name='finance_exp_activit_d0f600_idx'),
+        ),
+        # A default lets the column be added back when migrating backwards
+        migrations.AlterField(
+            model_name='project',
+            name='activities',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.RemoveField(
+            model_name='project',
+            name='activities',
+        ),
+    ]
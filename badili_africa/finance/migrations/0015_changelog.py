@@ -0,0 +1,55 @@
+# Generated by Django 5.1.1 on 2026-10-17 19:55
+
+import itertools
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    # One entry per existing project, then per expense, so clients syncing
+    # from scratch get every row from the feed and projects before their
+    # expenses
+    Project = apps.get_model('finance', 'Project')
+    Expense = apps.get_model('finance', 'Expense')
+    ChangeLog = apps.get_model('finance', 'ChangeLog')
+    db_alias = schema_editor.connection.alias
+
+    rows = [
+        ('project', project_id, project_id)
+        for project_id in Project.objects.using(db_alias).order_by('pk').values_list('pk', flat=True).iterator()
+    ]
+    expenses = Expense.objects.using(db_alias).order_by('pk').values_list('pk', 'project_id').iterator()
+    batch = []
+    for kind, object_id, project_id in itertools.chain(rows, (('expense', *row) for row in expenses)):
+        batch.append(ChangeLog(kind=kind, object_id=object_id, project_id=project_id))
+        if len(batch) == 5000:
+            ChangeLog.objects.using(db_alias).bulk_create(batch)
+            batch = []
+    ChangeLog.objects.using(db_alias).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0014_activities'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('project', 'Project'), ('expense', 'Expense')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('project_id', models.BigIntegerField()),
+                ('txid', models.BigIntegerField(default=0)),
+                ('deleted', models.BooleanField(default=False)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['txid', 'seq'], name='finance_cha_txid_9f588f_idx'), models.Index(fields=['project_id', 'txid', 'seq'], name='finance_cha_project_3eede1_idx'), models.Index(fields=['kind', 'object_id'], name='finance_cha_kind_c56c30_idx')],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-17 20:09
+
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0015_changelog'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='activity',
+            name='unique_project_activity',
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='activity_ref',
+            field=models.ForeignKey(blank=True, db_index=False, default=None, null=True, on_delete=django.db.models.deletion.RESTRICT, to='finance.activity'),
+        ),
+        migrations.AddConstraint(
+            model_name='activity',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('name'), models.F('project'), name='unique_project_activity'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 20:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0016_activity_case_insensitive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='project',
+            name='status',
+            field=models.CharField(default='active', max_length=100),
+        ),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models
+import uuid
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, router, transaction
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractUser, Group, Permission
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .storage import receipt_storage
+
 class User(AbstractUser):
     alias = models.CharField(max_length=100)
     designation = models.CharField(max_length=100)
@@ -30,26 +36,217 @@ class User(AbstractUser):
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
 
-class Project(models.Model):
-    name = models.CharField(max_length=100)
+class AtomicSaveMixin:
+    # Runs the post_save receivers (rollups, the delta-sync log) in the
+    # transaction that writes the row, so both commit or roll back together.
+    # Deletions already send post_delete inside their transaction.
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            super().save(*args, **kwargs)
+
+class Project(AtomicSaveMixin, models.Model):
+    name = models.CharField(max_length=100, db_index=True)
     description = models.TextField()
-    activities = models.TextField()
     status = models.CharField(max_length=100 , default="active")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Bumped on every change to the project's expenses, for ETags and caching
+    expenses_version = models.BigIntegerField(default=0)
+    expenses_updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.name
+
+class Activity(models.Model):
+    # One of a project's activities, see finance.activities
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)
+    budget = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = "activities"
+        constraints = [
+            # Names are matched ignoring case
+            models.UniqueConstraint(Lower("name"), "project", name="unique_project_activity"),
+        ]
 
     def __str__(self):
         return self.name
 
-class Expense(models.Model):
+class Expense(AtomicSaveMixin, models.Model):
     project_id = models.ForeignKey(Project, on_delete=models.CASCADE, default=None)
     project_name = models.CharField(max_length=100)
+    # Indexed together with the amount below. An activity can only be
+    # deleted together with its expenses, e.g. when their project is.
+    activity_ref = models.ForeignKey(Activity, on_delete=models.RESTRICT, null=True, blank=True, default=None, db_index=False)
+    # Copy of the activity's name
     activity = models.CharField(max_length=100)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     description = models.TextField()
-    receipt = models.FileField(upload_to="receipts/")
+    receipt = models.FileField(upload_to="receipts/", storage=receipt_storage)
+    # Kinds of finance.imaging.DERIVATIVES already stored beside the receipt
+    receipt_derivatives = models.JSONField(default=list, blank=True)
     project_officer_id = models.ForeignKey(User, on_delete=models.CASCADE, default=None)
     project_officer = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Written by a PostgreSQL trigger from the searched columns, see
+    # finance.search; stays empty on other databases
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Newest-first listings, overall and per project or officer
+            models.Index(fields=["created_at", "id"]),
+            models.Index(fields=["project_id", "created_at", "id"]),
+            models.Index(fields=["project_officer_id", "created_at"]),
+            # Expenses sharing a receipt file
+            models.Index(fields=["receipt"]),
+            # Spend per activity, summed from the index alone
+            models.Index(fields=["activity_ref", "amount"]),
+        ]
+
+    def __str__(self):
+        return f"{self.project_id.name} - {self.amount}"
+
+class ExtractionJob(models.Model):
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    receipt = models.FileField(upload_to="extraction_jobs/")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    callback_url = models.URLField(blank=True)
+    submitted_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Earliest time a worker may pick the job up, pushed back on every retry
+    run_after = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Start of the current attempt; a running job claimed longer than
+    # EXTRACTION_JOB_LEASE ago is given to another worker
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Duration of the last attempt in milliseconds
+    run_ms = models.PositiveIntegerField(null=True, blank=True)
+    # Receipt size before and after image preprocessing
+    original_bytes = models.PositiveIntegerField(null=True, blank=True)
+    processed_bytes = models.PositiveIntegerField(null=True, blank=True)
+    preprocess_ms = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"]),
+        ]
+
+    def __str__(self):
+        return f"{self.id} - {self.status}"
+
+    @property
+    def queue_ms(self):
+        if not self.started_at:
+            return None
+        return int((self.started_at - self.created_at).total_seconds() * 1000)
+
+    @property
+    def total_ms(self):
+        if not self.finished_at:
+            return None
+        return int((self.finished_at - self.created_at).total_seconds() * 1000)
+
+class ExtractionCacheEntry(models.Model):
+    # sha256 of the receipt bytes
+    file_hash = models.CharField(max_length=64)
+    # finance.extraction.PROMPT_VERSION the result was produced with
+    prompt_version = models.CharField(max_length=16)
+    result = models.JSONField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["file_hash", "prompt_version"], name="unique_extraction_cache_key"),
+        ]
+        verbose_name_plural = "extraction cache entries"
+
+    def __str__(self):
+        return f"{self.file_hash[:12]} ({self.prompt_version})"
+
+class ReceiptFingerprint(models.Model):
+    # Perceptual hash of a receipt file, see finance.fingerprints
+    # sha256 of the receipt bytes
+    file_hash = models.CharField(max_length=64, unique=True)
+    # 64-bit dHash, stored signed
+    dhash = models.BigIntegerField()
+    # The hash in four 16-bit bands, each indexed, for near-duplicate lookups
+    band_0 = models.IntegerField(db_index=True)
+    band_1 = models.IntegerField(db_index=True)
+    band_2 = models.IntegerField(db_index=True)
+    band_3 = models.IntegerField(db_index=True)
+    # Stored receipt name, for files saved on an expense
+    receipt = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.file_hash[:12]} ({self.dhash & 0xFFFFFFFFFFFFFFFF:016x})"
+
+class ProjectSpendRollup(models.Model):
+    # Running totals per project, activity and calendar month, kept current by
+    # finance.rollups so spending summaries never scan the expense table
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="spend_rollups")
+    activity = models.CharField(max_length=100)
+    month = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    expense_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["project", "activity", "month"], name="unique_project_spend_rollup"),
+        ]
+
+    def __str__(self):
+        return f"{self.project_id} - {self.activity} - {self.month:%Y-%m}"
+
+class ChangeLog(models.Model):
+    # Latest change to every project and expense, for the delta-sync feed,
+    # see finance.sync. Tombstones of deleted rows are kept.
+    KIND_PROJECT = "project"
+    KIND_EXPENSE = "expense"
+    KIND_CHOICES = [
+        (KIND_PROJECT, "Project"),
+        (KIND_EXPENSE, "Expense"),
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    # Not a foreign key, so expense tombstones outlive their project
+    project_id = models.BigIntegerField()
+    # Id of the writing transaction on PostgreSQL, 0 elsewhere
+    txid = models.BigIntegerField(default=0)
+    deleted = models.BooleanField(default=False)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # The feed, overall and per project, in (txid, seq) order
+            models.Index(fields=["txid", "seq"]),
+            models.Index(fields=["project_id", "txid", "seq"]),
+            # Replacing an object's previous entry
+            models.Index(fields=["kind", "object_id"]),
+        ]
 
     def __str__(self):
-        return f"{self.project_id.name} - {self.amount}"
\ No newline at end of file
+        return f"{self.seq} {self.kind} {self.object_id}{' deleted' if self.deleted else ''}"
@@ -0,0 +1,54 @@
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ExpenseCursorPagination(CursorPagination):
+    # Keyset pagination, newest expenses first. Pages are found by seeking on
+    # the (created_at, id) index rather than with OFFSET, so deep pages cost
+    # the same as the first one and rows added meanwhile are not repeated.
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class SearchPagination(BasePagination):
+    # Ranked search results by page number. Rank order has no index to seek
+    # on, and instead of counting every match one extra row is fetched to
+    # tell whether there is a next page.
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    page_query_param = 'page'
+
+    def positive_int(self, request, name, default, cutoff=None):
+        try:
+            value = int(request.query_params[name])
+        except (KeyError, ValueError):
+            return default
+        if value < 1:
+            return default
+        return min(value, cutoff) if cutoff else value
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page = self.positive_int(request, self.page_query_param, 1)
+        size = self.positive_int(request, self.page_size_query_param, self.page_size, self.max_page_size)
+        offset = (self.page - 1) * size
+        rows = list(queryset[offset:offset + size + 1])
+        self.has_next = len(rows) > size
+        return rows[:size]
+
+    def page_link(self, page):
+        url = self.request.build_absolute_uri()
+        if page == 1:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, page)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.page_link(self.page + 1) if self.has_next else None,
+            'previous': self.page_link(self.page - 1) if self.page > 1 else None,
+            'results': data,
+        })
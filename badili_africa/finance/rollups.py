@@ -0,0 +1,155 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .caching import expenses_changed
+from .models import Expense, ProjectSpendRollup
+
+SUMMARY_CACHE_KEY = 'finance:spending:{}'
+ALL_PROJECTS = 'all'
+
+def month_of(created_at):
+    return timezone.localtime(created_at).date().replace(day=1)
+
+def rollup_key(project_id, activity, created_at):
+    return (project_id, activity, month_of(created_at))
+
+def apply_delta(key, amount, count):
+    project_id, activity, month = key
+    rollups = ProjectSpendRollup.objects.filter(project_id=project_id, activity=activity, month=month)
+    if rollups.update(total=F('total') + amount, expense_count=F('expense_count') + count):
+        if count < 0:
+            # Drop buckets whose last expense was removed
+            rollups.filter(expense_count__lte=0).delete()
+        return
+
+    # Nothing to subtract from (e.g. the project itself is being deleted)
+    if count <= 0:
+        return
+
+    try:
+        with transaction.atomic():
+            ProjectSpendRollup.objects.create(
+                project_id=project_id, activity=activity, month=month, total=amount, expense_count=count
+            )
+    except IntegrityError:
+        # Another request created the row first
+        rollups.update(total=F('total') + amount, expense_count=F('expense_count') + count)
+
+def expense_deltas(expenses, sign=1, deltas=None):
+    # Sum the rollup changes for adding (sign=1) or removing (sign=-1) expenses
+    if deltas is None:
+        deltas = defaultdict(lambda: [Decimal(0), 0])
+    for expense in expenses:
+        delta = deltas[rollup_key(expense.project_id_id, expense.activity, expense.created_at)]
+        delta[0] += Decimal(str(expense.amount)) * sign
+        delta[1] += sign
+    return deltas
+
+def apply_deltas(deltas):
+    # One update per affected project/activity/month
+    for key, (amount, count) in deltas.items():
+        apply_delta(key, amount, count)
+    project_ids = {project_id for project_id, _, _ in deltas}
+    invalidate_summaries(project_ids)
+    expenses_changed(project_ids)
+
+def apply_expenses(expenses, sign=1):
+    # For bulk paths that skip the save/delete signals
+    apply_deltas(expense_deltas(expenses, sign))
+
+def invalidate_summaries(project_ids):
+    keys = [SUMMARY_CACHE_KEY.format(project_id) for project_id in project_ids]
+    keys.append(SUMMARY_CACHE_KEY.format(ALL_PROJECTS))
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+def _money(value):
+    return f"{value:.2f}"
+
+def project_summary(project):
+    key = SUMMARY_CACHE_KEY.format(project.pk)
+    summary = cache.get(key)
+    if summary is not None:
+        return summary
+
+    # One row per activity and month; everything else is folded from those
+    activities = defaultdict(lambda: [Decimal(0), 0])
+    months = defaultdict(lambda: [Decimal(0), 0])
+    for activity, month, total, count in ProjectSpendRollup.objects.filter(project=project).values_list(
+        'activity', 'month', 'total', 'expense_count'
+    ):
+        for bucket in (activities[activity], months[month.strftime('%Y-%m')]):
+            bucket[0] += total
+            bucket[1] += count
+
+    summary = {
+        'project_id': project.pk,
+        'project_name': project.name,
+        'total': _money(sum(total for total, _ in activities.values())),
+        'expense_count': sum(count for _, count in activities.values()),
+        'activities': [
+            {'activity': activity, 'total': _money(total), 'expense_count': count}
+            for activity, (total, count) in sorted(activities.items())
+        ],
+        'months': [
+            {'month': month, 'total': _money(total), 'expense_count': count}
+            for month, (total, count) in sorted(months.items())
+        ],
+    }
+    cache.set(key, summary, settings.SPENDING_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+def all_projects_summary():
+    key = SUMMARY_CACHE_KEY.format(ALL_PROJECTS)
+    summary = cache.get(key)
+    if summary is not None:
+        return summary
+
+    summary = [
+        {
+            'project_id': row['project_id'],
+            'project_name': row['project__name'],
+            'total': _money(row['total']),
+            'expense_count': row['expense_count'],
+        }
+        for row in ProjectSpendRollup.objects.values('project_id', 'project__name').annotate(
+            total=Sum('total'), expense_count=Sum('expense_count')
+        ).order_by('project_id')
+    ]
+    cache.set(key, summary, settings.SPENDING_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+def rebuild(project_ids=None):
+    # Recompute the rollups from the expense table
+    expenses = Expense.objects.all()
+    rollups = ProjectSpendRollup.objects.all()
+    if project_ids:
+        expenses = expenses.filter(project_id__in=project_ids)
+        rollups = rollups.filter(project_id__in=project_ids)
+
+    rows = expenses.annotate(month=TruncMonth('created_at')).values('project_id', 'activity', 'month').annotate(
+        total=Sum('amount'), expense_count=Count('id')
+    ).order_by()
+
+    rollups.delete()
+    created = ProjectSpendRollup.objects.bulk_create(
+        (
+            ProjectSpendRollup(
+                project_id=row['project_id'],
+                activity=row['activity'],
+                month=timezone.localtime(row['month']).date(),
+                total=row['total'],
+                expense_count=row['expense_count']
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000
+    )
+    invalidate_summaries(project_ids or [])
+    return len(created)
@@ -0,0 +1,25 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Set by ReplicaRoutingMiddleware for requests whose reads may be served by a
+# replica. Everything else (writes, background jobs, management commands and
+# clients that wrote recently) reads from the primary.
+read_from_replica = ContextVar('finance_read_from_replica', default=False)
+
+
+class ReplicaRouter:
+    # Sends reads to a random DATABASE_REPLICAS alias while read_from_replica
+    # is set, and every write to the primary
+    def db_for_read(self, model, **hints):
+        if settings.DATABASE_REPLICAS and read_from_replica.get():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
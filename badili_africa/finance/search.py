@@ -0,0 +1,58 @@
+from functools import reduce
+from operator import and_, or_
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connections
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from .models import Expense
+
+# Ranked free-text search over expenses. On PostgreSQL, Expense.search_vector
+# is kept current by a trigger (migration 0012) and GIN-indexed, so matching
+# never scans the table. Queries with no full-text match, typically typos,
+# fall back to trigram word similarity on the searched columns, each of which
+# has its own trigram index. Other databases get a plain substring search.
+
+# Same text search configuration as the trigger
+SEARCH_CONFIG = 'english'
+SEARCH_FIELDS = ['project_name', 'activity', 'project_officer', 'description']
+
+def filter_expenses(queryset, min_amount=None, max_amount=None, date_from=None, date_to=None, project_id=None):
+    if min_amount is not None:
+        queryset = queryset.filter(amount__gte=min_amount)
+    if max_amount is not None:
+        queryset = queryset.filter(amount__lte=max_amount)
+    if date_from is not None:
+        queryset = queryset.filter(created_at__date__gte=date_from)
+    if date_to is not None:
+        queryset = queryset.filter(created_at__date__lte=date_to)
+    if project_id is not None:
+        queryset = queryset.filter(project_id=project_id)
+    return queryset
+
+def search_expenses(q, queryset=None):
+    # Best matches first, newest first among equals. Without `q`, just the
+    # newest expenses.
+    queryset = Expense.objects.all() if queryset is None else queryset
+    if not q:
+        return queryset.order_by('-created_at', '-id')
+    if connections[queryset.db].vendor != 'postgresql':
+        return substring_search(queryset, q)
+
+    query = SearchQuery(q, search_type='websearch', config=SEARCH_CONFIG)
+    matches = queryset.filter(search_vector=query)
+    if matches.exists():
+        return matches.annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', '-created_at', '-id')
+
+    similar = reduce(or_, [Q(**{f'{field}__trigram_word_similar': q}) for field in SEARCH_FIELDS])
+    similarity = Greatest(*[TrigramWordSimilarity(q, field) for field in SEARCH_FIELDS])
+    return queryset.filter(similar).annotate(rank=similarity).order_by('-rank', '-created_at', '-id')
+
+def substring_search(queryset, q):
+    # Every word must appear in one of the searched columns
+    words = [
+        reduce(or_, [Q(**{f'{field}__icontains': word}) for field in SEARCH_FIELDS])
+        for word in q.split()
+    ]
+    return queryset.filter(reduce(and_, words)).order_by('-created_at', '-id')
@@ -1,6 +1,10 @@
+from django.db import transaction
 from rest_framework import serializers
-from .models import User, Project, Expense
-from django.contrib.auth import authenticate
+from .models import User, Project, Activity, Expense, ExtractionJob
+from .activities import activity_for, format_activities, parse_activities, set_activities
+from .storage import RECEIPT_KEY_PATTERN, receipt_name, receipt_storage
+from .derivatives import derivative_url
+from .login import authenticate_login
 from django.contrib.auth.password_validation import validate_password
 
 class UserSerializer(serializers.ModelSerializer):
@@ -47,22 +51,142 @@ class LoginSerializer(serializers.Serializer):
     password = serializers.CharField()
 
     def validate(self, data):
-        user = authenticate(**data)
-        if user and user.is_active:
+        user = authenticate_login(data['username'], data['password'])
+        if user:
             return user
         raise serializers.ValidationError("Incorrect Credentials")
 
+class ActivityNamesField(serializers.Field):
+    # A project's activity names in the text format of the old
+    # Project.activities column: written as a JSON array, a comma or line
+    # separated list, or a list; read back as a JSON array
+    def to_representation(self, activities):
+        return format_activities([activity.name for activity in sorted(activities.all(), key=lambda a: a.pk)])
+
+    def to_internal_value(self, data):
+        if not isinstance(data, (str, list)):
+            raise serializers.ValidationError("Expected a list of activity names.")
+        return parse_activities(data)
+
 class ProjectSerializer(serializers.ModelSerializer):
+    activities = ActivityNamesField(source='activity_set')
+
     class Meta:
         model = Project
-        fields = '__all__'
+        exclude = ['expenses_version', 'expenses_updated_at']
+
+    def create(self, validated_data):
+        names = validated_data.pop('activity_set', [])
+        with transaction.atomic():
+            project = super().create(validated_data)
+            set_activities(project, names)
+        return project
+
+    def update(self, instance, validated_data):
+        names = validated_data.pop('activity_set', None)
+        with transaction.atomic():
+            project = super().update(instance, validated_data)
+            if names is not None:
+                set_activities(project, names)
+        return project
+
+class ActivitySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Activity
+        fields = ['id', 'name', 'budget', 'created_at']
+        read_only_fields = ('created_at',)
 
 class ExpenseSerializer(serializers.ModelSerializer):
+    # Key of a receipt the client already uploaded straight to storage, sent
+    # instead of the receipt file itself
+    receipt_key = serializers.CharField(write_only=True, required=False)
+    thumbnail = serializers.SerializerMethodField()
+    thumbnail_webp = serializers.SerializerMethodField()
+    preview = serializers.SerializerMethodField()
+    activity_id = serializers.PrimaryKeyRelatedField(source='activity_ref', read_only=True)
+
+    def __init__(self, *args, **kwargs):
+        # Optionally only output the given subset of fields
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
     class Meta:
         model = Expense
-        fields = ['id', 'project_name', 'activity', 'amount', 'description', 'receipt', 'created_at' , 'project_officer_id', 'project_officer']
+        fields = ['id', 'project_name', 'activity', 'activity_id', 'amount', 'description', 'receipt', 'receipt_key', 'thumbnail', 'thumbnail_webp', 'preview', 'created_at' , 'project_officer_id', 'project_officer']
         read_only_fields = ('project_officer_id', 'project_officer' , 'created_at')
+        extra_kwargs = {'receipt': {'required': False}}
+
+    def get_thumbnail(self, obj):
+        return derivative_url(obj, 'thumbnail', self.context.get('request'))
+
+    def get_thumbnail_webp(self, obj):
+        return derivative_url(obj, 'thumbnail_webp', self.context.get('request'))
+
+    def get_preview(self, obj):
+        return derivative_url(obj, 'preview', self.context.get('request'))
+
+    def validate(self, attrs):
+        receipt_key = attrs.pop('receipt_key', None)
+        if receipt_key:
+            if not RECEIPT_KEY_PATTERN.match(receipt_key) or not receipt_storage().exists(receipt_key):
+                raise serializers.ValidationError({"receipt_key": ["No uploaded receipt with this key."]})
+            attrs['receipt'] = receipt_key
+        elif self.instance is None and not attrs.get('receipt'):
+            raise serializers.ValidationError({"receipt": ["No file was submitted."]})
+        return attrs
+
+    def link_activity(self, validated_data, project):
+        # Point the expense at its project's activity, see finance.activities
+        activity = activity_for(project, validated_data['activity'])
+        validated_data['activity_ref'] = activity
+        if activity is not None:
+            validated_data['activity'] = activity.name
 
     def create(self, validated_data):
         validated_data['project_officer_id'] = self.context['request'].user
-        return super().create(validated_data)
\ No newline at end of file
+        self.link_activity(validated_data, validated_data['project_id'])
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        if 'activity' in validated_data:
+            self.link_activity(validated_data, instance.project_id)
+        return super().update(instance, validated_data)
+
+class ExtractionJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.UUIDField(source='id', read_only=True)
+    queue_ms = serializers.IntegerField(read_only=True)
+    total_ms = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = ExtractionJob
+        fields = ['job_id', 'status', 'result', 'error', 'attempts', 'created_at', 'started_at', 'finished_at', 'queue_ms', 'run_ms', 'total_ms', 'original_bytes', 'processed_bytes', 'preprocess_ms']
+        read_only_fields = fields
+
+class ExpenseImportSerializer(serializers.Serializer):
+    # One row of a bulk import; the receipt is the key of an uploaded receipt
+    # or, as in exports, a URL of one
+    project_name = serializers.CharField(max_length=100)
+    activity = serializers.CharField(max_length=100)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+    description = serializers.CharField(allow_blank=True, required=False, default='')
+    receipt = serializers.CharField(allow_blank=True, required=False, default='', max_length=2000)
+
+    def validate_receipt(self, value):
+        if not value:
+            return value
+        name = receipt_name(value)
+        if not RECEIPT_KEY_PATTERN.match(name) or not receipt_storage().exists(name):
+            raise serializers.ValidationError("No uploaded receipt with this key.")
+        return name
+
+class ExpenseSearchSerializer(serializers.Serializer):
+    # Query parameters of the expense search
+    q = serializers.CharField(max_length=200, required=False, allow_blank=True, default='')
+    min_amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    max_amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    project_id = serializers.IntegerField(required=False)
@@ -0,0 +1,108 @@
+from decimal import Decimal
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .caching import expenses_changed
+from .denormalization import COPIES, schedule_propagation
+from .derivatives import schedule_derivatives
+from .fingerprints import schedule_fingerprint
+from .models import Expense, Project, User
+from .rollups import apply_delta, invalidate_summaries, rollup_key
+from .sync import EXPENSE, PROJECT, record_change
+from .token_cache import invalidate_tokens
+
+# Keep the spending rollups in step with every saved or deleted expense.
+# Queryset update()/delete() and bulk_create() bypass these signals, so code
+# using them must call finance.rollups.apply_expenses() itself.
+
+@receiver(pre_save, sender=Expense)
+def remember_previous_expense(sender, instance, raw=False, **kwargs):
+    instance._rollup_previous = None
+    if raw or instance.pk is None:
+        return
+    instance._rollup_previous = Expense.objects.filter(pk=instance.pk).values(
+        'project_id', 'activity', 'amount', 'created_at'
+    ).first()
+
+@receiver(post_save, sender=Expense)
+def add_expense_to_rollups(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    project_ids = {instance.project_id_id}
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous:
+        project_ids.add(previous['project_id'])
+        apply_delta(
+            rollup_key(previous['project_id'], previous['activity'], previous['created_at']),
+            -previous['amount'], -1
+        )
+    apply_delta(rollup_key(instance.project_id_id, instance.activity, instance.created_at), Decimal(str(instance.amount)), 1)
+    invalidate_summaries(project_ids)
+    expenses_changed(project_ids)
+
+    record_change(EXPENSE, instance.pk, instance.project_id_id)
+
+    if created:
+        schedule_derivatives(instance.receipt.name)
+        schedule_fingerprint(instance.receipt.name)
+
+@receiver(post_delete, sender=Expense)
+def remove_expense_from_rollups(sender, instance, **kwargs):
+    apply_delta(rollup_key(instance.project_id_id, instance.activity, instance.created_at), -Decimal(str(instance.amount)), -1)
+    invalidate_summaries({instance.project_id_id})
+    expenses_changed({instance.project_id_id})
+    record_change(EXPENSE, instance.pk, instance.project_id_id, deleted=True)
+
+
+# Every project write and deletion goes into the delta-sync feed. Expenses
+# are logged above; bulk paths call finance.sync.record_changes() themselves.
+
+@receiver(post_save, sender=Project)
+def log_project_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        record_change(PROJECT, instance.pk, instance.pk)
+
+@receiver(post_delete, sender=Project)
+def log_project_deletion(sender, instance, **kwargs):
+    record_change(PROJECT, instance.pk, instance.pk, deleted=True)
+
+
+# Drop cached authentication as soon as a token is rotated or removed, or its
+# user changes (e.g. is deactivated)
+
+@receiver([post_save, post_delete], sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    invalidate_tokens(instance.key)
+
+@receiver(post_save, sender=User)
+def invalidate_cached_user_tokens(sender, instance, created, raw=False, **kwargs):
+    if created or raw:
+        return
+    invalidate_tokens(*Token.objects.filter(user_id=instance.pk).values_list('key', flat=True))
+
+
+# Push project renames and officer name changes to the copies on Expense
+
+def copied_fields(model):
+    return {field: source_field for field, (foreign_key, source, source_field) in COPIES.items() if source is model}
+
+@receiver(pre_save, sender=Project)
+@receiver(pre_save, sender=User)
+def remember_copied_values(sender, instance, raw=False, **kwargs):
+    instance._copied_previous = None
+    if raw or instance.pk is None:
+        return
+    instance._copied_previous = sender.objects.filter(pk=instance.pk).values(*copied_fields(sender).values()).first()
+
+@receiver(post_save, sender=Project)
+@receiver(post_save, sender=User)
+def propagate_copied_values(sender, instance, created, raw=False, **kwargs):
+    previous = getattr(instance, '_copied_previous', None)
+    if created or raw or not previous:
+        return
+    for field, source_field in copied_fields(sender).items():
+        if previous[source_field] != getattr(instance, source_field):
+            schedule_propagation(field, instance.pk)
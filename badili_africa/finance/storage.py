@@ -0,0 +1,149 @@
+import base64
+import posixpath
+import re
+from urllib.parse import unquote, urlsplit
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .uploads import inspect_upload
+
+try:
+    from botocore.exceptions import ClientError
+    from storages.backends.s3 import S3Storage
+    from storages.utils import clean_name
+except ImportError:  # django-storages[s3] is only needed for RECEIPT_STORAGE=s3
+    S3Storage = None
+
+# Receipts are stored under the SHA-256 of their content, so uploading the
+# same file twice stores it once and every expense points at the same object
+RECEIPT_KEY_PATTERN = re.compile(r'^receipts/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]+)$')
+
+# A receipt key at the end of a URL path, as in the URLs exports carry
+RECEIPT_URL_KEY_PATTERN = re.compile(r'(receipts/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+)$')
+
+SIGNING_SALT = 'finance.receipts'
+
+def receipt_key(sha256, extension, directory='receipts'):
+    return posixpath.join(directory, sha256[:2], sha256 + extension.lower())
+
+def receipt_name(value):
+    # Storage key of a receipt given either as its key or as a (signed) URL
+    # of it; anything else is returned unchanged
+    match = RECEIPT_URL_KEY_PATTERN.search(unquote(urlsplit(value).path))
+    return match.group(1) if match else value
+
+def sign_receipt(name):
+    # "<timestamp>:<signature>" for `name`; checked by verify_receipt_signature
+    return signing.TimestampSigner(salt=SIGNING_SALT).sign(name)[len(name) + 1:]
+
+def verify_receipt_signature(name, signature, max_age=None):
+    try:
+        signing.TimestampSigner(salt=SIGNING_SALT).unsign(
+            f'{name}:{signature}',
+            max_age=settings.RECEIPT_URL_EXPIRY if max_age is None else max_age
+        )
+    except signing.BadSignature:
+        return False
+    return True
+
+def signed_url(view_name, name):
+    return f"{reverse(view_name, args=[name])}?{urlencode({'signature': sign_receipt(name)})}"
+
+
+class ContentHashMixin:
+    # Renames every saved file to receipts/<sha[:2]>/<sha><ext> and skips the
+    # write when that object already exists
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        directory, filename = posixpath.split(name.replace('\\', '/'))
+        stem, extension = posixpath.splitext(filename)
+        sha256 = inspect_upload(content)['sha256']
+        # Names that already are content keys (direct uploads) are kept
+        if stem != sha256:
+            name = receipt_key(sha256, extension, directory or 'receipts')
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    def save_derivative(self, name, content):
+        # Files made from a stored receipt keep the exact name they are given
+        return super().save(name, content)
+
+    def upload_target(self, name, sha256, content_type):
+        # Where a client should send the bytes of a new receipt itself
+        return {
+            'method': 'PUT',
+            'url': signed_url('receipt_upload', name),
+            'headers': {'Content-Type': content_type},
+        }
+
+
+class LocalReceiptStorage(ContentHashMixin, FileSystemStorage):
+    # MEDIA_ROOT storage whose URLs, with RECEIPT_SIGNED_URLS on, point at the
+    # signed download view so the web server can send the file
+    def url(self, name):
+        if not settings.RECEIPT_SIGNED_URLS:
+            return super().url(name)
+        return signed_url('receipt_download', name)
+
+
+if S3Storage is not None:
+    class S3ReceiptStorage(ContentHashMixin, S3Storage):
+        # S3-compatible bucket (AWS, MinIO, ...). url() returns presigned GET
+        # URLs and clients PUT new receipts straight to the bucket.
+        def exists(self, name):
+            # S3Storage.exists() always answers False while file_overwrite is
+            # on; deduplication needs to know whether the key is really there
+            try:
+                self.connection.meta.client.head_object(
+                    Bucket=self.bucket_name, Key=self._normalize_name(clean_name(name))
+                )
+            except ClientError as e:
+                if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                    return False
+                raise
+            return True
+
+        def upload_target(self, name, sha256, content_type):
+            # The checksum makes the bucket reject bytes that do not match the
+            # hash the key was derived from
+            checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+            url = self.bucket.meta.client.generate_presigned_url(
+                'put_object',
+                Params={
+                    'Bucket': self.bucket_name,
+                    'Key': self._normalize_name(clean_name(name)),
+                    'ContentType': content_type,
+                    'ChecksumSHA256': checksum,
+                },
+                ExpiresIn=settings.RECEIPT_URL_EXPIRY,
+            )
+            return {
+                'method': 'PUT',
+                'url': url,
+                'headers': {'Content-Type': content_type, 'x-amz-checksum-sha256': checksum},
+            }
+
+
+_receipt_storage = None
+
+def receipt_storage():
+    # Storage for Expense.receipt, chosen by RECEIPT_STORAGE
+    global _receipt_storage
+    if _receipt_storage is None:
+        if settings.RECEIPT_STORAGE == 's3':
+            if S3Storage is None:
+                raise ImproperlyConfigured("RECEIPT_STORAGE=s3 needs django-storages[s3] installed.")
+            _receipt_storage = S3ReceiptStorage(querystring_expire=settings.RECEIPT_URL_EXPIRY)
+        elif settings.RECEIPT_STORAGE == 'local':
+            _receipt_storage = LocalReceiptStorage()
+        else:
+            raise ImproperlyConfigured(f"Unknown RECEIPT_STORAGE {settings.RECEIPT_STORAGE!r}, use 'local' or 's3'.")
+    return _receipt_storage
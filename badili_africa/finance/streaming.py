@@ -0,0 +1,70 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.http import StreamingHttpResponse
+
+from .models import Expense
+
+# Columns of an exported expense, matching ExpenseSerializer's fields
+EXPENSE_EXPORT_FIELDS = ['id', 'project_name', 'activity', 'activity_id', 'amount', 'description', 'receipt', 'created_at', 'project_officer_id', 'project_officer']
+# Exported columns named differently from the model field they come from
+EXPENSE_EXPORT_SOURCES = {'activity_id': 'activity_ref'}
+
+def export_rows(queryset, fields=EXPENSE_EXPORT_FIELDS, chunk_size=2000):
+    # Plain dicts straight from the database cursor, fetched in chunks so the
+    # full result set is never loaded at once
+    receipt_storage = Expense._meta.get_field('receipt').storage
+    renamed = {field: F(EXPENSE_EXPORT_SOURCES[field]) for field in fields if field in EXPENSE_EXPORT_SOURCES}
+    rows = queryset.order_by('id').values(*(field for field in fields if field not in renamed), **renamed)
+    for row in rows.iterator(chunk_size=chunk_size):
+        if renamed:
+            # Renamed columns come last from values(); keep the export's order
+            row = {field: row[field] for field in fields}
+        if 'receipt' in row:
+            row['receipt'] = receipt_storage.url(row['receipt']) if row['receipt'] else None
+        if 'amount' in row:
+            row['amount'] = f"{row['amount']:.2f}"
+        yield row
+
+def stream_json_array(rows):
+    # Render an iterable of dicts as one JSON array, a row at a time
+    yield '['
+    for index, row in enumerate(rows):
+        yield (',' if index else '') + json.dumps(row, cls=DjangoJSONEncoder)
+    yield ']'
+
+def stream_ndjson(rows):
+    # One JSON object per line, the format the bulk import reads back
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+class Echo:
+    # csv.writer target that hands each rendered line straight back
+    def write(self, value):
+        return value
+
+def stream_csv(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+def json_export_response(rows, filename):
+    response = StreamingHttpResponse(stream_json_array(rows), content_type='application/json')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+def export_response(rows, fields, export_type, basename):
+    # Stream `rows` as a JSON array, JSON Lines or CSV download
+    if export_type == 'csv':
+        content, content_type, extension = stream_csv(rows, fields), 'text/csv', 'csv'
+    elif export_type in ('ndjson', 'jsonl'):
+        content, content_type, extension = stream_ndjson(rows), 'application/x-ndjson', 'ndjson'
+    else:
+        return json_export_response(rows, f'{basename}.json')
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{basename}.{extension}"'
+    return response
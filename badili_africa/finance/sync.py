@@ -0,0 +1,98 @@
+from django.db import connections, router, transaction
+from django.db.models import Q
+
+from .models import ChangeLog
+
+# Delta sync for offline clients. Every write to a project or expense
+# replaces that row's entry in ChangeLog, so the log holds one entry per row
+# (tombstones included) and a client's cursor points into it: a sync reads
+# the entries after the cursor along an index, then the few rows they name.
+#
+# Sequence numbers are handed out when rows are inserted, not when their
+# transaction commits, so a reader could see seq 11 committed while seq 10 is
+# still in flight and skip it for good. On PostgreSQL entries are therefore
+# ordered by the writing transaction's id first, and only entries of
+# transactions older than every transaction still running are served: later
+# commits always sort after them. Other databases run one write at a time
+# and order by seq alone.
+
+PROJECT = ChangeLog.KIND_PROJECT
+EXPENSE = ChangeLog.KIND_EXPENSE
+
+# Entries replaced per DELETE/INSERT pair by record_changes()
+RECORD_BATCH_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def current_txid(using):
+    if connections[using].vendor != 'postgresql':
+        return 0
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT txid_current()')
+        return cursor.fetchone()[0]
+
+def record_changes(kind, rows, deleted=False):
+    # `rows` are (object id, project id) pairs of written or deleted rows.
+    # Callers run it in the writing transaction (model saves and deletions
+    # send their signals inside it), so the entries carry that transaction's
+    # id and rolled back writes leave none. The block below keeps the id and
+    # every batch together even when a caller is in autocommit.
+    rows = list(rows)
+    if not rows:
+        return
+    using = router.db_for_write(ChangeLog)
+    with transaction.atomic(using=using, savepoint=False):
+        txid = current_txid(using)
+        for start in range(0, len(rows), RECORD_BATCH_SIZE):
+            batch = rows[start:start + RECORD_BATCH_SIZE]
+            ChangeLog.objects.using(using).filter(kind=kind, object_id__in=[object_id for object_id, _ in batch]).delete()
+            ChangeLog.objects.using(using).bulk_create([
+                ChangeLog(kind=kind, object_id=object_id, project_id=project_id, txid=txid, deleted=deleted)
+                for object_id, project_id in batch
+            ])
+
+def record_change(kind, object_id, project_id, deleted=False):
+    record_changes(kind, [(object_id, project_id)], deleted)
+
+def format_cursor(txid, seq):
+    return f"{txid}-{seq}"
+
+def parse_cursor(value):
+    # (txid, seq) of the last entry a client has, or None to start over
+    if not value:
+        return None
+    try:
+        txid, seq = (int(part) for part in value.split('-'))
+    except ValueError:
+        raise InvalidCursor("Invalid sync cursor.")
+    return txid, seq
+
+def settled_txid(using):
+    # Transactions below this id have all finished; None if there is no limit
+    if connections[using].vendor != 'postgresql':
+        return None
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        return cursor.fetchone()[0]
+
+def changes_since(cursor, project_id=None, limit=500):
+    # Up to `limit` entries after `cursor`, oldest first, and whether more
+    # are waiting. Without a cursor the client has nothing to delete, so
+    # tombstones are skipped.
+    using = router.db_for_read(ChangeLog)
+    entries = ChangeLog.objects.using(using).order_by('txid', 'seq')
+    if cursor is None:
+        entries = entries.filter(deleted=False)
+    else:
+        txid, seq = cursor
+        entries = entries.filter(Q(txid__gt=txid) | Q(txid=txid, seq__gt=seq))
+    if project_id is not None:
+        entries = entries.filter(project_id=project_id)
+    settled = settled_txid(using)
+    if settled is not None:
+        entries = entries.filter(txid__lt=settled)
+    rows = list(entries.values_list('txid', 'seq', 'kind', 'object_id', 'deleted')[:limit + 1])
+    return rows[:limit], len(rows) > limit
@@ -1,3 +1,2099 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import Future
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import RestrictedError, Sum
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+
+from .clients import CircuitBreaker, CircuitOpenError, ProviderClient
+from .extractors import aprocess_receipt_with_gpt, process_receipt_with_gpt
+from .models import Activity, ChangeLog, Expense, ExtractionCacheEntry, ExtractionJob, Project, ProjectSpendRollup, ReceiptFingerprint, User
+from . import async_views, batch, denormalization, derivatives, extraction, extraction_cache, imaging, uploads
+from .activities import activity_for, link_activities, parse_activities, set_activities
+from .derivatives import derivative_name
+from .extraction import extract_receipt
+from .extraction_cache import cache_stats, get_cached_result
+from .importing import import_expenses
+from .jobs import claim_job, pending_job_ids, run_job, submit_job
+from . import extractors
+from . import fingerprints
+from .imaging import SPOOL_SIZE, Image, pdfium
+from . import metrics
+from .benchmarking import compare, run_scenario, seed
+from .middleware import ReplicaRoutingMiddleware
+from .routers import ReplicaRouter, read_from_replica
+from .sync import EXPENSE, record_changes
+from .storage import LocalReceiptStorage, S3Storage, receipt_key, receipt_storage
+from .token_cache import TokenCache, get_token_cache
+from badili_africa import urls
+
+
+class StubServer(ThreadingHTTPServer):
+    # Local HTTP server for the stub handlers below, on a free port and
+    # serving from a background thread until stop()
+    daemon_threads = True
+
+    def __init__(self, handler, **attributes):
+        super().__init__(('127.0.0.1', 0), handler)
+        for name, value in attributes.items():
+            setattr(self, name, value)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections (timeouts, closed pools)
+        # are expected here, anything else is still reported
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    # Minimal stand-in for the model provider's chat completions endpoint
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        server.connections.add(self.client_address)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append(json.loads(body))
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        response = json.dumps(server.response).encode('utf-8')
+        self.send_response(server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def stub_provider(response):
+    # A model provider answering every request with `response`
+    return StubServer(StubProviderHandler, connections=set(), requests=[], delay=0, status=200, response=response)
+
+
+class ProviderClientTests(SimpleTestCase):
+    def setUp(self):
+        self.server = stub_provider({'ok': True})
+        self.client = ProviderClient(
+            f'{self.server.url}/v1/',
+            timeout=1,
+            breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_post_json_reuses_connection(self):
+        for i in range(3):
+            self.assertEqual(self.client.post_json('chat/completions', {'n': i}), {'ok': True})
+
+        self.assertEqual(self.server.requests, [{'n': 0}, {'n': 1}, {'n': 2}])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_apost_json(self):
+        async def post_all():
+            return await asyncio.gather(*(
+                self.client.apost_json('chat/completions', {'n': i}) for i in range(3)
+            ))
+
+        self.assertEqual(asyncio.run(post_all()), [{'ok': True}] * 3)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        self.server.status = 503
+        self.server.response = {'error': {'message': 'overloaded'}}
+        for _ in range(2):
+            self.client.post_json('chat/completions', {})
+
+        with self.assertRaises(CircuitOpenError):
+            self.client.post_json('chat/completions', {})
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_timeout_counts_as_failure(self):
+        self.server.delay = 1.5
+        with self.assertRaises(httpx.TimeoutException):
+            self.client.post_json('chat/completions', {})
+        self.assertEqual(self.client.breaker.failures, 1)
+
+    def test_cancelled_trial_call_releases_the_breaker(self):
+        breaker = self.client.breaker
+        breaker.state, breaker.opened_at = breaker.OPEN, time.monotonic() - 60
+        self.server.delay = 0.5
+
+        async def cancel_trial():
+            call = asyncio.create_task(self.client.apost_json('chat/completions', {}))
+            await asyncio.sleep(0.1)
+            self.assertEqual(breaker.state, breaker.HALF_OPEN)
+            call.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await call
+
+        asyncio.run(cancel_trial())
+        self.server.delay = 0
+        self.assertEqual(self.client.post_json('chat/completions', {}), {'ok': True})
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_lost_trial_call_gives_way_after_the_reset_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        with mock.patch('finance.clients.time.monotonic', return_value=100):
+            breaker.record_failure()
+        with mock.patch('finance.clients.time.monotonic', return_value=160):
+            breaker.before_call()
+            with self.assertRaises(CircuitOpenError):
+                breaker.before_call()
+        with mock.patch('finance.clients.time.monotonic', return_value=220):
+            breaker.before_call()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+
+    def test_process_receipt_streams_base64_body(self):
+        self.server.response = {
+            'choices': [{'message': {'content': '```json\n{"amount": 12.5, "description": "Fuel"}\n```'}}]
+        }
+        receipt = bytes(range(256)) * 1000
+
+        with mock.patch('finance.extractors.get_provider_client', return_value=self.client):
+            self.assertEqual(process_receipt_with_gpt(receipt, 'image/png'), {'amount': 12.5, 'description': 'Fuel'})
+            self.assertEqual(
+                asyncio.run(aprocess_receipt_with_gpt(receipt, 'image/png')),
+                {'amount': 12.5, 'description': 'Fuel'}
+            )
+
+        for request in self.server.requests:
+            url = request['messages'][1]['content'][1]['image_url']['url']
+            prefix, encoded = url.split(',', 1)
+            self.assertEqual(prefix, 'data:image/png;base64')
+            self.assertEqual(base64.b64decode(encoded), receipt)
+
+
+class ReceiptUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+
+    @override_settings(RECEIPT_FINGERPRINTS_ENABLED=False)
+    def test_only_receipt_endpoints_use_the_receipt_handler(self):
+        received = []
+        new_file = uploads.ReceiptUploadHandler.new_file
+        with mock.patch.object(uploads.ReceiptUploadHandler, 'new_file', autospec=True, side_effect=new_file) as handled, \
+                mock.patch('finance.views.extract_receipt', side_effect=lambda file, **kwargs: received.append(file) or {'amount': 1}):
+            response = self.client.post('/api/file/', {'receipt': SimpleUploadedFile('fuel.jpg', JPEG)})
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(handled.call_count, 1)
+
+            self.client.post('/api/expenses/import/', {'file': SimpleUploadedFile('expenses.csv', b'project_name,activity,amount\n')})
+            self.assertEqual(handled.call_count, 1)
+
+        # Even small receipts go to disk, already hashed and sniffed
+        self.assertIsInstance(received[0], TemporaryUploadedFile)
+        self.assertEqual((received[0].sha256, received[0].file_type), (hashlib.sha256(JPEG).hexdigest(), 'jpeg'))
+
+    def test_large_bodies_are_parsed_in_bounded_memory(self):
+        content = b'%PDF-' + os.urandom(8 * 1024 * 1024)
+        request = Request(RequestFactory().post('/api/file/', {'receipt': SimpleUploadedFile('receipt.pdf', content)}), parsers=[uploads.ReceiptMultiPartParser()])
+
+        tracemalloc.start()
+        try:
+            receipt = request.FILES['receipt']
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.addCleanup(receipt.close)
+        self.assertLess(peak, 1024 * 1024)
+        self.assertIsInstance(receipt, TemporaryUploadedFile)
+        self.assertEqual((receipt.sha256, receipt.file_type), (hashlib.sha256(content).hexdigest(), 'pdf'))
+
+    def test_base64_json_body(self):
+        for size in (0, 1, 2, 3, 4, uploads.CHUNK_SIZE * 3 + 1, 500000):
+            content = os.urandom(size)
+            body = uploads.Base64JSONBody({'model': 'm', 'data': 'PLACEHOLDER'}, 'PLACEHOLDER', io.BytesIO(content), size)
+            encoded = body.read()
+            self.assertEqual(len(encoded), len(body))
+            self.assertEqual(json.loads(encoded), {'model': 'm', 'data': base64.b64encode(content).decode()})
+
+            # Read in small pieces or iterated, the body is the same
+            body = uploads.Base64JSONBody({'model': 'm', 'data': 'PLACEHOLDER'}, 'PLACEHOLDER', io.BytesIO(content), size)
+            pieces = iter(lambda: body.read(1000), b'')
+            self.assertEqual(b''.join(pieces), encoded)
+            body = uploads.Base64JSONBody({'model': 'm', 'data': 'PLACEHOLDER'}, 'PLACEHOLDER', io.BytesIO(content), size)
+            self.assertEqual(b''.join(body), encoded)
+
+
+class ExtractionCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_hits_misses_and_prompt_versions(self):
+        self.assertIsNone(extraction_cache.get_cached_result('a' * 64, 'v1'))
+        extraction_cache.store_result('a' * 64, 'v1', {'amount': 12.5, 'description': 'Fuel'})
+        self.assertEqual(extraction_cache.get_cached_result('a' * 64, 'v1'), {'amount': 12.5, 'description': 'Fuel'})
+        # A new prompt version never gets the old result
+        self.assertIsNone(extraction_cache.get_cached_result('a' * 64, 'v2'))
+        self.assertEqual(ExtractionCacheEntry.objects.get(file_hash='a' * 64).hits, 1)
+        self.assertEqual(cache_stats(), {'hits': 1, 'misses': 2, 'hit_rate': 0.3333, 'entries': 1})
+
+        with override_settings(RECEIPT_CACHE_TTL=0):
+            self.assertIsNone(extraction_cache.get_cached_result('a' * 64, 'v1'))
+        self.assertEqual(extraction_cache.invalidate('v2'), 1)
+
+    @override_settings(RECEIPT_CACHE_MAX_ENTRIES=3, RECEIPT_CACHE_EVICT_PROBABILITY=0)
+    def test_eviction(self):
+        for i in range(5):
+            extraction_cache.store_result(f'{i:064x}', 'v1', {'amount': i})
+        # Stores alone leave eviction to the command
+        self.assertEqual(ExtractionCacheEntry.objects.count(), 5)
+
+        ExtractionCacheEntry.objects.filter(file_hash=f'{0:064x}').update(created_at=timezone.now() - timedelta(days=365))
+        ExtractionCacheEntry.objects.filter(file_hash=f'{1:064x}').update(last_used_at=timezone.now() + timedelta(minutes=1))
+        out = io.StringIO()
+        call_command('evict_extraction_cache', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "2 extraction cache entries evicted")
+        # The expired entry goes, then the least recently used beyond the limit
+        self.assertEqual(
+            set(ExtractionCacheEntry.objects.values_list('file_hash', flat=True)),
+            {f'{i:064x}' for i in (1, 3, 4)}
+        )
+
+        with override_settings(RECEIPT_CACHE_EVICT_PROBABILITY=0.5), mock.patch.object(extraction_cache, 'evict') as evict:
+            with mock.patch.object(extraction_cache.random, 'random', return_value=0.7):
+                extraction_cache.store_result('f' * 64, 'v1', {'amount': 1})
+            self.assertFalse(evict.called)
+            with mock.patch.object(extraction_cache.random, 'random', return_value=0.2):
+                extraction_cache.store_result('f' * 64, 'v1', {'amount': 1})
+            self.assertTrue(evict.called)
+
+
+class ExtractionJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        get_token_cache().clear()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        override = override_settings(
+            MEDIA_ROOT=self.media_root, EXTRACTION_CALLBACK_HOSTS=['hooks.example.com'], EXTRACTION_MAX_ATTEMPTS=2
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        # Workers close their connections, which would end the test's transaction
+        patcher = mock.patch('finance.jobs.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def receipt(self):
+        return SimpleUploadedFile('receipt.png', render_photo(1, size=(40, 60)), content_type='image/png')
+
+    def submit(self, callback_url=''):
+        return submit_job(self.receipt(), user=self.user, callback_url=callback_url)
+
+    def test_async_mode_queues_a_job(self):
+        response = self.client.post('/api/file/', {'receipt': self.receipt(), 'mode': 'async'})
+        self.assertEqual(response.status_code, 202, response.content)
+        job = ExtractionJob.objects.get(pk=response.json()['job_id'])
+        self.assertEqual((job.status, job.submitted_by), (ExtractionJob.STATUS_PENDING, self.user))
+        self.assertEqual(self.client.get(response.json()['status_url']).json()['status'], 'pending')
+
+    def test_callbacks_only_go_to_allowed_hosts(self):
+        for url in (
+            'http://169.254.169.254/latest/meta-data/', 'http://localhost:8000/', 'ftp://hooks.example.com/',
+            'https://hooks.example.com.attacker.test/', 'https://user@attacker.test/?hooks.example.com',
+        ):
+            response = self.client.post('/api/file/', {'receipt': self.receipt(), 'mode': 'async', 'callback_url': url})
+            self.assertEqual(response.status_code, 400, url)
+        self.assertFalse(ExtractionJob.objects.exists())
+
+        response = self.client.post('/api/file/', {
+            'receipt': self.receipt(), 'mode': 'async', 'callback_url': 'https://hooks.example.com/receipts'
+        })
+        self.assertEqual(response.status_code, 202)
+
+    def test_run_sends_the_callback(self):
+        job = self.submit('https://hooks.example.com/receipts')
+        self.assertTrue(default_storage.exists(job.receipt.name))
+        with mock.patch('finance.jobs.extract_receipt', return_value={'amount': 12.5, 'description': 'Fuel'}), \
+                mock.patch('finance.jobs.requests.post') as post:
+            job = run_job(job.pk)
+        self.assertEqual((job.status, job.attempts, job.result['amount']), (ExtractionJob.STATUS_SUCCEEDED, 1, 12.5))
+        self.assertIsNotNone(job.finished_at)
+        # The upload is removed once the job has finished
+        self.assertFalse(default_storage.exists(job.receipt.name))
+        url, = post.call_args.args
+        self.assertEqual(url, 'https://hooks.example.com/receipts')
+        self.assertEqual(post.call_args.kwargs['json']['status'], 'succeeded')
+        self.assertFalse(post.call_args.kwargs['allow_redirects'])
+        # Finished jobs are not claimed again
+        self.assertIsNone(run_job(job.pk))
+
+    def test_failed_attempts_back_off_then_fail(self):
+        job = self.submit()
+        with mock.patch('finance.jobs.extract_receipt', side_effect=RuntimeError('provider down')), \
+                self.assertLogs('finance.jobs', 'WARNING'):
+            job = run_job(job.pk)
+            self.assertEqual((job.status, job.attempts, job.error), (ExtractionJob.STATUS_PENDING, 1, 'provider down'))
+            self.assertGreater(job.run_after, timezone.now())
+            self.assertIsNone(claim_job(job.pk))
+            self.assertTrue(default_storage.exists(job.receipt.name))
+
+            ExtractionJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            job = run_job(job.pk)
+        self.assertEqual((job.status, job.attempts), (ExtractionJob.STATUS_FAILED, 2))
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(default_storage.exists(job.receipt.name))
+
+    def test_jobs_of_lost_workers_are_run_again(self):
+        job = self.submit()
+        self.assertEqual(claim_job(job.pk).status, ExtractionJob.STATUS_RUNNING)
+        self.assertIsNone(claim_job(job.pk))
+        self.assertEqual(pending_job_ids(10), [])
+
+        expired = timezone.now() - timedelta(seconds=settings.EXTRACTION_JOB_LEASE + 1)
+        ExtractionJob.objects.filter(pk=job.pk).update(claimed_at=expired)
+        self.assertEqual(pending_job_ids(10), [job.pk])
+        self.assertEqual(claim_job(job.pk).attempts, 2)
+
+        # Lost again on its last attempt
+        ExtractionJob.objects.filter(pk=job.pk).update(claimed_at=expired)
+        self.assertEqual(pending_job_ids(10), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExtractionJob.STATUS_FAILED)
+        self.assertFalse(default_storage.exists(job.receipt.name))
+
+
+class ExpenseListingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+        other = Project.objects.create(name='Schools', description='Visits')
+        Expense.objects.bulk_create([
+            Expense(
+                project_id=cls.project if i % 3 else other,
+                project_name=cls.project.name if i % 3 else other.name,
+                activity='Fuel',
+                amount=i,
+                description=f'Expense {i}',
+                receipt=f'receipts/{i}.jpg',
+                project_officer_id=cls.user,
+                project_officer=cls.user.first_name
+            )
+            for i in range(30)
+        ])
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        get_token_cache().clear()
+        cache.clear()
+
+    def collect_pages(self, url, extra_queries=0):
+        ids = []
+        queries = 2 + extra_queries
+        while url:
+            # One query for the page whatever its size, plus one to
+            # authenticate until the token is cached
+            with self.assertNumQueries(queries):
+                data = self.client.get(url).json()
+            queries = 1 + extra_queries
+            ids += [expense['id'] for expense in data['results']]
+            url = data['next']
+        return ids
+
+    def test_expense_list_is_cursor_paginated(self):
+        ids = self.collect_pages('/api/expenses/?page_size=7')
+        expected = list(Expense.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_expenses_by_project_is_cursor_paginated(self):
+        # Plus the project's version for the ETag
+        ids = self.collect_pages(f'/api/projects/{self.project.pk}/expenses/?page_size=5', extra_queries=1)
+        self.assertEqual(len(ids), Expense.objects.filter(project_id=self.project).count())
+
+    def test_field_projection(self):
+        data = self.client.get('/api/expenses/?fields=id,amount').json()
+        self.assertEqual(set(data['results'][0]), {'id', 'amount'})
+
+    def test_export_streams_every_expense(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/expenses/export/?project_id={self.project.pk}')
+            rows = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(rows[0]['receipt'], '/media/receipts/1.jpg')
+        self.assertEqual(rows[0]['amount'], '1.00')
+
+
+class ExpenseSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        water = Project.objects.create(name='Kisumu Water', description='Boreholes')
+        schools = Project.objects.create(name='Schools', description='Visits')
+        rows = [
+            (water, 'Fuel', 100, 'Fuel for the borehole rig'),
+            (water, 'Workshop', 250, 'Kisumu workshop venue'),
+            (schools, 'Fuel', 80, 'Fuel to visit schools'),
+            (schools, 'Printing', 40, 'Workshop handouts'),
+        ]
+        Expense.objects.bulk_create([
+            Expense(
+                project_id=project,
+                project_name=project.name,
+                activity=activity,
+                amount=amount,
+                description=description,
+                receipt='receipts/search.jpg',
+                project_officer_id=cls.user,
+                project_officer=cls.user.first_name
+            )
+            for project, activity, amount, description in rows
+        ])
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        get_token_cache().clear()
+
+    def search(self, query):
+        response = self.client.get(f'/api/expenses/search/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def descriptions(self, query):
+        return [expense['description'] for expense in self.search(query)['results']]
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.descriptions('q=kisumu workshop'), ['Kisumu workshop venue'])
+        self.assertEqual(len(self.descriptions('q=fuel')), 2)
+
+    def test_filters(self):
+        self.assertEqual(self.descriptions('q=fuel&min_amount=90'), ['Fuel for the borehole rig'])
+        self.assertEqual(len(self.descriptions('max_amount=90')), 2)
+        self.assertEqual(self.descriptions('q=fuel&date_from=2999-01-01'), [])
+        response = self.client.get('/api/expenses/search/?min_amount=lots')
+        self.assertEqual(response.status_code, 400)
+
+    def test_pages_and_fields(self):
+        data = self.search('page_size=3&fields=id,description')
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(set(data['results'][0]), {'id', 'description'})
+        self.assertIsNone(data['previous'])
+        last = self.client.get(data['next']).json()
+        self.assertEqual(len(last['results']), 1)
+        self.assertIsNone(last['next'])
+        self.assertIsNotNone(last['previous'])
+
+    @skipUnless(connection.vendor == 'postgresql', "Ranking and typo tolerance need PostgreSQL")
+    def test_ranking_and_typos(self):
+        # The project name outweighs the description
+        self.assertEqual(self.descriptions('q=kisumu')[0], 'Kisumu workshop venue')
+        self.assertEqual(self.descriptions('q=workshop')[0], 'Kisumu workshop venue')
+        self.assertIn('Kisumu workshop venue', self.descriptions('q=kisumo'))
+
+
+class SpendingRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.water = Project.objects.create(name='Water', description='Boreholes')
+        cls.schools = Project.objects.create(name='Schools', description='Visits')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+
+    def add_expense(self, project, activity, amount):
+        return Expense.objects.create(
+            project_id=project,
+            project_name=project.name,
+            activity=activity,
+            amount=amount,
+            description='Spend',
+            receipt='receipts/spend.jpg',
+            project_officer_id=self.user,
+            project_officer=self.user.first_name
+        )
+
+    def rollup_rows(self):
+        return sorted(ProjectSpendRollup.objects.values_list('project_id', 'activity', 'month', 'total', 'expense_count'))
+
+    def test_rollups_follow_expense_writes(self):
+        fuel = self.add_expense(self.water, 'Fuel', '10.50')
+        self.add_expense(self.water, 'Fuel', '4.50')
+        transport = self.add_expense(self.water, 'Transport', '20.00')
+
+        summary = self.client.get(f'/api/projects/{self.water.pk}/spending/').json()
+        self.assertEqual(summary['total'], '35.00')
+        self.assertEqual(summary['expense_count'], 3)
+
+        # Moving an expense to another project and deleting one both update
+        # the totals, and drop the cached summaries once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            transport.project_id = self.schools
+            transport.save()
+            fuel.delete()
+
+        with self.assertNumQueries(2):
+            summary = self.client.get(f'/api/projects/{self.water.pk}/spending/').json()
+        # Served from the cache until the next write
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(f'/api/projects/{self.water.pk}/spending/').json(), summary)
+        self.assertEqual(summary['activities'], [{'activity': 'Fuel', 'total': '4.50', 'expense_count': 1}])
+        self.assertEqual(len(summary['months']), 1)
+
+        totals = {row['project_name']: row['total'] for row in self.client.get('/api/projects/spending/').json()}
+        self.assertEqual(totals, {'Water': '4.50', 'Schools': '20.00'})
+
+    def test_backfill_matches_incremental_rollups(self):
+        for i in range(6):
+            self.add_expense(self.water if i % 2 else self.schools, f'Activity {i % 3}', i + 0.25)
+        incremental = self.rollup_rows()
+
+        ProjectSpendRollup.objects.all().delete()
+        call_command('backfill_spend_rollups', stdout=io.StringIO())
+        self.assertEqual(self.rollup_rows(), incremental)
+
+
+class ActivityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        get_token_cache().clear()
+        cache.clear()
+
+    def test_parse_activities(self):
+        cases = [
+            ('["Fuel", "Meals", "fuel"]', ['Fuel', 'Meals']),
+            ("Visit girls' school, Mission to home\nTraining", ["Visit girls' school", 'Mission to home', 'Training']),
+            ("['Fuel'; 'Meals']", ['Fuel', 'Meals']),
+            (['Fuel', ' Meals '], ['Fuel', 'Meals']),
+            ('', []),
+        ]
+        for blob, expected in cases:
+            self.assertEqual(parse_activities(blob), expected, blob)
+
+    def test_project_activities_stay_a_text_field(self):
+        response = self.client.post('/api/projects/', {
+            'name': 'Water', 'description': 'Boreholes', 'activities': 'Fuel, Meals'
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(json.loads(response.json()['activities']), ['Fuel', 'Meals'])
+        project = Project.objects.get(pk=response.json()['id'])
+
+        Expense.objects.create(
+            project_id=project, project_name=project.name, activity_ref=activity_for(project, 'Meals'), activity='Meals',
+            amount=5, description='Lunch', receipt='receipts/lunch.jpg', project_officer_id=self.user, project_officer='Amina'
+        )
+        # Activities with expenses are kept when left out
+        response = self.client.patch(f'/api/projects/{project.pk}/', {'activities': ['Fuel', 'Transport']}, content_type='application/json')
+        self.assertEqual(json.loads(response.json()['activities']), ['Fuel', 'Meals', 'Transport'])
+        listed = self.client.get('/api/projects/').json()
+        self.assertEqual(listed[0]['activities'], response.json()['activities'])
+
+    @override_settings(RECEIPT_DERIVATIVES_ENABLED=False, RECEIPT_FINGERPRINTS_ENABLED=False)
+    def test_expenses_reference_their_activity(self):
+        project = Project.objects.create(name='Water', description='Boreholes')
+        set_activities(project, ['Fuel'])
+        response = self.client.post('/api/expenses/', {
+            'project_name': 'Water', 'activity': ' fuel ', 'amount': '10.00', 'description': 'Trip',
+            'receipt': SimpleUploadedFile('fuel.png', render_photo(1, size=(40, 60)))
+        })
+        self.assertEqual(response.status_code, 201, response.content)
+        fuel = Activity.objects.get(project=project, name='Fuel')
+        self.assertEqual((response.json()['activity'], response.json()['activity_id']), ('Fuel', fuel.pk))
+
+        # Bulk imports link (and create) activities too
+        rows = [
+            {'project_name': 'Water', 'activity': 'FUEL', 'amount': '2.50'},
+            {'project_name': 'Water', 'activity': 'Transport', 'amount': '7.00'},
+        ]
+        import_expenses(rows, self.user)
+        self.assertEqual(
+            sorted(Expense.objects.values_list('activity', 'activity_ref__name')),
+            [('Fuel', 'Fuel'), ('Fuel', 'Fuel'), ('Transport', 'Transport')]
+        )
+
+    def test_budget_against_spend(self):
+        project = Project.objects.create(name='Water', description='Boreholes')
+        url = f'/api/projects/{project.pk}/activities/'
+        fuel = self.client.post(url, {'name': 'Fuel', 'budget': '100.00'}, content_type='application/json').json()
+        self.client.post(url, {'name': 'Meals'}, content_type='application/json')
+        response = self.client.post(url, {'name': 'fuel'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        import_expenses([{'project_name': 'Water', 'activity': 'Fuel', 'amount': amount} for amount in ('30.00', '12.50')], self.user)
+        with self.assertNumQueries(2):
+            report = self.client.get(url).json()
+        self.assertEqual(report, [
+            {'id': fuel['id'], 'activity': 'Fuel', 'budget': '100.00', 'spent': '42.50', 'remaining': '57.50', 'expense_count': 2},
+            {'id': report[1]['id'], 'activity': 'Meals', 'budget': None, 'spent': '0.00', 'remaining': None, 'expense_count': 0},
+        ])
+
+        response = self.client.patch(f'{url}{fuel["id"]}/', {'budget': '40.00', 'name': 'Diesel'}, content_type='application/json')
+        self.assertEqual(response.json()['name'], 'Fuel')
+        self.assertEqual(self.client.get(url).json()[0]['remaining'], '-2.50')
+
+    def test_names_are_unique_ignoring_case(self):
+        project = Project.objects.create(name='Water', description='Boreholes')
+        Activity.objects.create(project=project, name='Fuel')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Activity.objects.create(project=project, name='fuel')
+
+    def test_new_activities_change_their_project(self):
+        project = Project.objects.create(name='Water', description='Boreholes')
+        etag = self.client.get('/api/projects/')['ETag']
+        logged = ChangeLog.objects.get(kind=ChangeLog.KIND_PROJECT, object_id=project.pk).seq
+
+        activity_for(project, 'Brand new')
+        response = self.client.get('/api/projects/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.json()[0]['activities']), ['Brand new'])
+        self.assertGreater(ChangeLog.objects.get(kind=ChangeLog.KIND_PROJECT, object_id=project.pk).seq, logged)
+
+        # Activities created by bulk paths too
+        etag = response['ETag']
+        import_expenses([{'project_name': 'Water', 'activity': 'Transport', 'amount': '7.00'}], self.user)
+        response = self.client.get('/api/projects/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(json.loads(response.json()[0]['activities']), ['Brand new', 'Transport'])
+
+    def test_deleting_a_project_deletes_its_linked_expenses(self):
+        project = Project.objects.create(name='Water', description='Boreholes')
+        import_expenses([{'project_name': 'Water', 'activity': 'Fuel', 'amount': '7.00'}], self.user)
+        Expense.objects.create(
+            project_id=project, project_name=project.name, activity_ref=activity_for(project, 'Meals'), activity='Meals',
+            amount=5, description='Lunch', receipt='receipts/lunch.jpg', project_officer_id=self.user, project_officer='Amina'
+        )
+        # An activity in use cannot be deleted on its own
+        with self.assertRaises(RestrictedError):
+            Activity.objects.get(name='Meals').delete()
+
+        response = self.client.delete(f'/api/projects/{project.pk}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Expense.objects.exists())
+        self.assertFalse(Activity.objects.exists())
+
+
+class ExpenseImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.water = Project.objects.create(name='Water', description='Boreholes')
+        cls.schools = Project.objects.create(name='Schools', description='Visits')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+
+    def upload(self, name, content, **data):
+        return self.client.post('/api/expenses/import/', {'file': SimpleUploadedFile(name, content.encode()), **data})
+
+    def test_csv_import_resolves_projects_once(self):
+        rows = ''.join(f'{"Water" if i % 2 else "Schools"},Fuel,{i}.50,Trip {i}\n' for i in range(250))
+        with CaptureQueriesContext(connection) as context:
+            response = self.upload('expenses.csv', 'project_name,activity,amount,description\n' + rows)
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['created'], 250)
+
+        project_queries = [q for q in context.captured_queries if 'FROM "finance_project"' in q['sql']]
+        self.assertEqual(len(project_queries), 1)
+        self.assertEqual(Expense.objects.filter(project_id=self.water).count(), 125)
+        self.assertEqual(ProjectSpendRollup.objects.get(project=self.water).expense_count, 125)
+
+    def test_invalid_row_aborts_import(self):
+        content = '\n'.join([
+            json.dumps({'project_name': 'Water', 'activity': 'Fuel', 'amount': '10.00'}),
+            json.dumps({'project_name': 'Roads', 'activity': 'Fuel', 'amount': '5.00'}),
+            json.dumps({'project_name': 'Water', 'activity': 'Fuel', 'amount': 'ten'}),
+        ])
+        response = self.upload('expenses.ndjson', content)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['row'] for error in response.json()['errors']], [2, 3])
+        self.assertFalse(Expense.objects.exists())
+
+        response = self.upload('expenses.ndjson', content, skip_invalid='true')
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(Expense.objects.count(), 1)
+
+    def test_export_round_trips_through_import(self):
+        self.upload('expenses.csv', 'project_name,activity,amount,description\nWater,Fuel,12.50,"Trip, return"\n')
+
+        response = self.client.get('/api/expenses/export/?type=csv&fields=project_name,activity,amount,description')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        exported = b''.join(response.streaming_content).decode()
+        self.assertEqual(exported, 'project_name,activity,amount,description\r\nWater,Fuel,12.50,"Trip, return"\r\n')
+
+        self.assertEqual(self.upload('expenses.csv', exported).json()['created'], 1)
+        ndjson = b''.join(self.client.get('/api/expenses/export/?type=ndjson').streaming_content).decode()
+        self.assertEqual(len(ndjson.splitlines()), 2)
+
+        ndjson = b''.join(self.client.get(f'/api/expenses/export/?type=ndjson&project_id={self.schools.pk}').streaming_content)
+        self.assertEqual(ndjson, b'')
+        response = self.client.get('/api/expenses/export/?project_id=abc')
+        self.assertEqual((response.status_code, response.json()), (400, {"error": "Invalid project_id."}))
+
+
+JPEG = b'\xff\xd8\xff\xe0' + bytes(range(256)) * 4
+
+
+class ReceiptStorageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root, RECEIPT_SIGNED_URLS=True)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.storage = LocalReceiptStorage()
+        patcher = mock.patch('finance.storage._receipt_storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_expense(self, **data):
+        return self.client.post('/api/expenses/', {
+            'project_name': 'Water', 'activity': 'Fuel', 'amount': '10.00', 'description': 'Trip', **data
+        })
+
+    def test_identical_receipts_are_stored_once(self):
+        for _ in range(2):
+            response = self.create_expense(receipt=SimpleUploadedFile('fuel.jpg', JPEG))
+            self.assertEqual(response.status_code, 201, response.content)
+
+        names = set(Expense.objects.values_list('receipt', flat=True))
+        self.assertEqual(names, {receipt_key(hashlib.sha256(JPEG).hexdigest(), '.jpg')})
+        stored = [files for _, _, files in os.walk(self.media_root) if files]
+        self.assertEqual(stored, [[f'{hashlib.sha256(JPEG).hexdigest()}.jpg']])
+
+    def test_direct_upload_and_signed_download(self):
+        sha256 = hashlib.sha256(JPEG).hexdigest()
+        target = self.client.post('/api/receipts/uploads/', {'sha256': sha256, 'filename': 'fuel.jpg', 'size': len(JPEG)}).json()
+        self.assertFalse(target['exists'])
+
+        # A body that does not match the key is refused
+        upload = target['upload']
+        self.assertEqual(self.client.put(upload['url'], b'\xff\xd8\xff tampered', content_type='image/jpeg').status_code, 400)
+        self.assertEqual(self.client.put(upload['url'], JPEG, content_type='image/jpeg').status_code, 201)
+        self.assertTrue(self.client.post('/api/receipts/uploads/', {'sha256': sha256, 'filename': 'x.jpg', 'size': 1}).json()['exists'])
+
+        response = self.create_expense(receipt_key=target['receipt_key'])
+        self.assertEqual(response.status_code, 201, response.content)
+        url = response.json()['receipt']
+
+        del self.client.defaults['HTTP_AUTHORIZATION']
+        with override_settings(RECEIPT_SERVE_MODE='x-accel-redirect'):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Accel-Redirect'], f"/protected-media/{target['receipt_key']}")
+        self.assertEqual(response.content, b'')
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), JPEG)
+
+        path = urlsplit(url).path
+        self.assertEqual(self.client.get(path + '?signature=forged').status_code, 403)
+
+    def test_receipts_round_trip_through_export_and_import(self):
+        self.assertEqual(self.create_expense(receipt=SimpleUploadedFile('fuel.jpg', JPEG)).status_code, 201)
+        name = receipt_key(hashlib.sha256(JPEG).hexdigest(), '.jpg')
+
+        # Exports carry signed URLs; importing them back stores the key
+        exported = b''.join(self.client.get('/api/expenses/export/?type=ndjson').streaming_content)
+        self.assertIn('signature=', json.loads(exported)['receipt'])
+        response = self.client.post('/api/expenses/import/', {'file': SimpleUploadedFile('expenses.ndjson', exported)})
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(list(Expense.objects.values_list('receipt', flat=True)), [name, name])
+
+        for receipt in ('settings.py', 'extraction_jobs/fuel.jpg', receipt_key('0' * 64, '.jpg')):
+            row = json.dumps({'project_name': 'Water', 'activity': 'Fuel', 'amount': '1.00', 'receipt': receipt})
+            response = self.client.post('/api/expenses/import/', {'file': SimpleUploadedFile('expenses.ndjson', row.encode())})
+            self.assertEqual(response.status_code, 400, receipt)
+            self.assertIn('receipt', response.json()['errors'][0]['errors'])
+
+    def test_unknown_receipt_key_is_rejected(self):
+        response = self.create_expense(receipt_key=receipt_key('0' * 64, '.jpg'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('receipt_key', response.json())
+
+
+def render_receipt(image_format, size=(1600, 1200)):
+    output = io.BytesIO()
+    Image.new('RGB', size, 'white').save(output, format=image_format)
+    return output.getvalue()
+
+
+@skipUnless(Image is not None and pdfium is not None, "Pillow and pypdfium2 are needed to render derivatives")
+class ReceiptDerivativeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch('finance.storage._receipt_storage', LocalReceiptStorage())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_expense(self, name, content):
+        response = self.client.post('/api/expenses/', {
+            'project_name': 'Water', 'activity': 'Fuel', 'amount': '10.00', 'description': 'Trip',
+            'receipt': SimpleUploadedFile(name, content)
+        })
+        self.assertEqual(response.status_code, 201, response.content)
+        return Expense.objects.get(pk=response.json()['id'])
+
+    def test_thumbnails_are_rendered_after_create(self):
+        # Run the background render inline, keeping the test's connection open
+        with mock.patch.object(derivatives.executor, 'submit', side_effect=lambda fn, *args: fn(*args)), \
+                mock.patch.object(derivatives, 'close_old_connections'):
+            with self.captureOnCommitCallbacks(execute=True):
+                expense = self.create_expense('fuel.png', render_receipt('PNG'))
+
+        expense.refresh_from_db()
+        self.assertEqual(expense.receipt_derivatives, ['thumbnail', 'thumbnail_webp'])
+        with receipt_storage().open(derivative_name(expense.receipt.name, 'thumbnail_webp')) as f:
+            thumbnail = Image.open(f)
+            self.assertEqual((thumbnail.format, thumbnail.size), ('WEBP', (320, 240)))
+
+        data = self.client.get('/api/expenses/?fields=id,thumbnail,preview').json()['results'][0]
+        self.assertEqual(data['thumbnail'], 'http://testserver' + receipt_storage().url(derivative_name(expense.receipt.name, 'thumbnail')))
+        self.assertIsNone(data['preview'])
+
+    def test_missing_preview_is_rendered_on_first_request(self):
+        expense = self.create_expense('invoice.pdf', render_receipt('PDF'))
+        preview_url = self.client.get(f'/api/expenses/{expense.pk}/').json()['preview']
+        self.assertEqual(preview_url, f'http://testserver/api/expenses/{expense.pk}/receipt/preview/')
+
+        response = self.client.get(preview_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], receipt_storage().url(derivative_name(expense.receipt.name, 'preview')))
+        expense.refresh_from_db()
+        self.assertEqual(expense.receipt_derivatives, ['preview', 'thumbnail', 'thumbnail_webp'])
+        self.assertEqual(self.client.get(f'/api/expenses/{expense.pk}/receipt/missing/').status_code, 404)
+
+
+def render_photo(seed, size=(800, 1200), brightness=1.0, image_format='PNG'):
+    # A page of dark blocks standing in for a receipt. The same seed at
+    # another size, exposure or format is another photo of the same receipt.
+    rng = random.Random(seed)
+    image = Image.new('L', (800, 1200), 255)
+    for _ in range(12):
+        x, y = rng.randint(0, 600), rng.randint(0, 1100)
+        image.paste(rng.randint(0, 120), (x, y, x + rng.randint(50, 300), y + rng.randint(20, 120)))
+    image = image.resize(size).point(lambda value: int(value * brightness)).convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+@skipUnless(Image is not None, "Pillow is needed to hash receipts")
+class ReceiptFingerprintTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        cache.clear()
+        get_token_cache().clear()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch('finance.storage._receipt_storage', LocalReceiptStorage())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.original = render_photo(1)
+        self.retaken = render_photo(1, size=(600, 900), brightness=0.9, image_format='JPEG')
+        self.unrelated = render_photo(2)
+
+    def fingerprint(self, content, name='receipt.png'):
+        file = ContentFile(content, name=name)
+        return fingerprints.fingerprint(file), hashlib.sha256(content).hexdigest()
+
+    def test_other_photos_of_a_receipt_are_similar(self):
+        original, original_hash = self.fingerprint(self.original)
+        unrelated, unrelated_hash = self.fingerprint(self.unrelated)
+        retaken, retaken_hash = self.fingerprint(self.retaken, 'receipt.jpg')
+
+        with self.assertNumQueries(1):
+            matches = [file_hash for _, file_hash, _ in fingerprints.similar(retaken)]
+        self.assertEqual(matches, [retaken_hash, original_hash])
+
+    def test_banded_lookup_finds_everything_within_the_distance(self):
+        rng = random.Random(0)
+        hashes = [rng.getrandbits(64) for _ in range(300)]
+        for index, dhash in enumerate(hashes):
+            fingerprints.remember(f'{index:064x}', dhash)
+        for dhash in hashes[:20]:
+            query = dhash
+            for bit in rng.sample(range(64), 7):
+                query ^= 1 << bit
+            expected = sorted(
+                (fingerprints.distance(query, other), f'{index:064x}')
+                for index, other in enumerate(hashes)
+                if fingerprints.distance(query, other) <= 7
+            )
+            found = [(distance, file_hash) for distance, file_hash, _ in fingerprints.similar(query, 7)]
+            self.assertEqual(found, expected)
+            self.assertIn((7, f'{hashes.index(dhash):064x}'), found)
+
+    def test_extraction_reads_look_alike_receipts_again(self):
+        # Look-alike receipts can have other totals, so only the same bytes
+        # are answered from the cache
+        results = [{'amount': 12, 'description': 'Fuel'}, {'amount': 91, 'description': 'Fuel'}]
+        with mock.patch('finance.extractors.process_receipt_with_gpt', side_effect=results) as extract:
+            first = extract_receipt(ContentFile(self.original, name='receipt.png'))
+            second = extract_receipt(ContentFile(self.retaken, name='receipt.jpg'))
+            again = extract_receipt(ContentFile(self.original, name='receipt.png'))
+        self.assertEqual((first, second, again), (results[0], results[1], results[0]))
+        self.assertEqual(extract.call_count, 2)
+
+    @override_settings(RECEIPT_DERIVATIVES_ENABLED=False)
+    def test_upload_flags_expenses_with_another_photo_of_the_receipt(self):
+        with mock.patch.object(fingerprints.executor, 'submit', side_effect=lambda fn, *args: fn(*args)), \
+                mock.patch.object(fingerprints, 'close_old_connections'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/expenses/', {
+                'project_name': 'Water', 'activity': 'Fuel', 'amount': '10.00', 'description': 'Trip',
+                'receipt': SimpleUploadedFile('fuel.png', self.original)
+            })
+        self.assertEqual(response.status_code, 201, response.content)
+
+        with mock.patch('finance.extractors.process_receipt_with_gpt', return_value={'amount': 7, 'description': 'Food'}) as extract:
+            data = self.client.post('/api/file/', {'receipt': SimpleUploadedFile('fuel.jpg', self.retaken)}).json()
+            # Still read by the provider, with the expense only flagged
+            self.assertEqual(data, {'amount': 7, 'description': 'Food', 'possible_duplicates': [response.json()['id']]})
+            self.assertEqual(extract.call_count, 1)
+            data = self.client.post('/api/file/', {'receipt': SimpleUploadedFile('other.png', self.unrelated)}).json()
+            self.assertNotIn('possible_duplicates', data)
+            self.assertEqual(extract.call_count, 2)
+
+    def test_imported_receipts_are_fingerprinted(self):
+        name = receipt_storage().save('receipt.png', ContentFile(self.original))
+        content = json.dumps({'project_name': 'Water', 'activity': 'Fuel', 'amount': '10.00', 'receipt': name})
+        with mock.patch.object(fingerprints.executor, 'submit', side_effect=lambda fn, *args: fn(*args)), \
+                mock.patch.object(fingerprints, 'close_old_connections'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/expenses/import/', {
+                'file': SimpleUploadedFile('expenses.ndjson', content.encode())
+            })
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertTrue(ReceiptFingerprint.objects.filter(receipt=name).exists())
+
+
+def text_pdf(lines):
+    # A one-page PDF with a text layer, as receipt software exports them
+    content = 'BT /F1 12 Tf 72 720 Td 14 TL ' + ' '.join(f'({line}) Tj T*' for line in lines) + ' ET'
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        f'<< /Length {len(content)} >>\nstream\n{content}\nendstream',
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    pdf, offsets = '%PDF-1.4\n', []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f'{number} 0 obj\n{body}\nendobj\n'
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n' + ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    return pdf.encode('latin-1')
+
+
+def noise(size, image_format, **options):
+    # A photo-like image that compresses badly
+    output = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(output, format=image_format, **options)
+    return output.getvalue()
+
+
+@skipUnless(Image is not None and pdfium is not None, "Pillow and pypdfium2 are needed to preprocess receipts")
+class ReceiptPreprocessingTests(SimpleTestCase):
+    def prepare(self, content, name):
+        prepared = imaging.prepare_receipt(ContentFile(content, name=name))
+        prepared.file.seek(0)
+        return prepared, Image.open(prepared.file)
+
+    def test_large_photos_are_downscaled(self):
+        prepared, image = self.prepare(noise((3200, 2400), 'PNG'), 'receipt.png')
+        self.assertEqual((prepared.mime_type, image.format, image.size), ('image/jpeg', 'JPEG', (1600, 1200)))
+        self.assertLess(prepared.processed_bytes, prepared.original_bytes)
+
+    def test_large_jpegs_are_recompressed(self):
+        content = noise((1500, 1500), 'JPEG', quality=100)
+        self.assertGreater(len(content), imaging.SPOOL_SIZE)
+        prepared, image = self.prepare(content, 'receipt.jpg')
+        self.assertEqual(image.size, (1500, 1500))
+        self.assertLess(prepared.processed_bytes, len(content))
+
+        small = render_receipt('JPEG', size=(800, 600))
+        receipt = ContentFile(small, name='small.jpg')
+        self.assertIs(imaging.prepare_receipt(receipt).file, receipt)
+
+    def test_pdfs_are_rasterized(self):
+        prepared, image = self.prepare(text_pdf(['Quickmart', 'TOTAL 100.00']), 'receipt.pdf')
+        self.assertEqual((prepared.mime_type, image.format, image.size[1]), ('image/jpeg', 'JPEG', 1600))
+
+    def test_pdfs_that_cannot_be_rasterized_are_sent_as_files(self):
+        pdf = text_pdf(['Quickmart', 'TOTAL 100.00'])
+        with mock.patch.object(imaging, 'pdfium', None):
+            prepared = imaging.prepare_receipt(ContentFile(pdf, name='receipt.pdf'))
+        self.assertEqual(prepared.mime_type, 'application/pdf')
+
+        body = json.loads(extractors.build_request_body(prepared.file, prepared.mime_type).read())
+        part = body['messages'][1]['content'][1]
+        self.assertEqual((part['type'], part['file']['filename']), ('file', 'receipt.pdf'))
+        prefix, encoded = part['file']['file_data'].split(',', 1)
+        self.assertEqual((prefix, base64.b64decode(encoded)), ('data:application/pdf;base64', pdf))
+
+
+class ExtractorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.servers = {}
+        for name in ('default', 'hedge'):
+            self.servers[name] = stub_provider({'choices': [{'message': {'content': json.dumps({'amount': 12.5, 'description': name})}}]})
+        backends = {
+            name: {'BACKEND': 'finance.extractors.ChatCompletionsExtractor', 'URL': f'{server.url}/v1/'}
+            for name, server in self.servers.items()
+        }
+        backends['offline'] = {'BACKEND': 'finance.extractors.OfflineExtractor'}
+        override = override_settings(RECEIPT_EXTRACTORS=backends, RECEIPT_HEDGE_AFTER=0.2, RECEIPT_EXTRACTION_TIMEOUT=5)
+        override.enable()
+        self.addCleanup(override.disable)
+        extractors.reset_extractors()
+        self.addCleanup(extractors.reset_extractors)
+
+    def tearDown(self):
+        for server in self.servers.values():
+            server.stop()
+
+    def test_slow_backend_is_hedged(self):
+        self.servers['default'].delay = 1
+        receipt = ContentFile(b'receipt', name='receipt.png')
+
+        started = time.perf_counter()
+        result, extractor = extractors.extract_with_backends(receipt, 'image/png')
+        self.assertLess(time.perf_counter() - started, 0.9)
+        self.assertEqual((result['description'], extractor.name), ('hedge', 'hedge'))
+
+        result, extractor = asyncio.run(extractors.aextract_with_backends(receipt, 'image/png'))
+        self.assertEqual((result['description'], extractor.name), ('hedge', 'hedge'))
+        self.assertGreaterEqual(metrics.EXTRACTOR_HANDOFFS.values[('hedge', 'slow')], 2)
+
+    def test_hedged_copies_are_not_read_into_memory(self):
+        self.servers['default'].delay = 0.5
+        content = bytes(range(256)) * (SPOOL_SIZE // 256 + 1)
+        upload = TemporaryUploadedFile('receipt.png', 'image/png', len(content), None)
+        self.addCleanup(upload.close)
+        upload.write(content)
+        upload.seek(0)
+
+        # An upload on disk is reopened for each backend
+        copies = extractors.ReceiptCopies(upload, 2)
+        self.assertEqual((copies.path, copies.content, copies.spooled), (upload.temporary_file_path(), None, None))
+        result, extractor = extractors.extract_with_backends(upload, 'image/png')
+        self.assertEqual(extractor.name, 'hedge')
+        for server in self.servers.values():
+            url = server.requests[0]['messages'][1]['content'][1]['image_url']['url']
+            self.assertEqual(base64.b64decode(url.split(',', 1)[1]), content)
+
+        # Anything else that is large is spooled to one temporary file
+        copies = extractors.ReceiptCopies(ContentFile(content, name='receipt.png'), 2)
+        self.assertIsNone(copies.content)
+        with copies() as first, copies() as second:
+            first.read(10)
+            self.assertEqual(second.read(), content)
+        spooled = copies.spooled
+        copies.close()
+        self.assertFalse(os.path.exists(spooled))
+
+    def test_hedge_deadline_follows_recent_latency(self):
+        extractor = extractors.get_extractors()[0]
+        self.assertEqual(extractor.hedge_deadline(), 0.2)
+        with override_settings(RECEIPT_HEDGE_MIN_SAMPLES=20, RECEIPT_HEDGE_PERCENTILE=95):
+            extractor.latencies.extend(i / 100 for i in range(1, 101))
+            self.assertEqual(extractor.hedge_deadline(), 0.96)
+
+    def test_failed_backend_hands_over_without_waiting(self):
+        self.servers['default'].status = 503
+        self.servers['default'].response = {'error': {'message': 'overloaded'}}
+        result, extractor = extractors.extract_with_backends(ContentFile(b'receipt', name='receipt.png'), 'image/png')
+        self.assertEqual(extractor.name, 'hedge')
+        self.assertEqual(len(self.servers['default'].requests), 1)
+
+    @skipUnless(pdfium is not None, "pypdfium2 is not installed")
+    def test_offline_fallback_reads_pdf_total(self):
+        for server in self.servers.values():
+            server.status = 503
+            server.response = {'error': {'message': 'overloaded'}}
+        receipt = text_pdf(['Quickmart Westlands', 'Milk 2 x 65.00 130.00', 'Subtotal 1,130.00', 'VAT 16% 180.80', 'TOTAL KES 1,310.80', 'Cash 1,500.00', 'Change 189.20'])
+
+        self.assertEqual(extract_receipt(ContentFile(receipt, name='receipt.pdf')), {'amount': 1310.8, 'description': 'Quickmart Westlands'})
+        self.assertIsNone(get_cached_result(hashlib.sha256(receipt).hexdigest(), extraction.PROMPT_VERSION))
+
+        with self.assertRaisesMessage(Exception, 'overloaded'):
+            extract_receipt(ContentFile(render_photo(3), name='receipt.png'))
+
+    def test_parse_total(self):
+        cases = [
+            ('Sub Total 100.00\nTax 16.00\nTotal 116.00', Decimal('116.00')),
+            ('Total\n2,450.50\nCash 3,000.00', Decimal('2450.50')),
+            ('Total items 3\nAmount Due: 87.25\nTendered 100.00', Decimal('87.25')),
+            ('Grand Total 540.00\nTotal savings 20.00\nTotal 560.00', Decimal('540.00')),
+            ('Bread 55.00\nMilk 65.50', Decimal('65.50')),
+            ('Thank you', None),
+        ]
+        for text, expected in cases:
+            self.assertEqual(extractors.parse_total(text), expected, text)
+
+
+def run_inline(fn, *args):
+    # Stand-in for executor.submit that runs `fn` before returning its future
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+@override_settings(RECEIPT_DERIVATIVES_ENABLED=False)
+class BatchExtractionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        cache.clear()
+        get_token_cache().clear()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.provider = stub_provider({'choices': [{'message': {'content': json.dumps({'amount': 12.5, 'description': 'Fuel'})}}]})
+        self.addCleanup(self.provider.stop)
+        override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            RECEIPT_EXTRACTORS={'default': {'BACKEND': 'finance.extractors.ChatCompletionsExtractor', 'URL': f'{self.provider.url}/v1/'}}
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        extractors.reset_extractors()
+        self.addCleanup(extractors.reset_extractors)
+        for patcher in (
+            mock.patch('finance.storage._receipt_storage', LocalReceiptStorage()),
+            mock.patch.object(batch.executor, 'submit', side_effect=run_inline),
+            mock.patch.object(batch, 'close_old_connections'),
+            mock.patch.object(fingerprints.executor, 'submit', side_effect=lambda fn, *args: fn(*args)),
+            mock.patch.object(fingerprints, 'close_old_connections'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, **data):
+        return self.client.post('/api/file/batch/', {
+            'receipts': [
+                SimpleUploadedFile('fuel.png', render_photo(1)),
+                SimpleUploadedFile('notes.txt', b'not a receipt'),
+                SimpleUploadedFile('lunch.png', render_photo(2)),
+            ],
+            **data
+        })
+
+    def lines(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_streams_one_line_per_receipt(self):
+        lines = self.lines(self.post())
+        self.assertEqual(sorted(line['index'] for line in lines), [0, 1, 2])
+        self.assertEqual({line['index']: line['status'] for line in lines}, {0: 'ok', 1: 'error', 2: 'ok'})
+        self.assertEqual(lines[-1]['result'], {'amount': 12.5, 'description': 'Fuel'})
+        self.assertEqual(len(self.provider.requests), 2)
+        self.assertFalse(Expense.objects.exists())
+
+    def test_created_expenses_go_through_the_save_path(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            lines = self.lines(self.post(create_expenses='true', project_name='Water', activity='Fuel'))
+        done = lines[-1]
+        self.assertEqual((done['status'], done['expenses_created']), ('done', 2))
+        self.assertEqual(sorted(done['expense_ids']), sorted(line['expense_id'] for line in lines if 'expense_id' in line))
+
+        expenses = Expense.objects.filter(pk__in=done['expense_ids'])
+        self.assertEqual({expense.activity_ref.name for expense in expenses}, {'Fuel'})
+        self.assertEqual(ProjectSpendRollup.objects.get(project=self.project).expense_count, 2)
+        self.assertEqual(ChangeLog.objects.filter(kind=EXPENSE, object_id__in=done['expense_ids']).count(), 2)
+        self.assertEqual(
+            set(ReceiptFingerprint.objects.exclude(receipt='').values_list('receipt', flat=True)),
+            {expense.receipt.name for expense in expenses}
+        )
+
+    def test_disconnecting_keeps_the_expenses_already_streamed(self):
+        # The server stops reading the stream once the client is gone
+        response = self.post(create_expenses='true', project_name='Water')
+        stream = iter(response.streaming_content)
+        lines = [json.loads(next(stream)) for _ in range(2)]
+
+        saved = [line['expense_id'] for line in lines if 'expense_id' in line]
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(list(Expense.objects.values_list('pk', flat=True)), saved)
+
+
+class StubS3Handler(BaseHTTPRequestHandler):
+    # Path-style object PUT/GET/HEAD, enough for an S3-compatible bucket
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.objects[urlsplit(self.path).path] = body
+        self.server.puts += 1
+        self.send(200, headers=[('ETag', f'"{hashlib.md5(body).hexdigest()}"')])
+
+    def do_GET(self):
+        body = self.server.objects.get(urlsplit(self.path).path)
+        if body is None:
+            self.send(404, b'<Error><Code>NoSuchKey</Code></Error>', [('Content-Type', 'application/xml')])
+        else:
+            self.send(200, body, [('Content-Type', 'application/octet-stream')])
+
+    def do_HEAD(self):
+        body = self.server.objects.get(urlsplit(self.path).path)
+        self.send(404 if body is None else 200, headers=[('Content-Length-Hint', str(len(body or b'')))])
+
+    def log_message(self, *args):
+        pass
+
+
+@skipUnless(S3Storage is not None, "django-storages[s3] is not installed")
+class S3ReceiptStorageTests(SimpleTestCase):
+    def setUp(self):
+        from .storage import S3ReceiptStorage
+
+        self.server = StubServer(StubS3Handler, objects={}, puts=0)
+        self.storage = S3ReceiptStorage(
+            bucket_name='receipts',
+            endpoint_url=self.server.url,
+            access_key='test',
+            secret_key='test',
+            region_name='us-east-1',
+            addressing_style='path'
+        )
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_content_addressed_save_and_presigned_urls(self):
+        names = {self.storage.save(f'receipts/{name}', SimpleUploadedFile(name, JPEG)) for name in ('a.jpg', 'b.jpg')}
+        sha256 = hashlib.sha256(JPEG).hexdigest()
+        self.assertEqual(names, {receipt_key(sha256, '.jpg')})
+        self.assertEqual(self.server.puts, 1)
+
+        url = self.storage.url(receipt_key(sha256, '.jpg'))
+        self.assertIn('X-Amz-Signature=', url)
+        self.assertEqual(httpx.get(url).content, JPEG)
+
+        other = b'\x89PNG\r\n\x1a\n' + bytes(100)
+        other_key = receipt_key(hashlib.sha256(other).hexdigest(), '.png')
+        upload = self.storage.upload_target(other_key, hashlib.sha256(other).hexdigest(), 'image/png')
+        self.assertEqual(httpx.put(upload['url'], content=other, headers=upload['headers']).status_code, 200)
+        self.assertTrue(self.storage.exists(other_key))
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        cache.clear()
+
+    def add_expense(self, amount):
+        return Expense.objects.create(
+            project_id=self.project,
+            project_name=self.project.name,
+            activity='Fuel',
+            amount=amount,
+            description='Trip',
+            receipt='receipts/trip.jpg',
+            project_officer_id=self.user,
+            project_officer=self.user.first_name
+        )
+
+    def test_expenses_by_project_revalidates(self):
+        url = f'/api/projects/{self.project.pk}/expenses/'
+        self.add_expense(5)
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Another page or field set is another representation
+        self.assertNotEqual(self.client.get(url + '?fields=id')['ETag'], etag)
+
+        expense = self.add_expense(7)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+
+        etag = response['ETag']
+        expense.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    @override_settings(RECEIPT_SIGNED_URLS=True, RECEIPT_URL_EXPIRY=3600)
+    def test_signed_receipt_urls_are_not_served_stale(self):
+        url = f'/api/projects/{self.project.pk}/expenses/'
+        self.add_expense(5)
+        now = time.time()
+        with mock.patch('finance.caching.time.time', return_value=now):
+            response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        receipt_url = response.json()['results'][0]['receipt']
+        self.assertIn('signature=', receipt_url)
+
+        # Half the URLs' lifetime later the page is rebuilt with fresh links
+        with mock.patch('finance.caching.time.time', return_value=now + 1800):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+            response = self.client.get(url)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_project_list_revalidates(self):
+        response = self.client.get('/api/projects/')
+        etag = response['ETag']
+        self.assertNotIn('expenses_version', response.json()[0])
+        self.assertEqual(self.client.get('/api/projects/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Expense writes leave the project list alone, project writes do not
+        self.add_expense(5)
+        self.assertEqual(self.client.get('/api/projects/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.patch(f'/api/projects/{self.project.name}/update_status/', {'status': 'completed'}, content_type='application/json')
+        response = self.client.get('/api/projects/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['status'], 'completed')
+
+
+# Committed transactions, so that on PostgreSQL the change feed serves the
+# entries written by each test
+@override_settings(RECEIPT_DERIVATIVES_ENABLED=False, RECEIPT_FINGERPRINTS_ENABLED=False)
+class SyncTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        self.token = Token.objects.create(user=self.user)
+        self.project = Project.objects.create(name='Water', description='Boreholes')
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        get_token_cache().clear()
+        cache.clear()
+
+    def add_expense(self, amount, project=None):
+        project = project or self.project
+        return Expense.objects.create(
+            project_id=project,
+            project_name=project.name,
+            activity='Fuel',
+            amount=amount,
+            description='Trip',
+            receipt='receipts/trip.jpg',
+            project_officer_id=self.user,
+            project_officer=self.user.first_name
+        )
+
+    def sync(self, **params):
+        response = self.client.get('/api/sync/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_changes_and_tombstones_since_cursor(self):
+        first, second = self.add_expense(5), self.add_expense(7)
+        data = self.sync()
+        self.assertEqual([project['id'] for project in data['projects']], [self.project.pk])
+        self.assertEqual({expense['id'] for expense in data['expenses']}, {first.pk, second.pk})
+        self.assertEqual(data['deleted'], {'projects': [], 'expenses': []})
+        self.assertFalse(data['has_more'])
+        cursor = data['cursor']
+
+        # Nothing new keeps the cursor where it was
+        data = self.sync(cursor=cursor)
+        self.assertEqual((data['cursor'], data['projects'], data['expenses']), (cursor, [], []))
+
+        first.amount = 9
+        first.save()
+        second_id = second.pk
+        second.delete()
+        third = self.add_expense(3)
+        data = self.sync(cursor=cursor)
+        self.assertEqual([expense['id'] for expense in data['expenses']], [first.pk, third.pk])
+        self.assertEqual(data['expenses'][0]['amount'], '9.00')
+        self.assertEqual(data['deleted'], {'projects': [], 'expenses': [second_id]})
+        self.assertEqual(data['projects'], [])
+
+        # A first sync has nothing to delete
+        self.assertEqual(self.sync()['deleted'], {'projects': [], 'expenses': []})
+
+        # Deleting a project deletes its expenses too
+        cursor, project_id = data['cursor'], self.project.pk
+        self.project.delete()
+        data = self.sync(cursor=cursor)
+        self.assertEqual(data['deleted']['projects'], [project_id])
+        self.assertEqual(sorted(data['deleted']['expenses']), [first.pk, third.pk])
+
+    def test_pages(self):
+        expenses = [self.add_expense(amount) for amount in range(1, 6)]
+        seen, cursor, pages = [], None, 0
+        while True:
+            data = self.sync(page_size=2, **({'cursor': cursor} if cursor else {}))
+            pages += 1
+            seen += [('project', project['id']) for project in data['projects']]
+            seen += [('expense', expense['id']) for expense in data['expenses']]
+            cursor = data['cursor']
+            if not data['has_more']:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(seen), sorted([('project', self.project.pk)] + [('expense', expense.pk) for expense in expenses]))
+
+    def test_project_filter_and_fields(self):
+        other = Project.objects.create(name='Schools', description='Desks')
+        mine, _ = self.add_expense(5), self.add_expense(6, project=other)
+        data = self.sync(project_id=self.project.pk, fields='id,amount')
+        self.assertEqual([project['id'] for project in data['projects']], [self.project.pk])
+        self.assertEqual(data['expenses'], [{'id': mine.pk, 'amount': '5.00'}])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/sync/', {'cursor': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/sync/', {'project_id': 'Water'}).status_code, 400)
+
+    def test_change_entry_commits_with_its_row(self):
+        # A save whose post_save receivers fail leaves neither the row nor
+        # its sync entry behind
+        with mock.patch('finance.signals.schedule_derivatives', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.add_expense(5)
+        self.assertFalse(Expense.objects.exists())
+        self.assertFalse(ChangeLog.objects.filter(kind=EXPENSE).exists())
+
+    @skipUnless(connection.vendor == 'postgresql', "Transaction ids are only recorded on PostgreSQL")
+    def test_change_entry_has_the_txid_of_its_write(self):
+        expense = self.add_expense(5)
+        expense.amount = 6
+        expense.save()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT xmin::text::bigint FROM finance_expense WHERE id = %s', [expense.pk])
+            xmin = cursor.fetchone()[0]
+        entry = ChangeLog.objects.get(kind=EXPENSE, object_id=expense.pk)
+        # txid_current() is xmin extended with an epoch
+        self.assertEqual(entry.txid % 2 ** 32, xmin)
+
+    def test_queries_do_not_grow_with_changes(self):
+        def queries(count):
+            cursor = self.sync()['cursor']
+            for amount in range(count):
+                self.add_expense(amount)
+            with CaptureQueriesContext(connection) as context:
+                data = self.sync(cursor=cursor)
+            self.assertEqual(len(data['expenses']), count)
+            return len(context.captured_queries)
+
+        self.assertEqual(queries(2), queries(30))
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_BYTES=200)
+    def test_compressed_response(self):
+        for amount in range(20):
+            self.add_expense(amount)
+        plain = self.client.get('/api/sync/')
+        self.assertNotIn('Content-Encoding', plain)
+
+        response = self.client.get('/api/sync/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(json.loads(gzip.decompress(response.content)), plain.json())
+
+        refused = self.client.get('/api/sync/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', refused)
+
+
+class TokenCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        get_token_cache().clear()
+        cache.clear()
+        self.url = f'/api/projects/{self.project.pk}/expenses/'
+
+    def get(self, key=None):
+        return self.client.get(self.url, HTTP_AUTHORIZATION=f'Bearer {key or self.token.key}')
+
+    def test_repeat_requests_skip_the_token_query(self):
+        # Token, project version and page, then only the version once both
+        # the token and the response are cached
+        with self.assertNumQueries(3):
+            self.assertEqual(self.get().status_code, 200)
+        for _ in range(3):
+            with self.assertNumQueries(1):
+                self.assertEqual(self.get().status_code, 200)
+
+        stats = self.client.get('/api/auth/cache/stats/', HTTP_AUTHORIZATION=f'Bearer {self.token.key}')
+        self.assertEqual(stats.status_code, 403)
+        self.assertEqual(get_token_cache().stats()['hits'], 4)
+        self.assertEqual(get_token_cache().stats()['misses'], 1)
+
+    def test_deactivating_user_invalidates(self):
+        self.assertEqual(self.get().status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get().status_code, 401)
+
+    def test_rotating_token_invalidates(self):
+        self.assertEqual(self.get().status_code, 200)
+        old_key = self.token.key
+        self.token.delete()
+        new_token = Token.objects.create(user=self.user)
+        self.assertEqual(self.get(old_key).status_code, 401)
+        self.assertEqual(self.get(new_token.key).status_code, 200)
+
+    def test_lru_is_bounded_and_expires(self):
+        token_cache = TokenCache(max_entries=2, ttl=60)
+        for key in ('a', 'b', 'c'):
+            token_cache.set(key, self.user, self.token)
+        self.assertIsNone(token_cache.get('a'))
+        self.assertIsNotNone(token_cache.get('c'))
+
+        token_cache.ttl = 0
+        token_cache.set('d', self.user, self.token)
+        self.assertIsNone(token_cache.get('d'))
+
+
+class RequestMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.admin = User.objects.create_user('admin', password='secret', is_staff=True)
+        cls.admin_token = Token.objects.create(user=cls.admin)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+
+    def setUp(self):
+        get_token_cache().clear()
+        cache.clear()
+        self.url = f'/api/projects/{self.project.pk}/expenses/'
+
+    def get(self, url, token=None):
+        return self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {(token or self.token).key}')
+
+    @override_settings(SERVER_TIMING_ENABLED=True)
+    def test_records_queries_and_bytes_per_view(self):
+        queries = metrics.DB_QUERIES.values[('expenses-by-project',)]
+        sent = metrics.RESPONSE_BYTES.values[('expenses-by-project',)]
+        requests = metrics.REQUESTS.values[('expenses-by-project', 'GET', 200)]
+
+        response = self.get(self.url)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        self.assertEqual(metrics.DB_QUERIES.values[('expenses-by-project',)] - queries, 3)
+        self.assertEqual(metrics.RESPONSE_BYTES.values[('expenses-by-project',)] - sent, len(response.content))
+        self.assertEqual(metrics.REQUESTS.values[('expenses-by-project', 'GET', 200)] - requests, 1)
+
+    def test_metrics_endpoint_is_admin_only(self):
+        self.get(self.url)
+        self.assertEqual(self.get('/api/metrics/').status_code, 403)
+        response = self.get('/api/metrics/', self.admin_token)
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('finance_http_requests_total{view="expenses-by-project",method="GET",status="200"}', body)
+        self.assertIn('finance_http_request_duration_seconds_bucket{view="expenses-by-project",method="GET",le="+Inf"}', body)
+        self.assertIn('finance_token_cache_hits_total', body)
+        self.assertIn('finance_provider_circuit_open 0', body)
+
+    def test_slow_requests_are_profiled(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_SLOW_REQUEST_MS=0, PROFILE_DIR=directory):
+            self.get(self.url)
+        profiles = os.listdir(directory)
+        self.assertEqual(len(profiles), 1)
+        self.assertIn('-expenses-by-project-', profiles[0])
+
+        # Fast requests are profiled but not saved
+        with override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_SLOW_REQUEST_MS=60000, PROFILE_DIR=directory):
+            self.get(self.url)
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+
+@override_settings(PASSWORD_PBKDF2_ITERATIONS=1000, LOGIN_RATE_PER_IP='', LOGIN_FAILURES_PER_USER='3/h')
+class LoginTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret-pass', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        get_token_cache().clear()
+
+    def login(self, password='secret-pass', username='officer'):
+        return self.client.post('/api/login/', {'username': username, 'password': password})
+
+    def test_login_reuses_token_and_upgrades_hash(self):
+        with override_settings(PASSWORD_PBKDF2_ITERATIONS=2000):
+            # The user and token in one query, then the rehash
+            with self.assertNumQueries(2):
+                response = self.login()
+            self.assertEqual(response.json()['token'], f'Bearer {self.token.key}')
+            self.user.refresh_from_db()
+            self.assertTrue(self.user.password.startswith('pbkdf2_sha256$2000$'))
+
+            with self.assertNumQueries(1):
+                self.assertEqual(self.login().status_code, 200)
+
+        # The issued token is already cached for the next request
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/auth/cache/stats/', HTTP_AUTHORIZATION=f'Bearer {self.token.key}')
+        self.assertEqual(response.status_code, 403)
+
+    def test_failed_logins_are_throttled_per_username(self):
+        for _ in range(3):
+            self.assertEqual(self.login('wrong').status_code, 400)
+        # Even the right password is refused until the window passes
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.login(username='someone-else').status_code, 400)
+
+    @override_settings(LOGIN_RATE_PER_IP='2/m')
+    def test_attempts_are_throttled_per_address(self):
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login().status_code, 429)
+
+    @override_settings(LOGIN_RATE_PER_IP='2/m')
+    def test_forwarded_addresses_cannot_be_spoofed(self):
+        spoofed = lambda i: self.client.post(
+            '/api/login/', {'username': 'officer', 'password': 'secret-pass'}, HTTP_X_FORWARDED_FOR=f'203.0.113.{i}'
+        )
+        self.assertEqual([spoofed(i).status_code for i in range(3)], [200, 200, 429])
+
+        # Behind one proxy the address it appends counts, not the client's
+        cache.clear()
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            behind_proxy = lambda i: self.client.post(
+                '/api/login/', {'username': 'officer', 'password': 'secret-pass'},
+                HTTP_X_FORWARDED_FOR=f'198.51.100.{i}, 192.0.2.1'
+            )
+            self.assertEqual([behind_proxy(i).status_code for i in range(3)], [200, 200, 429])
+
+    async def test_async_login(self):
+        factory = AsyncRequestFactory()
+        login = lambda password: async_views.login(factory.post(
+            '/api/login/', {'username': 'officer', 'password': password}, content_type='application/json'
+        ))
+        response = await login('secret-pass')
+        self.assertEqual(json.loads(response.content)['token'], f'Bearer {self.token.key}')
+        for _ in range(3):
+            self.assertEqual((await login('wrong')).status_code, 400)
+        self.assertEqual((await login('secret-pass')).status_code, 429)
+
+
+class AsyncURLConf:
+    # The native async views in front of the DRF ones, as with ASYNC_VIEWS on
+    urlpatterns = urls.async_urlpatterns + urls.urlpatterns
+
+
+@override_settings(RECEIPT_DERIVATIVES_ENABLED=False, RECEIPT_FINGERPRINTS_ENABLED=False)
+class AsyncViewTests(TestCase):
+    # Each request goes to a DRF view and to its async counterpart, and both
+    # must answer alike
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+        Activity.objects.create(project=cls.project, name='Fuel')
+        for i in range(3):
+            Expense.objects.create(
+                project_id=cls.project, project_name='Water', activity='Fuel', amount=i + 1,
+                description=f'Trip {i}', receipt='receipts/legacy.jpg', project_officer_id=cls.user, project_officer='Amina'
+            )
+
+    def setUp(self):
+        cache.clear()
+        get_token_cache().clear()
+        self.headers = {'Authorization': f'Bearer {self.token.key}'}
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch('finance.storage._receipt_storage', LocalReceiptStorage())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def both(self, method, path, data=None, headers=None):
+        # (DRF response, async response)
+        headers = self.headers if headers is None else headers
+        sync = getattr(self.client, method)(path, data, headers=headers)
+        for value in (data or {}).values():
+            if hasattr(value, 'seek'):
+                value.seek(0)
+        with override_settings(ROOT_URLCONF=AsyncURLConf):
+            native = async_to_sync(getattr(self.async_client, method))(path, data, headers=headers)
+        return sync, native
+
+    def assertSameResponse(self, sync, native, status_code):
+        self.assertEqual((sync.status_code, native.status_code), (status_code, status_code))
+        self.assertEqual(sync.json(), native.json())
+
+    def test_authentication(self):
+        for headers in ({}, {'Authorization': 'Bearer not-a-token'}, {'Authorization': 'Token ' + self.token.key}):
+            sync, native = self.both('get', '/api/expenses/', headers=headers)
+            self.assertSameResponse(sync, native, 401)
+            self.assertEqual(sync['WWW-Authenticate'], native['WWW-Authenticate'])
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertSameResponse(*self.both('get', '/api/expenses/'), 401)
+
+    def test_listings(self):
+        self.assertSameResponse(*self.both('get', '/api/expenses/?page_size=2'), 200)
+        self.assertSameResponse(*self.both('get', f'/api/projects/{self.project.pk}/expenses/?fields=id,amount'), 200)
+
+    def test_create(self):
+        expense = lambda **changes: {
+            'project_name': 'Water', 'activity': 'fuel', 'amount': '10.00', 'description': 'Trip',
+            'receipt': SimpleUploadedFile('fuel.jpg', JPEG), **changes
+        }
+        sync, native = self.both('post', '/api/expenses/', expense())
+        self.assertEqual((sync.status_code, native.status_code), (201, 201), native.content)
+        created = [response.json() for response in (sync, native)]
+        self.assertEqual(created[0].keys(), created[1].keys())
+        for field in ('project_name', 'activity', 'activity_id', 'amount', 'receipt', 'project_officer_id', 'project_officer'):
+            self.assertEqual(created[0][field], created[1][field], field)
+        self.assertEqual(created[1]['activity'], 'Fuel')
+
+        for invalid in (
+            expense(project_name='Roads'),
+            expense(receipt=SimpleUploadedFile('fuel.txt', b'not a receipt')),
+            expense(receipt=SimpleUploadedFile('fuel.png', JPEG)),
+            expense(amount='ten'),
+        ):
+            self.assertSameResponse(*self.both('post', '/api/expenses/', invalid), 400)
+        self.assertEqual(Expense.objects.count(), 5)
+
+
+class DenormalizationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+        Expense.objects.bulk_create([
+            Expense(
+                project_id=cls.project,
+                project_name=cls.project.name,
+                activity='Fuel',
+                amount=i,
+                description='Trip',
+                project_officer_id=cls.user,
+                project_officer=cls.user.first_name
+            )
+            for i in range(1, 26)
+        ])
+
+    def copies(self, field):
+        return set(Expense.objects.values_list(field, flat=True))
+
+    @override_settings(DENORMALIZATION_BATCH_SIZE=10)
+    def test_renames_propagate_in_batches(self):
+        self.project.name = 'Clean Water'
+        with mock.patch.object(denormalization.executor, 'submit', side_effect=lambda fn, *args: fn(*args)), \
+                mock.patch.object(denormalization, 'close_old_connections'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.project.save()
+            self.assertEqual(self.copies('project_name'), {'Clean Water'})
+
+            self.user.first_name = 'Amina W.'
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.save()
+            self.assertEqual(self.copies('project_officer'), {'Amina W.'})
+
+            # Saves that leave the copied fields alone schedule nothing
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.project.save()
+            self.assertEqual(callbacks, [])
+
+    def test_batches_update_by_primary_key(self):
+        Project.objects.filter(pk=self.project.pk).update(name='Clean Water')
+        # Per batch: the current name, the rows, and in a savepoint their
+        # update and its change log entries; then the version bump
+        with self.assertNumQueries(3 * 7 + 1):
+            self.assertEqual(denormalization.propagate('project_name', self.project.pk, batch_size=10), 25)
+        self.assertEqual(denormalization.propagate('project_name', self.project.pk, batch_size=10), 0)
+
+    def test_verifier_finds_and_fixes_drift(self):
+        # Queryset updates bypass the signals
+        Project.objects.filter(pk=self.project.pk).update(name='Clean Water')
+        User.objects.filter(pk=self.user.pk).update(first_name='Amina W.')
+        out = io.StringIO()
+        call_command('verify_denormalized_fields', '--chunk-size', '7', stdout=out)
+        self.assertIn('project_name: 25 rows out of date', out.getvalue())
+        self.assertEqual(self.copies('project_name'), {'Water'})
+
+        call_command('verify_denormalized_fields', '--chunk-size', '7', '--fix', stdout=out)
+        self.assertEqual(self.copies('project_name'), {'Clean Water'})
+        self.assertEqual(self.copies('project_officer'), {'Amina W.'})
+
+
+# A second database in the test settings (badili_africa.replica_test_settings)
+# stands in for a replica. Nothing replicates to it, so rows written only to
+# the primary show whether a read was routed. Mirrors of the primary cannot
+# show that. DATABASE_REPLICAS stays empty for the other tests.
+REPLICA_ALIASES = [
+    alias for alias, database in settings.DATABASES.items()
+    if alias != 'default' and not database.get('TEST', {}).get('MIRROR')
+]
+
+@skipUnless(REPLICA_ALIASES, "Run with --settings=badili_africa.replica_test_settings to test replica routing")
+@override_settings(DATABASE_REPLICAS=REPLICA_ALIASES[:1])
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', *REPLICA_ALIASES[:1]}
+
+    @classmethod
+    def setUpTestData(cls):
+        replica = REPLICA_ALIASES[0]
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.project = Project.objects.create(name='Water', description='Boreholes')
+        for instance in (cls.user, cls.token, cls.project):
+            instance.save(using=replica)
+        Expense.objects.create(
+            project_id=cls.project,
+            project_name=cls.project.name,
+            activity='Fuel',
+            amount=5,
+            description='Trip',
+            receipt='receipts/trip.jpg',
+            project_officer_id=cls.user,
+            project_officer=cls.user.first_name
+        )
+
+    def setUp(self):
+        cache.clear()
+        caches[settings.DB_REPLICA_STICKY_CACHE].clear()
+        get_token_cache().clear()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+        self.url = f'/api/projects/{self.project.pk}/expenses/'
+
+    def test_reads_go_to_replica_until_the_client_writes(self):
+        self.assertEqual(self.client.get(self.url).json()['results'], [])
+
+        self.client.patch(f'/api/projects/{self.project.name}/update_status/', {'status': 'completed'}, content_type='application/json')
+        self.assertEqual(len(self.client.get(self.url).json()['results']), 1)
+
+        # Other clients still read from the replica
+        self.assertEqual(Project.objects.using(REPLICA_ALIASES[0]).get().status, 'active')
+
+    def test_stickiness_is_kept_in_the_shared_cache(self):
+        self.client.patch(f'/api/projects/{self.project.name}/update_status/', {'status': 'completed'}, content_type='application/json')
+        # Another worker's process-local cache knows nothing of the write
+        cache.clear()
+        self.assertEqual(len(self.client.get(self.url).json()['results']), 1)
+
+        with override_settings(DB_REPLICA_STICKY_CACHE=''), self.assertRaises(ImproperlyConfigured):
+            ReplicaRoutingMiddleware(lambda request: None)
+
+    def test_router_defaults_to_primary(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Expense), 'default')
+        token = read_from_replica.set(True)
+        try:
+            self.assertIn(router.db_for_read(Expense), settings.DATABASE_REPLICAS)
+            self.assertEqual(router.db_for_write(Expense), 'default')
+        finally:
+            read_from_replica.reset(token)
+
+
+class BenchmarkTests(TestCase):
+    def test_seed_and_measure(self):
+        data = seed(users=2, projects=3, expenses=25, chunk_size=10)
+        self.assertEqual(Expense.objects.count(), 25)
+        self.assertEqual(ProjectSpendRollup.objects.aggregate(count=Sum('expense_count'))['count'], 25)
+
+        summary = run_scenario(self.client, 'project-expenses', data, iterations=3, warmup=0)
+        self.assertEqual(summary['ok'], 3)
+        self.assertGreater(summary['queries'], 0)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'list-expenses': {'p50': 10, 'p95': 20, 'p99': 30, 'rps': 100, 'queries': 2}}
+        current = {'list-expenses': {'p50': 10, 'p95': 25, 'p99': 30, 'rps': 90, 'queries': 3}}
+        regressed = {metric for _, metric, _, _, _, flagged in compare(baseline, current, max_regression=10) if flagged}
+        self.assertEqual(regressed, {'p95', 'queries'})
+        self.assertFalse(any(row[-1] for row in compare(baseline, baseline)))
+
+
+@skipUnless(connection.vendor == 'postgresql', "Query plans are only checked on PostgreSQL")
+class QueryPlanTests(TestCase):
+    # Runs EXPLAIN on every query the hot endpoints issue against a seeded
+    # dataset. Sequential scans are disabled for the check, so a "Seq Scan"
+    # left in a plan means no index can serve that query at all.
+    PROJECTS = 200
+    EXPENSES_PER_PROJECT = 50
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('officer', password='secret', first_name='Amina')
+        cls.token = Token.objects.create(user=cls.user)
+        projects = Project.objects.bulk_create([
+            Project(name=f'Project {i}', description='') for i in range(cls.PROJECTS)
+        ])
+        Expense.objects.bulk_create(link_activities([
+            Expense(
+                project_id=project,
+                project_name=project.name,
+                activity='Fuel',
+                amount=10,
+                description='Seeded',
+                receipt='receipts/seed.jpg',
+                project_officer_id=cls.user,
+                project_officer=cls.user.first_name
+            )
+            for project in projects
+            for _ in range(cls.EXPENSES_PER_PROJECT)
+        ]), batch_size=2000)
+        record_changes(EXPENSE, Expense.objects.values_list('pk', 'project_id'))
+        cls.project = projects[len(projects) // 2]
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {self.token.key}'
+
+    def assertIndexedPlans(self, queries):
+        selects = [query['sql'] for query in queries if query['sql'].lstrip().upper().startswith('SELECT')]
+        self.assertTrue(selects)
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for sql in selects:
+                cursor.execute(f'EXPLAIN {sql}')
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+                self.assertNotIn('Seq Scan', plan, f"{sql}\n{plan}")
+
+    def assertEndpointIndexed(self, method, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data, content_type='application/json')
+        self.assertLess(response.status_code, 400)
+        self.assertIndexedPlans(context.captured_queries)
+
+    def assertQuerysetIndexed(self, queryset):
+        with CaptureQueriesContext(connection) as context:
+            list(queryset)
+        self.assertIndexedPlans(context.captured_queries)
+
+    def test_expense_list(self):
+        response = self.client.get('/api/expenses/?page_size=20').json()
+        self.assertEndpointIndexed('get', '/api/expenses/?page_size=20')
+        self.assertEndpointIndexed('get', response['next'])
+
+    def test_expenses_by_project(self):
+        self.assertEndpointIndexed('get', f'/api/projects/{self.project.pk}/expenses/')
+
+    def test_update_project_status(self):
+        self.assertEndpointIndexed('patch', f'/api/projects/{self.project.name}/update_status/', {'status': 'completed'})
+
+    def test_project_lookup_by_name(self):
+        self.assertQuerysetIndexed(Project.objects.filter(name=self.project.name)[:1])
+
+    def test_expenses_by_officer(self):
+        self.assertQuerysetIndexed(Expense.objects.filter(project_officer_id=self.user).order_by('-created_at')[:50])
+
+    def test_activity_budget(self):
+        self.assertEndpointIndexed('get', f'/api/projects/{self.project.pk}/activities/')
+
+    def test_sync(self):
+        self.assertEndpointIndexed('get', '/api/sync/?page_size=20')
+        self.assertEndpointIndexed('get', f'/api/sync/?cursor=0-0&project_id={self.project.pk}')
+
+    def test_expense_search(self):
+        self.assertEndpointIndexed('get', '/api/expenses/search/?q=Project 7')
+        # A typo falls back to the trigram indexes
+        self.assertEndpointIndexed('get', '/api/expenses/search/?q=Projetc')
@@ -0,0 +1,124 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Token key -> (user, token) cache in front of BearerTokenAuthentication.
+# Entries live in a bounded in-process LRU for `ttl` seconds, optionally backed
+# by a shared Django cache so a miss in one worker can be served from another.
+# Invalidation (finance.signals) reaches this process's LRU and the shared
+# cache immediately; other processes' LRUs drop stale entries within `ttl`.
+
+class TokenCache:
+    def __init__(self, max_entries=10000, ttl=60, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def shared_key(key):
+        # Never use the raw token as a key in an external store
+        return 'finance:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def _copy(user, token):
+        # Callers get their own instances, so a view changing request.user
+        # cannot leak into other requests
+        token = copy.copy(token)
+        token.user = copy.copy(user)
+        return token.user, token
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, user, token = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self._copy(user, token)
+                del self.entries[key]
+
+        if self.shared is not None:
+            cached = self.shared.get(self.shared_key(key))
+            if cached is not None:
+                with self.lock:
+                    self.shared_hits += 1
+                self._store(key, *cached)
+                return self._copy(*cached)
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, user, token):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, user, token)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def set(self, key, user, token):
+        user, token = self._copy(user, token)
+        self._store(key, user, token)
+        if self.shared is not None:
+            self.shared.set(self.shared_key(key), (user, token), self.ttl)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+        if self.shared is not None and keys:
+            self.shared.delete_many([self.shared_key(key) for key in keys])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.shared_hits) / lookups, 4) if lookups else None,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'shared_backend': settings.TOKEN_CACHE_SHARED_BACKEND or None,
+            }
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+def get_token_cache():
+    global _token_cache
+    if not settings.TOKEN_CACHE_ENABLED:
+        return None
+    with _token_cache_lock:
+        if _token_cache is None:
+            shared = settings.TOKEN_CACHE_SHARED_BACKEND
+            _token_cache = TokenCache(
+                max_entries=settings.TOKEN_CACHE_MAX_ENTRIES,
+                ttl=settings.TOKEN_CACHE_TTL,
+                shared=caches[shared] if shared else None
+            )
+        return _token_cache
+
+def invalidate_tokens(*keys):
+    token_cache = get_token_cache()
+    if token_cache is not None:
+        token_cache.invalidate(*keys)
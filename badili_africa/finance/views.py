@@ -1,22 +1,43 @@
+import mimetypes
 import os
-import base64
-import json
-import requests
 import re
+import tempfile
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.shortcuts import render , get_object_or_404
-from django.http import JsonResponse
-from rest_framework import viewsets, permissions, generics, status
-from rest_framework.decorators import api_view, authentication_classes, permission_classes , parser_classes
+from django.urls import reverse
+from django.core.files import File
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+from rest_framework import viewsets, permissions, generics, serializers, status
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes , parser_classes
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from rest_framework.parsers import MultiPartParser, FormParser
-from .models import Expense, User, Project
-from .serializers import ExpenseSerializer, UserSerializer, ProjectSerializer, LoginSerializer
+from .models import Expense, User, Project, Activity, ExtractionJob
+from .serializers import ExpenseSerializer, UserSerializer, ProjectSerializer, ActivitySerializer, LoginSerializer, ExtractionJobSerializer, ExpenseSearchSerializer
 from .authentication import BearerTokenAuthentication
-
-api_key = os.getenv('OPENAI_API_KEY')
+from .extraction import extract_receipt
+from .extraction_cache import cache_stats
+from .token_cache import get_token_cache
+from .jobs import submit_job
+from .batch import stream_batch_extraction
+from .uploads import CHUNK_SIZE, EXTENSION_TYPES, MAX_RECEIPT_BYTES, ReceiptMultiPartParser, extension_matches_content, inspect_upload
+from .storage import RECEIPT_KEY_PATTERN, receipt_key, receipt_storage, verify_receipt_signature
+from .pagination import ExpenseCursorPagination, SearchPagination
+from .rollups import all_projects_summary, project_summary
+from .streaming import EXPENSE_EXPORT_FIELDS, EXPENSE_EXPORT_SOURCES, export_response, export_rows
+from .caching import cached_list, project_expenses_version, project_list_version
+from .derivatives import derivative_name, derivative_url, generate_derivatives
+from .importing import PARSERS, ImportAborted, detect_format, import_expenses
+from .metrics import exposition
+from .login import FailedLoginThrottle, LoginRateThrottle, issue_token, login_response_data
+from .search import filter_expenses, search_expenses
+from .fingerprints import possible_duplicates
+from .activities import activities_added, budget_report
+from .sync import EXPENSE, PROJECT, InvalidCursor, changes_since, format_cursor, parse_cursor
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -28,48 +49,219 @@ class ProjectViewSet(viewsets.ModelViewSet):
     serializer_class = ProjectSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            # Activity names for every listed project in one query
+            queryset = queryset.prefetch_related('activity_set')
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # Polled by the dashboard: answer 304 or a cached body while no
+        # project has changed
+        version, updated_at = project_list_version()
+        build = lambda: self.get_serializer(self.filter_queryset(self.get_queryset()), many=True).data
+        return list_response(*cached_list(request, 'projects', version, updated_at, build))
+
+    # Spending totals come from the rollup table, never from the expenses
+    @action(detail=False, methods=['get'], url_path='spending')
+    def spending_summary(self, request):
+        return Response(all_projects_summary())
+
+    @action(detail=True, methods=['get'])
+    def spending(self, request, pk=None):
+        return Response(project_summary(self.get_object()))
+
+    # Budget against spend per activity; POST adds an activity
+    @action(detail=True, methods=['get', 'post'])
+    def activities(self, request, pk=None):
+        project = self.get_object()
+        if request.method == 'GET':
+            return Response(budget_report(project))
+
+        serializer = ActivitySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        name = serializer.validated_data['name'].strip()
+        if Activity.objects.filter(project=project, name__iexact=name).exists():
+            return Response({"name": ["The project already has this activity."]}, status=status.HTTP_400_BAD_REQUEST)
+        serializer.save(project=project, name=name)
+        activities_added([project.pk])
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    # Only the budget can change: expenses and rollups keep the name
+    @action(detail=True, methods=['patch'], url_path=r'activities/(?P<activity_pk>[0-9]+)', url_name='activity')
+    def activity(self, request, pk=None, activity_pk=None):
+        activity = get_object_or_404(Activity, project=self.get_object(), pk=activity_pk)
+        serializer = ActivitySerializer(activity, data={'budget': request.data.get('budget')}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data)
+
+def with_duplicates(receipt_data, duplicates):
+    # Flag expenses that already have this receipt, or another photo of it
+    if duplicates:
+        return {**receipt_data, 'possible_duplicates': duplicates}
+    return receipt_data
+
+def list_response(data, headers):
+    # Response for finance.caching.cached_list's result
+    if data is None:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(data, headers=headers)
+
+# Serialized expense fields computed from the receipt rather than stored
+EXPENSE_DERIVATIVE_FIELDS = ['thumbnail', 'thumbnail_webp', 'preview']
+
+def requested_expense_fields(request):
+    # `?fields=id,amount` limits both the response and the selected columns
+    fields = request.query_params.get('fields')
+    allowed = EXPENSE_EXPORT_FIELDS + EXPENSE_DERIVATIVE_FIELDS
+    if not fields:
+        return allowed
+    return [field for field in fields.split(',') if field in allowed]
+
+def expense_list_queryset(queryset, fields):
+    # Only load the serialized columns, plus those the pagination orders by
+    columns = {EXPENSE_EXPORT_SOURCES.get(field, field) for field in fields if field not in EXPENSE_DERIVATIVE_FIELDS}
+    columns |= {'id', 'created_at'}
+    if set(fields) & set(EXPENSE_DERIVATIVE_FIELDS):
+        columns |= {'receipt', 'receipt_derivatives'}
+    return queryset.only(*columns)
+
 class ExpenseViewSet(viewsets.ModelViewSet):
     queryset = Expense.objects.all()
     serializer_class = ExpenseSerializer
     permission_classes = [permissions.IsAuthenticated]
-    parser_classes = (MultiPartParser, FormParser)
+    parser_classes = (ReceiptMultiPartParser, FormParser)
+    pagination_class = ExpenseCursorPagination
 
-    def perform_create(self, serializer):
-        # Get project name from request data
-        project_name = self.request.data.get('project_name')
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            queryset = expense_list_queryset(queryset, requested_expense_fields(self.request))
+        return queryset
 
-        # Find the first project with the given name
-        project = Project.objects.filter(name=project_name).first()
+    def get_serializer(self, *args, **kwargs):
+        if self.action in ('list', 'search'):
+            kwargs['fields'] = requested_expense_fields(self.request)
+        return super().get_serializer(*args, **kwargs)
 
-        if not project:
-            # Return an error if no project is found
-            raise ValidationError({"error": "Project with the given name not found."})
-
-        # Get the uploaded file from the request
-        file = self.request.FILES.get('receipt', None)
-        
-        # Validate file size and type
-        if file:
-            self.validate_file(file)
-
-        # Save the expense with the project_id and project officer details
-        serializer.save(
-            project_id=project,
-            project_officer_id=self.request.user,
-            project_officer=self.request.user.first_name
-        )
-
-    def validate_file(self, file):
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        # Ranked full-text search with typo tolerance, see finance.search
+        params = ExpenseSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        filters = dict(params.validated_data)
+        q = filters.pop('q').strip()
+
+        queryset = filter_expenses(self.get_queryset(), **filters)
+        queryset = expense_list_queryset(queryset, requested_expense_fields(request))
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(search_expenses(q, queryset), request, view=self)
+        return paginator.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        # Every expense (optionally of one project) streamed as a JSON array,
+        # or as CSV / JSON Lines with ?type=csv or ?type=ndjson
+        expenses = Expense.objects.all()
+        project_id = request.query_params.get('project_id')
+        if project_id:
+            if not project_id.isdigit():
+                return Response({"error": "Invalid project_id."}, status=status.HTTP_400_BAD_REQUEST)
+            expenses = expenses.filter(project_id=project_id)
+        fields = [field for field in requested_expense_fields(request) if field in EXPENSE_EXPORT_FIELDS]
+        return export_response(export_rows(expenses, fields), fields, request.query_params.get('type'), 'expenses')
+
+    @action(detail=True, methods=['get'], url_path=r'receipt/(?P<kind>[a-z_]+)', url_name='receipt-derivative')
+    def receipt_derivative(self, request, pk=None, kind=None):
+        # Render a missing thumbnail or preview on first request, then send
+        # the client to the stored copy
+        expense = self.get_object()
+        if derivative_url(expense, kind) is None:
+            raise Http404("No such derivative for this receipt.")
+        if kind not in expense.receipt_derivatives:
+            if kind not in generate_derivatives(expense.receipt.name):
+                raise Http404("Could not render this receipt.")
+        response = HttpResponseRedirect(receipt_storage().url(derivative_name(expense.receipt.name, kind)))
+        response['Cache-Control'] = f'private, max-age={settings.RECEIPT_URL_EXPIRY}'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser, FormParser])
+    def bulk_import(self, request):
+        # Create many expenses from an uploaded CSV or JSON Lines file
+        file = request.FILES.get('file')
+        if not file:
+            return Response({"error": "No file uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+        import_format = detect_format(file.name, request.data.get('type'))
+        if import_format not in PARSERS:
+            return Response({"error": "Unsupported import type. Use csv or ndjson."}, status=status.HTTP_400_BAD_REQUEST)
+
+        file.seek(0)
+        try:
+            summary = import_expenses(
+                PARSERS[import_format](file),
+                request.user,
+                chunk_size=settings.EXPENSE_IMPORT_CHUNK_SIZE,
+                skip_invalid=request.data.get('skip_invalid', '').lower() == 'true',
+                dry_run=request.data.get('dry_run', '').lower() == 'true'
+            )
+        except ImportAborted as e:
+            return Response(e.summary, status=status.HTTP_400_BAD_REQUEST)
+        return Response(summary, status=status.HTTP_201_CREATED)
+
+    def perform_create(self, serializer):
+        save_expense(serializer, self.request.user, self.request.data.get('project_name'), self.request.FILES.get('receipt', None))
+
+    @staticmethod
+    def validate_file(file):
         # Check file size (limit 15MB)
         max_size_mb = 15
         if file.size > max_size_mb * 1024 * 1024:
-            raise ValidationError({"error": f"File size exceeds {max_size_mb}MB."})
+            raise serializers.ValidationError({"error": f"File size exceeds {max_size_mb}MB."})
 
         # Check file extension
         allowed_extensions = ['.pdf', '.doc', '.docx', '.odf', '.jpg', '.jpeg', '.png']
         ext = os.path.splitext(file.name)[1].lower()
         if ext not in allowed_extensions:
-            raise ValidationError({"error": "Invalid file type. Allowed types: PDF, Word documents, or images."})
+            raise serializers.ValidationError({"error": "Invalid file type. Allowed types: PDF, Word documents, or images."})
+
+        # Check the file content actually is what the extension claims
+        if not extension_matches_content(file):
+            raise serializers.ValidationError({"error": "File content does not match its extension."})
+
+def save_expense(serializer, user, project_name, file):
+    # Create the expense of a validated ExpenseSerializer. Shared by
+    # ExpenseViewSet and the async expense_list, so both check alike.
+
+    # Find the first project with the given name
+    project = Project.objects.filter(name=project_name).first()
+
+    if not project:
+        # Return an error if no project is found
+        raise serializers.ValidationError({"error": "Project with the given name not found."})
+
+    # Validate file size and type
+    if file:
+        ExpenseViewSet.validate_file(file)
+
+    # Save the expense with the project_id and project officer details
+    serializer.save(
+        project_id=project,
+        project_officer_id=user,
+        project_officer=user.first_name
+    )
+
+def create_expense(request, data, files):
+    # ExpenseViewSet's create for a plain Django request; raises
+    # rest_framework's ValidationError with the same details
+    payload = data.copy()
+    payload.update(files)
+    serializer = ExpenseSerializer(data=payload, context={'request': request})
+    serializer.is_valid(raise_exception=True)
+    save_expense(serializer, request.user, data.get('project_name'), files.get('receipt', None))
+    return serializer.data
 
 
 class SignupView(generics.CreateAPIView):
@@ -88,24 +280,76 @@ class SignupView(generics.CreateAPIView):
         }, status=status.HTTP_201_CREATED)
 
 class LoginView(ObtainAuthToken):
+    serializer_class = LoginSerializer
+    authentication_classes = []
+    # Checked before the password is hashed
+    throttle_classes = [LoginRateThrottle, FailedLoginThrottle]
+
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data, context={'request': request})
-        serializer.is_valid(raise_exception=True)
-        user = serializer.validated_data['user']
-        token, created = Token.objects.get_or_create(user=user)
-        return Response({
-            'token': f'Bearer {token.key}',
-            'user_id': user.pk,
-            'email': user.email
-        })
+        if not serializer.is_valid():
+            FailedLoginThrottle().record_failure(request, self)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        user = serializer.validated_data
+        return Response(login_response_data(user, issue_token(user)))
 
 @api_view(['GET'])
 @authentication_classes([BearerTokenAuthentication])
 @permission_classes([permissions.IsAuthenticated])
 def get_expenses_by_project(request, project_id):
-    expenses = Expense.objects.filter(project_id=project_id)
-    serializer = ExpenseSerializer(expenses, many=True)
-    return Response(serializer.data)
+    def build():
+        fields = requested_expense_fields(request)
+        expenses = expense_list_queryset(Expense.objects.filter(project_id=project_id), fields)
+        paginator = ExpenseCursorPagination()
+        page = paginator.paginate_queryset(expenses, request)
+        serializer = ExpenseSerializer(page, many=True, fields=fields)
+        return paginator.get_paginated_response(serializer.data).data
+
+    version, updated_at = project_expenses_version(project_id)
+    if version is None:
+        return Response(build())
+    return list_response(*cached_list(request, f'expenses-{project_id}', version, updated_at, build, signed_urls=True))
+
+@api_view(['GET'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAuthenticated])
+def sync_changes(request):
+    # Projects and expenses written since `cursor`, and the ids of those
+    # deleted since. Clients keep the returned cursor for their next sync and
+    # call again straight away while `has_more` is true.
+    try:
+        cursor = parse_cursor(request.query_params.get('cursor'))
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    project_id = request.query_params.get('project_id')
+    if project_id is not None and not project_id.isdigit():
+        return Response({"error": "Invalid project_id."}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = int(request.query_params.get('page_size', settings.SYNC_PAGE_SIZE))
+    except ValueError:
+        limit = settings.SYNC_PAGE_SIZE
+    limit = min(max(limit, 1), settings.SYNC_MAX_PAGE_SIZE)
+
+    entries, has_more = changes_since(cursor, project_id=project_id and int(project_id), limit=limit)
+    written = {PROJECT: [], EXPENSE: []}
+    deleted = {PROJECT: [], EXPENSE: []}
+    for txid, seq, kind, object_id, is_deleted in entries:
+        (deleted if is_deleted else written)[kind].append(object_id)
+    if entries:
+        cursor = entries[-1][:2]
+
+    # Rows deleted after their entry was read are left out here; their
+    # tombstones come with a later sync
+    fields = requested_expense_fields(request)
+    projects = Project.objects.filter(pk__in=written[PROJECT]).prefetch_related('activity_set') if written[PROJECT] else []
+    expenses = expense_list_queryset(Expense.objects.filter(pk__in=written[EXPENSE]), fields) if written[EXPENSE] else []
+    return Response({
+        "cursor": format_cursor(*cursor) if cursor else format_cursor(0, 0),
+        "has_more": has_more,
+        "projects": ProjectSerializer(projects, many=True).data,
+        "expenses": ExpenseSerializer(expenses, many=True, fields=fields, context={'request': request}).data,
+        "deleted": {"projects": deleted[PROJECT], "expenses": deleted[EXPENSE]},
+    })
 
 @api_view(['PATCH'])
 @authentication_classes([BearerTokenAuthentication])
@@ -131,7 +375,7 @@ def update_project_status(request, project_name):
 @api_view(['POST'])
 @authentication_classes([BearerTokenAuthentication])
 @permission_classes([permissions.IsAuthenticated])
-@parser_classes([MultiPartParser, FormParser])
+@parser_classes([ReceiptMultiPartParser, FormParser])
 def upload_receipt_and_extract_data(request):
     # Get the uploaded file from the request
     file = request.FILES.get('receipt', None)
@@ -143,17 +387,66 @@ def upload_receipt_and_extract_data(request):
         validate_file(file)
     except ValidationError as e:
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    
-    # Read the file content
-    file_content = file.read()
-    
-    # Send the file content to GPT-4 for processing
+
+    # In async mode queue the extraction and let the client poll for the result
+    if request.data.get('mode') == 'async':
+        try:
+            job = submit_job(file, user=request.user, callback_url=request.data.get('callback_url', ''))
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            "job_id": job.pk,
+            "status": job.status,
+            "status_url": request.build_absolute_uri(reverse('extraction_job', args=[job.pk]))
+        }, status=status.HTTP_202_ACCEPTED)
+
+    # Send the file to GPT-4 for processing, streamed from its temporary file,
+    # and warn about expenses that may already have this receipt
     try:
-        receipt_data = process_receipt_with_gpt(file_content)
+        duplicates = possible_duplicates(file)
+        receipt_data = with_duplicates(extract_receipt(file), duplicates)
         return Response(receipt_data, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['POST'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAuthenticated])
+@parser_classes([ReceiptMultiPartParser, FormParser])
+def upload_receipts_batch(request):
+    # Get all uploaded files from the request
+    files = request.FILES.getlist('receipts')
+    if not files:
+        return Response({"error": "No files uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+    max_files = settings.RECEIPT_BATCH_MAX_FILES
+    if len(files) > max_files:
+        return Response({"error": f"At most {max_files} files can be uploaded at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Optionally create an expense for every successfully extracted receipt
+    project = None
+    if request.data.get('create_expenses', '').lower() == 'true':
+        project = Project.objects.filter(name=request.data.get('project_name')).first()
+        if not project:
+            return Response({"error": "Project with the given name not found."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Validate every file up front; invalid ones are reported in the stream
+    errors = {}
+    for index, file in enumerate(files):
+        try:
+            validate_file(file)
+        except ValidationError as e:
+            errors[index] = " ".join(e.messages)
+
+    results = stream_batch_extraction(
+        files,
+        errors,
+        project=project,
+        activity=request.data.get('activity', ''),
+        user=request.user
+    )
+    return StreamingHttpResponse(results, content_type='application/x-ndjson')
+
 def validate_file(file):
     # Check file size (limit 15MB)
     max_size_mb = 15
@@ -166,64 +459,126 @@ def validate_file(file):
     if ext not in allowed_extensions:
         raise ValidationError("Invalid file type. Allowed types: PDF or images.")
 
-def process_receipt_with_gpt(file_content):
-    # Encode the file content as base64
-    base64_image = base64.b64encode(file_content).decode('utf-8')
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-
-    payload = {
-        "model": "gpt-4o",
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are a system that processes receipts and extracts key details."
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Here is a receipt. Please extract the total amount and provide a brief description of the purchase. Return the result as a JSON object with 'amount' (as a number) and 'description' (as a string) fields."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ],
-        "max_tokens": 300
-    }
-
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    response_data = response.json()
-
-    if 'error' in response_data:
-        raise Exception(f"GPT API Error: {response_data['error']['message']}")
-
-    content = response_data['choices'][0]['message']['content']
-    
-     # Extract JSON from the content
-    json_str = extract_json_from_markdown(content)
-    
+    # Check the file content actually is what the extension claims
+    if not extension_matches_content(file):
+        raise ValidationError("File content does not match its extension.")
+
+@api_view(['GET'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAuthenticated])
+def get_extraction_job(request, job_id):
+    jobs = ExtractionJob.objects.all()
+    if not request.user.is_staff:
+        jobs = jobs.filter(submitted_by=request.user)
+    job = get_object_or_404(jobs, pk=job_id)
+    return Response(ExtractionJobSerializer(job).data)
+
+
+@api_view(['GET'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAdminUser])
+def get_extraction_cache_stats(request):
+    return Response(cache_stats())
+
+@api_view(['GET'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAdminUser])
+def get_token_cache_stats(request):
+    # Counters are per worker process
+    token_cache = get_token_cache()
+    return Response(token_cache.stats() if token_cache is not None else {'enabled': False})
+
+@api_view(['GET'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAdminUser])
+def get_metrics(request):
+    # Prometheus text format; counters are per worker process
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api_view(['POST'])
+@authentication_classes([BearerTokenAuthentication])
+@permission_classes([permissions.IsAuthenticated])
+def create_receipt_upload(request):
+    # Reserve a storage key for a receipt the client will upload itself.
+    # Keys are derived from the content hash, so a receipt that is already
+    # stored needs no upload at all.
+    sha256 = str(request.data.get('sha256', '')).lower()
+    extension = os.path.splitext(str(request.data.get('filename', '')))[1].lower()
     try:
-        # Parse the JSON string into a Python dictionary
-        receipt_data = json.loads(json_str)
-        return receipt_data
-    except json.JSONDecodeError:
-        raise Exception("Failed to parse GPT-4 response as JSON")
-
-def extract_json_from_markdown(content):
-    # Remove Markdown code block syntax
-    json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-    if json_match:
-        return json_match.group(1)
+        size = int(request.data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        return Response({"error": "sha256 must be the hex SHA-256 of the receipt."}, status=status.HTTP_400_BAD_REQUEST)
+    if extension not in EXTENSION_TYPES:
+        return Response({"error": "Invalid file type. Allowed types: PDF, Word documents, or images."}, status=status.HTTP_400_BAD_REQUEST)
+    if not 0 < size <= MAX_RECEIPT_BYTES:
+        return Response({"error": f"File size must be between 1 byte and {MAX_RECEIPT_BYTES // (1024 * 1024)}MB."}, status=status.HTTP_400_BAD_REQUEST)
+
+    key = receipt_key(sha256, extension)
+    storage = receipt_storage()
+    if storage.exists(key):
+        return Response({"receipt_key": key, "exists": True, "upload": None})
+
+    content_type = mimetypes.guess_type(f'receipt{extension}')[0] or 'application/octet-stream'
+    return Response({
+        "receipt_key": key,
+        "exists": False,
+        "upload": storage.upload_target(key, sha256, content_type)
+    }, status=status.HTTP_201_CREATED)
+
+@csrf_exempt
+@require_http_methods(['PUT'])
+def upload_receipt_content(request, name):
+    # Target of the signed upload URL for local storage. The body is streamed
+    # to a temporary file and only kept if it hashes to the key it was sent to.
+    match = RECEIPT_KEY_PATTERN.match(name)
+    if not match or not verify_receipt_signature(name, request.GET.get('signature', '')):
+        return JsonResponse({"error": "Invalid or expired upload URL."}, status=status.HTTP_403_FORBIDDEN)
+
+    with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE * 16) as body:
+        size = 0
+        while chunk := request.read(CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_RECEIPT_BYTES:
+                return JsonResponse({"error": f"File size exceeds {MAX_RECEIPT_BYTES // (1024 * 1024)}MB."}, status=status.HTTP_400_BAD_REQUEST)
+            body.write(chunk)
+
+        receipt = File(body, name=name)
+        details = inspect_upload(receipt)
+        if details['sha256'] != match.group(1):
+            return JsonResponse({"error": "Content does not match the receipt key."}, status=status.HTTP_400_BAD_REQUEST)
+        if EXTENSION_TYPES[match.group(2)] != details['file_type']:
+            return JsonResponse({"error": "File content does not match its extension."}, status=status.HTTP_400_BAD_REQUEST)
+        receipt_storage().save(name, receipt)
+
+    return JsonResponse({"receipt_key": name}, status=status.HTTP_201_CREATED)
+
+@require_GET
+def download_receipt(request, name):
+    # Target of signed receipt URLs. The signature is the credential, so the
+    # link works from an <img> tag or a browser without the API token.
+    if not verify_receipt_signature(name, request.GET.get('signature', '')):
+        return JsonResponse({"error": "Invalid or expired receipt URL."}, status=status.HTTP_403_FORBIDDEN)
+
+    storage = receipt_storage()
+    if not storage.exists(name):
+        raise Http404("Receipt not found.")
+
+    if settings.RECEIPT_STORAGE != 'local':
+        # Let the client fetch it from the bucket with a presigned URL
+        return HttpResponseRedirect(storage.url(name))
+
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if settings.RECEIPT_SERVE_MODE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.RECEIPT_ACCEL_PREFIX + name
+    elif settings.RECEIPT_SERVE_MODE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = storage.path(name)
     else:
-        # If no code block is found, assume the entire content is JSON
-        return content.strip()
\ No newline at end of file
+        response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+    response['Cache-Control'] = f'private, max-age={settings.RECEIPT_URL_EXPIRY}'
+    return response